@@ -0,0 +1,266 @@
+"""
+Benchmarks pipeline stages on synthetic data.
+
+Times each cleaner, aggregator, selector and transformer separately on a
+synthetic raw piece and compares the timings with a stored baseline. Runs
+without access to S3.
+
+Usage:
+    python -m benchmarks.run                  # compare with baseline
+    python -m benchmarks.run --save-baseline  # store timings as baseline
+
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import benchmarks.synthetic as syn
+import src.config as config
+import src.data.aggregators as agg
+import src.data.clean as cl
+import src.data.grouper as gr
+import src.data.selectors as sl
+import src.data.transformers as tf
+
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), "baselines")
+
+# Timing differences below this many seconds are treated as noise
+MIN_DIFF = 0.005
+
+
+def _time(func, make_args, repeat):
+    """Returns fastest of repeat timings of func and its last result.
+
+    make_args is called before each run, outside of the timing, so that
+    functions that modify their inputs get fresh copies.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        args = make_args()
+        start = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def time_cleaners(raw, repeat):
+    """Returns timings of cleaners and clean piece.
+
+    Rows selected by cleaners are applied once all cleaners have run, as in
+    `cl.clean_data`.
+    """
+    timings = {}
+    df, rows = raw, None
+    for func in cl.cleaner_funcs:
+        name = f"clean.{func.__name__}"
+        if func.rows:
+            timings[name], rows = _time(func, lambda: [df, rows], repeat)
+        else:
+            make_args = lambda: [cl.split_columns(df.copy())]
+            timings[name], df = _time(func, make_args, repeat)
+    if rows is not None:
+        df = df.take(rows)
+    return timings, df.reset_index(drop=True)
+
+
+def _dependency_order(funcs):
+    """Returns names of funcs and their requirements, requirements first."""
+    order = []
+
+    def visit(name):
+        if name not in order:
+            for req in agg.registry[name].requires:
+                visit(req)
+            order.append(name)
+
+    for func in funcs:
+        visit(func.__name__)
+    return order
+
+
+def time_aggregators(df, repeat):
+    """Returns timings of aggregators and intermediates and aggregated data.
+
+    Each function is timed with the results it requires already computed.
+    """
+    df = df[agg.input_columns()]
+    timings = {}
+    timings["aggregate.grouper"], g = _time(
+        gr.Grouper, lambda: [df, agg.GROUP_COLS], repeat
+    )
+    results = {}
+    for name in _dependency_order(agg.aggregators):
+        func = agg.registry[name]
+        kwargs = {req: results[req] for req in func.requires}
+        timings[f"aggregate.{name}"], results[name] = _time(
+            lambda *args: func(*args, **kwargs), lambda: [df, g], repeat
+        )
+    aggregated = [results[func.__name__] for func in agg.aggregators]
+    timings["aggregate.collect"], panel = _time(g.collect, lambda: [aggregated], repeat)
+    return timings, panel.reset_index()
+
+
+def time_selectors(panel, repeat):
+    """Returns timings of user summary and selectors and selected data."""
+    timings = {}
+    timings["select.user_summary"], users = _time(
+        sl.user_summary, lambda: [panel, sl.selectors], repeat
+    )
+    keep = pd.Series(True, index=users.index)
+    for func in sl.selectors:
+        timings[f"select.{func.__name__}"], mask = _time(func, lambda: [users], repeat)
+        keep &= mask
+    return timings, panel[keep.reindex(panel.user_id).to_numpy()]
+
+
+def time_transformers(df, repeat):
+    """Returns timings of transformers."""
+    timings = {}
+    tf.sketches.clear()
+    for func in tf.transformers:
+        timings[f"transform.{func.__name__}"], df = _time(
+            func, lambda: [df.copy()], repeat
+        )
+    return timings
+
+
+def run(params, repeat=3):
+    """Returns timings of all pipeline stages on synthetic piece."""
+    raw = syn.make_raw_piece(**params)
+    nspl_lookup, build_cache_dir = config.NSPL_LOOKUP, config.BUILD_CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.NSPL_LOOKUP = os.path.join(tmpdir, "lookup.csv")
+        # Keeps parquet copy of synthetic lookup out of the build cache
+        config.BUILD_CACHE_DIR = os.path.join(tmpdir, "build")
+        syn.make_regions(seed=params.get("seed", 0)).to_csv(config.NSPL_LOOKUP, index=False)
+        cl._read_regions.cache_clear()
+        try:
+            # Stages print progress and timings, which would swamp the report
+            with contextlib.redirect_stdout(io.StringIO()):
+                clean_timings, clean = time_cleaners(raw, repeat)
+        finally:
+            config.NSPL_LOOKUP = nspl_lookup
+            config.BUILD_CACHE_DIR = build_cache_dir
+            cl._read_regions.cache_clear()
+    agg_timings, panel = time_aggregators(clean, repeat)
+    select_timings, selected = time_selectors(panel, repeat)
+    transform_timings = time_transformers(selected, repeat)
+    return {**clean_timings, **agg_timings, **select_timings, **transform_timings}
+
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def save_baseline(name, params, timings):
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    baseline = {
+        "params": params,
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "timings": timings,
+    }
+    with open(baseline_path(name), "w") as f:
+        json.dump(baseline, f, indent=2)
+
+
+def compare(baseline, timings, tolerance):
+    """Returns table comparing timings with baseline.
+
+    A stage has regressed if it is slower than the baseline by more than
+    tolerance, as a share of the baseline, and by more than `MIN_DIFF`.
+    Stages timed in only one of baseline and timings, such as new or
+    renamed stages, are unmatched.
+    """
+    table = pd.DataFrame(
+        {"baseline": pd.Series(baseline["timings"]), "current": pd.Series(timings)}
+    )
+    table["ratio"] = table.current / table.baseline
+    table["regressed"] = table.ratio.gt(1 + tolerance) & (
+        table.current - table.baseline
+    ).gt(MIN_DIFF)
+    table["unmatched"] = table.baseline.isna() | table.current.isna()
+    return table
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--txns-per-user", type=int, default=300)
+    parser.add_argument("--descriptions", type=int, default=5000)
+    parser.add_argument("--merchants", type=int, default=1000)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-r", "--repeat", type=int, default=3)
+    parser.add_argument("-b", "--baseline", default="default", help="Name of baseline")
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store timings as baseline instead of comparing with it",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative slowdown above which a stage counts as regressed",
+    )
+    return parser.parse_args(args)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    params = dict(
+        users=args.users,
+        txns_per_user=args.txns_per_user,
+        descriptions=args.descriptions,
+        merchants=args.merchants,
+        skew=args.skew,
+        seed=args.seed,
+    )
+    timings = run(params, repeat=args.repeat)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, params, timings)
+        print(f"Baseline {args.baseline} written.")
+        return 0
+
+    path = baseline_path(args.baseline)
+    if not os.path.exists(path):
+        print(pd.Series(timings, name="seconds").to_string())
+        print(f"No baseline {args.baseline}, run with --save-baseline to store one.")
+        return 0
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline["params"] != params:
+        print(f"Baseline {args.baseline} was run with {baseline['params']}.")
+        return 1
+
+    table = compare(baseline, timings, args.tolerance)
+    options = ["display.max_rows", None, "display.width", None]
+    with pd.option_context(*options, "display.float_format", "{:.4f}".format):
+        print(table)
+    regressed = table.index[table.regressed].tolist()
+    if regressed:
+        print("Regressed:", ", ".join(regressed))
+    unmatched = table.index[table.unmatched].tolist()
+    if unmatched:
+        print("Not in both baseline and run:", ", ".join(unmatched))
+        print(f"Run with --save-baseline to update baseline {args.baseline}.")
+    return 1 if regressed or unmatched else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
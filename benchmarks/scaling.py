@@ -0,0 +1,213 @@
+"""
+Measures how the full pipeline scales with data size and worker count.
+
+Generates ten synthetic raw pieces for each scale factor, then runs
+`src.data.clean` and `src.data.make_data` on them in separate processes for
+each worker count, recording wall time, CPU time, peak RSS and rows per
+second. Writes a scaling table and a speedup curve to the output directory.
+Runs without access to S3.
+
+Usage:
+    python -m benchmarks.scaling --scales 1 2 4 --workers 1 2 4
+
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+import benchmarks.synthetic as syn
+import src.config as config
+import src.data.clean as cl
+
+
+NUM_PIECES = 10
+
+# Runs command given as arguments and prints its wall time and the resource
+# usage of it and its children (e.g. worker processes) as json. Running each
+# command in a fresh process keeps peak RSS of earlier commands out of it.
+MEASURE = """
+import json, resource, subprocess, sys, time
+start = time.perf_counter()
+subprocess.run(sys.argv[1:], check=True, stdout=sys.stderr)
+wall = time.perf_counter() - start
+usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+cpu = usage.ru_utime + usage.ru_stime
+print(json.dumps({"wall": wall, "cpu": cpu, "peak_rss_mb": usage.ru_maxrss / 1024}))
+"""
+
+
+def measure(cmd, env, log):
+    """Runs cmd and returns its wall time, CPU time and peak RSS.
+
+    CPU time includes all worker processes, peak RSS is that of the largest
+    process.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE, *cmd],
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=log,
+        check=True,
+        text=True,
+    )
+    return json.loads(result.stdout)
+
+
+def make_dataset(root, scale, users_per_piece, txns_per_user):
+    """Writes raw pieces and NSPL lookup for scale factor to root and returns
+    paths and number of rows of raw pieces."""
+    raw_dir = os.path.join(root, "raw", "pieces")
+    os.makedirs(raw_dir)
+    os.makedirs(os.path.join(root, "clean", "pieces"))
+    syn.make_regions().to_csv(os.path.join(root, "lookup.csv"), index=False)
+    users = int(users_per_piece * scale)
+    filepaths, rows = [], 0
+    for piece in range(NUM_PIECES):
+        df = syn.make_raw_piece(
+            users=users,
+            txns_per_user=txns_per_user,
+            seed=piece,
+            first_user=piece * users + 1,
+        )
+        filepaths.append(os.path.join(raw_dir, f"mdb_XX{piece}.parquet"))
+        df.to_parquet(filepaths[-1], index=False)
+        rows += len(df)
+    return filepaths, rows
+
+
+def run_scale(root, scale, workers, args, log):
+    """Returns measurements of clean and make_data stages for scale factor."""
+    filepaths, raw_rows = make_dataset(
+        root, scale, args.users_per_piece, args.txns_per_user
+    )
+    clean_dir = os.path.join(root, "clean", "pieces")
+    env = dict(
+        os.environ,
+        MDB_NSPL_LOOKUP=os.path.join(root, "lookup.csv"),
+        MDB_OFFLINE="1",
+        MDB_CACHE_DIR=os.path.join(root, "cache"),
+        MDB_BUILD_CACHE_DIR=os.path.join(root, "build"),
+        MDB_METRICS_DIR=os.path.join(root, "metrics"),
+    )
+    records = []
+    clean_rows = None
+    for n in workers:
+        print(f"Scale {scale}, {n} workers", flush=True)
+        clean = [sys.executable, "-m", "src.data.clean", *filepaths, "-w", str(n)]
+        records.append(dict(stage="clean", rows=raw_rows, **measure(clean, env, log)))
+        if clean_rows is None:
+            clean_rows = sum(
+                pq.ParquetFile(cl.clean_path(fp)).metadata.num_rows for fp in filepaths
+            )
+        make_data = [
+            sys.executable,
+            "-m",
+            "src.data.make_data",
+            "--source",
+            clean_dir,
+            "--output",
+            root,
+            "--tables",
+            root,
+            "--workers",
+            str(n),
+            "--no-cache",
+        ]
+        records.append(
+            dict(stage="make_data", rows=clean_rows, **measure(make_data, env, log))
+        )
+        for record in records[-2:]:
+            record.update(scale=scale, workers=n)
+    return records
+
+
+def scaling_table(records):
+    """Returns scaling table with rows per second and speedup over the
+    smallest worker count of each stage and scale factor."""
+    table = pd.DataFrame(records).set_index(["stage", "scale", "workers"]).sort_index()
+    table["rows_per_sec"] = table.rows / table.wall
+    base = table.wall.groupby(level=["stage", "scale"]).transform("first")
+    table["speedup"] = base / table.wall
+    table["efficiency"] = table.speedup / table.index.get_level_values("workers")
+    return table
+
+
+def plot_speedup(table, filepath):
+    """Plots speedup against worker count for each stage and scale factor."""
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    stages = table.index.unique("stage")
+    fig, axes = plt.subplots(1, len(stages), figsize=(5 * len(stages), 4), squeeze=False)
+    for ax, stage in zip(axes[0], stages):
+        for scale, group in table.loc[stage].groupby(level="scale"):
+            workers = group.index.get_level_values("workers")
+            ax.plot(workers, group.speedup, marker="o", label=f"scale {scale}")
+        ax.plot(workers, workers / workers.min(), color="grey", linestyle=":")
+        ax.set(title=stage, xlabel="Workers", ylabel="Speedup")
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(filepath)
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument(
+        "--users-per-piece",
+        type=int,
+        default=500,
+        help="Number of users in each piece at scale factor 1",
+    )
+    parser.add_argument("--txns-per-user", type=int, default=300)
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=os.path.join(config.ROOTDIR, "output", "benchmarks"),
+        help="Directory to write scaling table, speedup plot and logs to",
+    )
+    return parser.parse_args(args)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+
+    records, failed = [], []
+    with open(os.path.join(args.output, "scaling.log"), "w") as log:
+        for scale in args.scales:
+            with tempfile.TemporaryDirectory() as root:
+                try:
+                    records.extend(
+                        run_scale(root, scale, sorted(args.workers), args, log)
+                    )
+                except subprocess.CalledProcessError as e:
+                    # E.g. no users are left in the final sample at small scales
+                    print(f"Scale {scale} failed with exit status {e.returncode}.")
+                    failed.append(scale)
+    if failed:
+        print(f"See {log.name} for errors of scales {', '.join(map(str, failed))}.")
+    if not records:
+        sys.exit(1)
+
+    table = scaling_table(records)
+    table.to_csv(os.path.join(args.output, "scaling.csv"))
+    plot_speedup(table, os.path.join(args.output, "speedup.png"))
+    with pd.option_context("display.width", None, "display.float_format", "{:.2f}".format):
+        print(table)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Synthetic MDB data for benchmarks.
+
+Generates raw pieces with the columns and value formats of the raw MDB data
+(see `cast_dtypes` in `src/data/clean.py`), and a matching NSPL lookup table,
+so the entire pipeline can run without access to S3.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+import src.data.txn_classifications as tc
+
+
+POSTCODES = [f"{area}{i} {j}" for area in ["ab", "cd", "ef"] for i in range(9) for j in range(9)]
+REGIONS = ["north east", "north west", "london", "south east", "scotland", "wales"]
+
+ACCOUNT_TYPES = ["Current", "Savings", "Credit Card"]
+DESCRIPTIONS = ["tesco dd", "Transfer to x", "bbp bill", "Save the change", "costa", "Amazon D/D"]
+USER_TAGS = ["No Tag", "Savings", "Groceries", "saving (general)"]
+BIRTH_YEARS = [1950.0, 1965.0, 1975.0, 1985.0, 1995.0, 2004.0, np.nan]
+
+
+def _zipf_choice(rng, options, size, skew):
+    """Draws from options with probabilities proportional to 1 / rank ** skew."""
+    options = np.asarray(options, dtype=object)
+    weights = 1 / np.arange(1, len(options) + 1) ** skew
+    return options[rng.choice(len(options), size, p=weights / weights.sum())]
+
+
+def make_raw_piece(
+    users=500,
+    txns_per_user=300,
+    descriptions=2000,
+    merchants=500,
+    skew=1.0,
+    seed=0,
+    first_user=1,
+):
+    """Returns synthetic raw piece.
+
+    Args:
+      users: number of users.
+      txns_per_user: mean number of txns per user.
+      descriptions: number of distinct txn descriptions.
+      merchants: number of distinct merchant names.
+      skew: skew of txns across users and of the frequency of categories.
+        Categories are drawn with probability proportional to
+        1 / rank ** skew, and txns per user are lognormally distributed
+        with shape skew. 0 gives uniform categories and equal numbers of
+        txns per user.
+      seed: seed of random number generator.
+      first_user: user id of first user, to give pieces distinct users.
+    """
+    rng = np.random.default_rng(seed)
+
+    weights = rng.lognormal(0, skew, users) if skew else np.ones(users)
+    counts = np.maximum(1, np.round(weights / weights.mean() * txns_per_user)).astype(int)
+    n = counts.sum()
+    user = np.repeat(np.arange(first_user, first_user + users), counts)
+
+    def per_user(values):
+        return np.repeat(values, counts)
+
+    reg = pd.Timestamp("2016-01-01") + pd.to_timedelta(rng.integers(0, 1500, users), "D")
+    date = per_user(reg.values) + pd.to_timedelta(rng.integers(-365, 365, n), "D").values
+    account = user * 10 + rng.integers(0, 4, n)
+
+    # Raw tags are partly capitalised and credits mostly tagged as income
+    tags = sorted({tag for tags in tc.tag_groups.values() for tag in tags})
+    tags = [tag.title() if i % 3 == 0 else tag for i, tag in enumerate(tags)] + ["No Tag"]
+    is_credit = rng.random(n) < 0.3
+    auto_tags = _zipf_choice(rng, tags, n, skew)
+    auto_tags[is_credit] = _zipf_choice(rng, tc.tag_groups["income"], is_credit.sum(), skew)
+    amount = np.round(rng.gamma(1.0, 100.0, n) * np.where(is_credit, 8, 1), 2)
+    descs = DESCRIPTIONS + [f"payment {i}" for i in range(descriptions - len(DESCRIPTIONS))]
+    merchant_names = ["No Merchant"] + [f"merchant {i}" for i in range(merchants - 1)]
+
+    df = pd.DataFrame(
+        {
+            "Transaction.Reference": np.arange(n),
+            "User.Reference": user,
+            "Year.of.Birth": per_user(rng.choice(BIRTH_YEARS, users)),
+            "Salary.Range": per_user(rng.choice(["10K to 20K", "20K to 30K"], users)),
+            "Postcode": per_user(rng.choice(POSTCODES, users)).astype(str),
+            "LSOA": "E01000001",
+            "MSOA": "E02000001",
+            "Derived.Gender": per_user(rng.choice(["F", "M", "U"], users)),
+            "Account.Reference": account,
+            "Provider.Group.Name": _zipf_choice(rng, ["Barclays", "HSBC", "Lloyds"], n, skew),
+            "Account.Type": np.array(ACCOUNT_TYPES)[account % 3],
+            "Latest.Recorded.Balance": rng.choice([0.0, 100.0, 2500.5], n),
+            "Transaction.Description": _zipf_choice(rng, descs, n, skew),
+            "Credit.Debit": np.where(is_credit, "Credit", "Debit"),
+            "Amount": amount,
+            "User.Precedence.Tag.Name": _zipf_choice(rng, USER_TAGS, n, skew),
+            "Manual.Tag.Name": "No Tag",
+            "Auto.Purpose.Tag.Name": auto_tags,
+            "Merchant.Name": _zipf_choice(rng, merchant_names, n, skew),
+            "Merchant.Business.Line": rng.choice(["No Merchant Business Line", "Food"], n),
+            "Transaction.Updated.Flag": "N",
+            "User.Registration.Date": per_user(reg.values),
+            "Transaction.Date": date,
+            "Account.Created.Date": per_user(reg.values),
+            "Account.Last.Refreshed": per_user(reg.values),
+            "Data.Warehouse.Date.Last.Updated": per_user(reg.values),
+            "Data.Warehouse.Date.Created": per_user(reg.values),
+        }
+    )
+    for col in df.select_dtypes(object):
+        df[col] = df[col].astype(str)
+    return df
+
+
+def make_regions(seed=0):
+    """Returns NSPL lookup table for postcodes of synthetic pieces."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "pcsector": POSTCODES,
+            "region_name": rng.choice(REGIONS, len(POSTCODES)),
+            "is_urban": rng.choice([0.0, 1.0], len(POSTCODES)),
+        }
+    )
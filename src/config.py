@@ -10,10 +10,53 @@ AWS_PROFILE = "3di"
 AWS_PIECES = "s3://3di-data-mdb/clean/pieces"
 AWS_PROJECT = "s3://3di-project-entropy"
 
+NSPL_LOOKUP = os.environ.get(
+    "MDB_NSPL_LOOKUP", "s3://3di-data-ons/nspl/NSPL_AUG_2020_UK/clean/lookup.csv"
+)
+
 ROOTDIR = Path(__file__).parent.parent
 FIGDIR = os.path.join(ROOTDIR, "output", "figures")
 TABDIR = os.path.join(ROOTDIR, "output", "tables")
 
+# Local cache of S3 objects, set MDB_OFFLINE=1 to read from cache only
+CACHE_DIR = os.environ.get("MDB_CACHE_DIR", os.path.join(ROOTDIR, ".cache", "s3"))
+CACHE_MAX_BYTES = int(os.environ.get("MDB_CACHE_MAX_BYTES", 50 * 2**30))
+# Cache files used more recently than this are never evicted, as other
+# processes may be about to read them
+CACHE_GRACE_SECONDS = int(os.environ.get("MDB_CACHE_GRACE_SECONDS", 3600))
+OFFLINE = os.environ.get("MDB_OFFLINE", "0") == "1"
+
+# Local cache of per-piece build stage results
+BUILD_CACHE_DIR = os.environ.get(
+    "MDB_BUILD_CACHE_DIR", os.path.join(ROOTDIR, ".cache", "build")
+)
+
+# Json reports of per-stage metrics of each run
+METRICS_DIR = os.environ.get("MDB_METRICS_DIR", os.path.join(ROOTDIR, "output", "metrics"))
+
+# Memory instrumentation of stages (see src/helpers/metrics.py). Budgets are
+# in MB of resident memory by "kind.name", "kind" or "*", e.g. set
+# MDB_MEMORY_BUDGETS="aggregate=4000,*=12000"
+TRACK_MEMORY = os.environ.get("MDB_TRACK_MEMORY", "0") == "1"
+
+
+def parse_budget(text):
+    """Parses budget given as "[stage=]MB" into a (stage, MB) pair, where a
+    bare MB applies to all stages."""
+    key, _, mb = text.rpartition("=")
+    return key or "*", float(mb)
+
+
+MEMORY_BUDGETS = dict(
+    parse_budget(item) for item in os.environ.get("MDB_MEMORY_BUDGETS", "").split(",") if item
+)
+
+# Stages to profile by "kind.name", "kind" or "*", and where profiles are
+# written to (see src/helpers/profiling.py)
+PROFILE_STAGES = [key for key in os.environ.get("MDB_PROFILE_STAGES", "").split(",") if key]
+PROFILE_DIR = os.environ.get("MDB_PROFILE_DIR", os.path.join(METRICS_DIR, "profiles"))
+PROFILE_TOP = 20
+
 # Data preprocessing parameters
 MAX_ACTIVE_ACCOUNTS = 10
 MIN_YEAR_INCOME = 5000
@@ -22,3 +65,6 @@ MIN_POST_MONTHS = 6
 MIN_MONTH_SPEND = 200
 MIN_MONTH_TXNS = 10
 WIN_PCT = 1
+
+# Relative accuracy of quantile sketches used for winsorisation thresholds
+SKETCH_ALPHA = 0.001
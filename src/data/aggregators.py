@@ -1,9 +1,17 @@
 """
 Functions to create columns for analysis dataset at user-month frequency.
 
+Each aggregator takes a piece of transaction data and the piece's shared
+user-month `Grouper`, and returns results indexed by the grouper's groups.
+Aggregators declare the piece columns they read and the aggregators or
+intermediates they depend on, and a per-piece `ResultCache` computes each of
+these exactly once.
+
 """
 
+import concurrent.futures
 import os
+import threading
 
 import numpy as np
 import pandas as pd
@@ -11,96 +19,193 @@ from scipy import stats
 import s3fs
 
 from src import config
+import src.data.flags as fl
+import src.data.grouper as gr
 import src.helpers.data as hd
-import src.helpers.helpers as hh
+import src.helpers.metrics as metrics
 
 
-TIMER_ON = False
+aggregators = []
+registry = {}
 
 
-aggregators = []
+GROUP_COLS = ["user_id", "ym"]
 
 
-def aggregator(func):
-    aggregators.append(func)
+def _register(func, inputs, requires):
+    func = metrics.instrument("aggregate")(func)
+    func.inputs = list(inputs)
+    func.requires = list(requires)
+    registry[func.__name__] = func
     return func
 
 
+def aggregator(func=None, inputs=(), requires=()):
+    """Adds function to list of aggregator functions.
+
+    Args:
+      inputs: columns of the piece read by func, in addition to the
+        grouping columns.
+      requires: names of aggregators or intermediates whose results are
+        passed to func as keyword arguments of the same name.
+    """
+
+    def decorate(func):
+        func = _register(func, inputs, requires)
+        aggregators.append(func)
+        return func
+
+    return decorate(func) if func else decorate
+
+
+def intermediate(func=None, inputs=(), requires=()):
+    """Registers function whose result is shared by aggregators.
+
+    Intermediates are computed only if an aggregator requires them and are
+    not added to the analysis data.
+    """
+
+    def decorate(func):
+        return _register(func, inputs, requires)
+
+    return decorate(func) if func else decorate
+
+
+def input_columns(funcs=None):
+    """Returns piece columns read by aggregators and their requirements."""
+    columns = set(GROUP_COLS)
+    pending = list(aggregators if funcs is None else funcs)
+    while pending:
+        func = pending.pop()
+        columns.update(func.inputs)
+        pending.extend(registry[name] for name in func.requires)
+    return sorted(columns)
+
+
+class ResultCache:
+    """Results of aggregators and intermediates for a single piece.
+
+    Each result is computed at most once, after the results it requires.
+    Results can be requested from several threads at once: the first thread
+    to request a result computes it and others wait for it. Call `clear()`
+    once the piece is aggregated to free the results.
+    """
+
+    def __init__(self, df):
+        self.df = df
+        self.grouper = gr.Grouper(df, keys=GROUP_COLS)
+        self.results = {}
+        self._running = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def get(self, name):
+        """Returns result of named aggregator or intermediate."""
+        with self._lock:
+            if name in self.results:
+                return self.results[name]
+            future = self._running.get(name)
+            is_owner = future is None
+            if is_owner:
+                future = self._running[name] = concurrent.futures.Future()
+        # Names this thread is computing, to detect circular dependencies
+        pending = self._local.__dict__.setdefault("pending", set())
+        if not is_owner:
+            if name in pending:
+                raise ValueError(f"Circular dependency involving {name}.")
+            return future.result()
+
+        pending.add(name)
+        try:
+            func = registry[name]
+            kwargs = {req: self.get(req) for req in func.requires}
+            result = func(self.df, self.grouper, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            pending.discard(name)
+        with self._lock:
+            self.results[name] = result
+            del self._running[name]
+        future.set_result(result)
+        return result
+
+    def get_all(self, names, threads=1):
+        """Returns results of named aggregators in the order of names.
+
+        Results are computed by a pool of threads if threads > 1, which all
+        read the same piece. This helps where aggregators spend their time
+        in NumPy or pandas code that releases the GIL.
+        """
+        if threads > 1:
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                return list(executor.map(self.get, names))
+        return [self.get(name) for name in names]
+
+    def clear(self):
+        self.results.clear()
+        self.df = self.grouper = None
+
+
 @aggregator
-@hh.timer(on=TIMER_ON)
-def numeric_ym(df):
+def numeric_ym(df, g):
     """Numeric ym variable for use in R."""
-    group_cols = [df.user_id, df.ym]
-    g = df.ym.groupby(group_cols).first()
-    yr = g.dt.year.astype("string")
-    mt = g.dt.month.astype("string").apply("{:0>2}".format)
-    return (yr + mt).astype("int").rename("ymn")
+    ym = g.level("ym")
+    return g.series(ym.year * 100 + ym.month, "ymn")
 
 
 @aggregator
-@hh.timer(on=TIMER_ON)
-def month(df):
+def month(df, g):
     """Numeric month for use as FE."""
-    group_cols = [df.user_id, df.ym]
-    return df.date.dt.month.groupby(group_cols).first().rename("month")
+    return g.series(g.level("ym").month, "month")
 
 
 @aggregator
-@hh.timer(on=TIMER_ON)
-def txns_count(df):
-    group_cols = [df.user_id, df.ym]
-    return df.groupby(group_cols).id.size().rename("txns_count")
+def txns_count(df, g):
+    return g.size("txns_count")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def txns_volume(df):
-    group_cols = [df.user_id, df.ym]
-    return df.amount.abs().groupby(group_cols).sum().rename("txns_volume")
+@aggregator(inputs=["amount"])
+def txns_volume(df, g):
+    return g.sum(df.amount.abs(), "txns_volume")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def income(df):
+@intermediate(inputs=fl.input_columns())
+def flags(df, g):
+    """Bit flags of txns, see `src/data/flags.py`."""
+    return fl.compute(df)
+
+
+@aggregator(inputs=["amount"], requires=["flags"])
+def income(df, g, flags):
     """Month and year income."""
-    is_income_pmt = df.tag_group.eq("income") & ~df.is_debit
+    is_income_pmt = fl.mask(flags, "income", unset=["debit"])
     inc_pmts = df.amount.where(is_income_pmt, 0).mul(-1)
-    year = df.date.dt.year.rename("year")
-
-    month_income = (
-        inc_pmts.groupby([df.user_id, df.ym, year]).sum().rename("month_income")
+    month_income = g.sum(inc_pmts, "month_income")
+    user_year = [g.level("user_id"), g.level("ym").year]
+    return pd.DataFrame(
+        {
+            "month_income": month_income,
+            "year_income": month_income.groupby(user_year).transform("sum"),
+            "month_income_mean": month_income.groupby(user_year).transform("mean"),
+        }
     )
-    year_income = inc_pmts.groupby([df.user_id, year]).sum().rename("year_income")
-    month_income_mean = (
-        inc_pmts.groupby([df.user_id, df.ym, year])
-        .sum()
-        .groupby(["user_id", "year"])
-        .transform("mean")
-        .rename("month_income_mean")
-    )
-
-    data = pd.merge(month_income, year_income, left_index=True, right_index=True)
 
-    return pd.merge(
-        data, month_income_mean, left_index=True, right_index=True
-    ).droplevel("year")
 
-
-@aggregator
-@hh.timer(on=TIMER_ON)
-def savings_accounts_flows(df):
+@aggregator(inputs=["amount"], requires=["flags", "income"])
+def savings_accounts_flows(df, g, flags, income):
     """Saving accounts flows variables."""
-    is_sa_flow = df.account_type.eq("savings") & df.amount.abs().gt(5)
-    sa_flows = df.amount.where(df.is_sa_flow, 0)
-    in_out = df.is_debit.map({True: "outflows", False: "inflows"})
-    month_income = income(df).month_income
-    group_vars = [df.user_id, df.ym, in_out]
+    is_debit = fl.mask(flags, "debit")
+    sa_flows = df.amount.where(fl.mask(flags, "sa_flow"), 0)
+    month_income = income.month_income
     return (
-        sa_flows.groupby(group_vars)
-        .sum()
-        .abs()
-        .unstack()
-        .fillna(0)
+        pd.DataFrame(
+            {
+                "inflows": g.sum(sa_flows.where(~is_debit, 0)).abs(),
+                "outflows": g.sum(sa_flows.where(is_debit, 0)).abs(),
+            }
+        )
         .assign(
             netflows=lambda df: df.inflows - df.outflows,
             netflows_norm=lambda df: df.netflows / month_income,
@@ -113,123 +218,97 @@ def savings_accounts_flows(df):
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def user_registration_ym(df):
+@aggregator(inputs=["user_registration_date"])
+def user_registration_ym(df, g):
     """Year-month of user registration."""
-    group_cols = [df.user_id, df.ym]
     return (
-        df.groupby(group_cols)
-        .user_registration_date.first()
-        .dt.to_period("m")
-        .rename("user_reg_ym")
+        g.first(df.user_registration_date).dt.to_period("m").rename("user_reg_ym")
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def treatment(df):
+@aggregator(requires=["user_registration_ym"])
+def treatment(df, g, user_registration_ym):
     """Treatment indicator."""
-    group_cols = [df.user_id, df.ym]
-    reg_ym = user_registration_ym(df)
-    return df.groupby(group_cols).ym.first().ge(reg_ym).astype("int").rename("t")
+    return g.series(g.level("ym") >= user_registration_ym, "t").astype("int")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def time_to_treatment(df):
+@aggregator(requires=["user_registration_ym"])
+def time_to_treatment(df, g, user_registration_ym):
     """Leads or lags to signup month.
 
     Month of signup is set to tt = 0.
     """
-    group_cols = [df.user_id, df.ym]
-    ym = df.ym.view("int")
-    reg_ym = df.user_registration_date.dt.to_period("m").view("int")
-    return ym.sub(reg_ym).groupby(group_cols).first().rename("tt")
+    ym = g.level("ym").asi8
+    return g.series(ym - user_registration_ym.array.asi8, "tt")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def month_spend(df):
+@intermediate(requires=["flags"])
+def is_spend(df, g, flags):
+    """Dummy for whether txn is a spend."""
+    return fl.mask(flags, "spend", "debit")
+
+
+@aggregator(inputs=["amount"], requires=["is_spend"])
+def month_spend(df, g, is_spend):
     """Total monthly spend."""
-    is_spend = df.tag_group.eq("spend") & df.is_debit
     spend = df.amount.where(is_spend, np.nan)
-    group_cols = [df.user_id, df.ym]
-    return spend.groupby(group_cols).sum().rename("month_spend")
+    return g.sum(spend, "month_spend")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def age(df):
+@aggregator(inputs=["birth_year"], requires=["user_registration_ym"])
+def age(df, g, user_registration_ym):
     """Adds user age at time of signup."""
-    group_cols = [df.user_id, df.ym]
-    age = df.user_registration_date.dt.year - df.birth_year
-    return age.groupby(group_cols).first().rename("age")
+    reg_year = user_registration_ym.dt.year
+    return (reg_year - g.first(df.birth_year)).rename("age")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def female(df):
+@aggregator(inputs=["is_female"])
+def female(df, g):
     """Dummy for whether user is a women."""
-    group_cols = [df.user_id, df.ym]
-    return df.groupby(group_cols).is_female.first()
+    return g.first(df.is_female)
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def region(df):
+@aggregator(inputs=["is_urban", "region_name"])
+def region(df, g):
     """Region and urban dummy."""
-    group_cols = [df.user_id, df.ym]
-    return (
-        df.rename(columns={"region_name": "region"})
-        .groupby(group_cols)[["region", "is_urban"]]
-        .first()
-        .assign(region_code=lambda df: df.region.factorize()[0])
-    )
+    return pd.DataFrame(
+        {"region": g.first(df.region_name), "is_urban": g.first(df.is_urban)}
+    ).assign(region_code=lambda df: df.region.factorize()[0])
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def has_savings_account(df):
+@aggregator(requires=["flags"])
+def has_savings_account(df, g, flags):
     """Indicator for whether user has at least one savings account added.
 
     We can only observe an account as added when we observe a transaction. So
     the indicator is one when we observe at least one sa txn for the user.
     """
-    group_cols = [df.user_id, df.ym]
     return (
-        df.account_type.eq("savings")
-        .groupby(group_cols)
-        .max()
+        g.max(fl.mask(flags, "savings_account"))
         .groupby("user_id")
         .transform("max")
         .rename("has_savings_account")
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def has_current_account(df):
+@aggregator(requires=["flags"])
+def has_current_account(df, g, flags):
     """Indicator for whether user has at least one current account added.
 
     We can only observe an account as added when we observe a transaction. So
     the indicator is one when we observe at least one current account txn for
     the user.
     """
-    group_cols = [df.user_id, df.ym]
     return (
-        df.account_type.eq("current")
-        .groupby(group_cols)
-        .max()
+        g.max(fl.mask(flags, "current_account"))
         .groupby("user_id")
         .transform("max")
         .rename("has_current_account")
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def generation(df):
+@aggregator(inputs=["birth_year"])
+def generation(df, g):
     """Generation of user.
 
     Source: https://www.beresfordresearch.com/age-range-by-generation/
@@ -250,12 +329,10 @@ def generation(df):
             gen = "Gen Z"
         return gen
 
-    group_cols = [df.user_id, df.ym]
     gens = ["Post War", "Boomers", "Gen X", "Millennials", "Gen Z"]
     gen_cats = pd.CategoricalDtype(gens, ordered=True)
     return (
-        df.groupby(group_cols)
-        .birth_year.first()
+        g.first(df.birth_year)
         .map(gen)
         .astype(gen_cats)
         .rename("generation")
@@ -264,211 +341,121 @@ def generation(df):
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def proportion_credit(df):
+@aggregator(inputs=["amount"], requires=["flags", "is_spend"])
+def proportion_credit(df, g, flags, is_spend):
     """Proportion of month spend paid by credit card."""
-    group_cols = [df.user_id, df.ym]
-    is_spend = df.tag_group.eq("spend") & df.is_debit
-    spend = df.amount.where(is_spend, np.nan).groupby(group_cols).sum()
-    is_cc_spend = is_spend & df.account_type.eq("credit card")
-    cc_spend = df.amount.where(is_cc_spend, np.nan).groupby(group_cols).sum()
+    spend = g.sum(df.amount.where(is_spend, np.nan))
+    is_cc_spend = is_spend & fl.mask(flags, "credit_card_account")
+    cc_spend = g.sum(df.amount.where(is_cc_spend, np.nan))
     return cc_spend.div(spend).rename("prop_credit")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def num_accounts(df):
+@aggregator(inputs=["account_id"])
+def num_accounts(df, g):
     """Number of active accounts."""
-    group_cols = [df.user_id, df.ym]
-    total = (
-        df.groupby("user_id")
-        .account_id.nunique()
-        .rename("accounts_total")
-        .reset_index()
-    )
-    return (
-        df.groupby(group_cols)
-        .account_id.nunique()
-        .rename("accounts_active")
-        .reset_index()
-        .merge(total)
-        .set_index(["user_id", "ym"])
+    return pd.DataFrame(
+        {
+            "accounts_active": g.nunique(df.account_id),
+            "accounts_total": g.nunique(df.account_id, level="user_id"),
+        }
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def investments(df):
+@aggregator(inputs=["amount"], requires=["flags"])
+def investments(df, g, flags):
     """Flows into investment and pension funds."""
-    group_cols = [df.user_id, df.ym]
-    is_invest = df.tag_auto.eq("pension or investments") & df.is_debit
+    is_invest = fl.mask(flags, "investment", "debit")
     invest = df.amount.where(is_invest, 0)
-    return invest.groupby(group_cols).sum().rename('investments')
+    return g.sum(invest, "investments")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def user_precedence_tag_based_savings(df):
+@aggregator(inputs=["amount"], requires=["flags"])
+def user_precedence_tag_based_savings(df, g, flags):
     """
     Transfers from current accounts to (linked and unlinked)
     savings accounts based on manual user tags.
     """
-    group_vars = [df.user_id, df.ym]
-    is_tfr = (
-        df.tag_up.str.contains("saving") & df.account_type.eq("current") & df.is_debit
-    )
+    is_tfr = fl.mask(flags, "saving_tag", "current_account", "debit")
     tfr = df.amount.where(is_tfr, 0)
-    return tfr.groupby(group_vars).sum().rename('up_savings')
+    return g.sum(tfr, "up_savings")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def current_account_transfers(df):
+@aggregator(inputs=["amount"], requires=["flags"])
+def current_account_transfers(df, g, flags):
     """
     Transfers from current accounts.
     """
-    group_vars = [df.user_id, df.ym]
-    is_tfr = (
-        df.tag_group.eq("transfers") & df.account_type.eq("current") & df.is_debit
-    )
+    is_tfr = fl.mask(flags, "transfers", "current_account", "debit")
     tfr = df.amount.where(is_tfr, 0)
-    return tfr.groupby(group_vars).sum().rename('ca_transfers')
+    return g.sum(tfr, "ca_transfers")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def credit_card_payments(df):
+@aggregator(inputs=["amount"], requires=["flags"])
+def credit_card_payments(df, g, flags):
     """
     Payments into credit card accounts.
     """
-    group_vars = [df.user_id, df.ym]
-    is_cc_inflow = (
-        df.account_type.eq("credit card")
-        & ~df.is_debit
-        & df.tag_auto.eq("credit card") # discards refunds
+    is_cc_inflow = fl.mask(
+        flags,
+        "credit_card_account",
+        "credit_card_payment",  # discards refunds
+        unset=["debit"],
     )
     cc_inflow = df.amount.where(is_cc_inflow, 0).mul(-1)
-    return cc_inflow.groupby(group_vars).sum().rename('cc_payments')
+    return g.sum(cc_inflow, "cc_payments")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def loan_funds(df):
+@aggregator(inputs=["amount"], requires=["flags"])
+def loan_funds(df, g, flags):
     """Loan funds inflow."""
-    LOAN_FUND_TAGS = [
-        "personal loan",
-        "unsecured loan funds",
-        "payday loan",
-        "payday loan funds",
-        "student loan funds",
-    ]
-    group_vars = [df.user_id, df.ym]
-    is_loan_fund = df.tag_auto.isin(LOAN_FUND_TAGS) & ~df.is_debit
+    is_loan_fund = fl.mask(flags, "loan_funds", unset=["debit"])
     loan_fund = df.amount.where(is_loan_fund, 0).mul(-1)
-    return loan_fund.groupby(group_vars).sum().rename("loan_funds")
+    return g.sum(loan_fund, "loan_funds")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def loan_repayments(df):
+@aggregator(inputs=["amount"], requires=["flags"])
+def loan_repayments(df, g, flags):
     """Loan repayments."""
-    LOAN_RPMT_TAGS = [
-        "secured loan repayment",
-        "unsecured loan repayment",
-        "student loan repayment",
-        "payday loan",
-        "personal loan",
-    ]
-    group_vars = [df.user_id, df.ym]
-    is_loan_rpmt = df.tag_auto.isin(LOAN_RPMT_TAGS) & df.is_debit
+    is_loan_rpmt = fl.mask(flags, "loan_repayment", "debit")
     loan_rpmts = df.amount.where(is_loan_rpmt, 0)
-    return loan_rpmts.groupby(group_vars).sum().rename("loan_rpmts")
-
-
-DSPEND_GROUPS = {
-    "other": [
-        "beauty products",
-        "beauty treatments",
-        "appearance",
-        "accessories",
-        "jewellery",
-        "personal electronics",
-        "hotel/b&b",
-        "gambling",
-        "games and gaming",
-        "enjoyment",
-    ],
-    "clothes": [
-        "clothes",
-        "clothes - designer or other",
-        "clothes - everyday or work",
-        "clothes - other",
-        "designer clothes",
-        "shoes",
-    ],
-    "groceries": [
-        "food, groceries, household",
-        "groceries",
-        "supermarket",
-    ],
-    "entertainment": [
-        "cinema",
-        "concert & theatre",
-        "entertainment, tv, media",
-        "sports event",
-    ],
-    "food": [
-        "dining and drinking",
-        "dining or going out",
-        "lunch or snacks",
-        "take-away",
-    ],
-}
+    return g.sum(loan_rpmts, "loan_rpmts")
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def dspend(df):
+@intermediate(requires=["flags"])
+def is_dspend(df, g, flags):
+    """Dummy for whether txn is a discretionary spend."""
+    return fl.mask(flags, "dspend", "debit")
+
+
+@aggregator(inputs=["amount"], requires=["is_dspend"])
+def dspend(df, g, is_dspend):
     """Discretionary spend."""
-    group_cols = [df.user_id, df.ym]
-    dspend_tags = [tag for group, tags in DSPEND_GROUPS.items() for tag in tags]
-    is_dspend = df.tag_auto.isin(dspend_tags) & df.is_debit
     dspend = df.amount.where(is_dspend, np.nan)
-    return (
-        dspend
-        .groupby(group_cols)
-        .agg([("dspend", "sum"), ("dspend_count", "count"), ("dspend_mean", "mean")])
+    return pd.DataFrame(
+        {
+            "dspend": g.sum(dspend),
+            "dspend_count": g.count(dspend),
+            "dspend_mean": g.mean(dspend),
+        }
     )
 
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def dspend_groups(df):
-    """Spends on discretionary spend groups."""
-    # Classify dspends
-    df["dspend"] = np.nan
-    for group, tags in DSPEND_GROUPS.items():
-        mask = df.tag_auto.isin(tags) & df.is_debit
-        df.loc[mask, "dspend"] = "_".join(["dspend", group])
-
-    group_cols = [df.user_id, df.ym, df.dspend]
-    is_dspend = df.dspend.notna()
-    dspend = df.amount.where(is_dspend, np.nan)
-    return dspend.groupby(group_cols).sum().unstack().fillna(0)
+@aggregator(inputs=["amount"], requires=["flags", "is_dspend"])
+def dspend_groups(df, g, flags, is_dspend):
+    """Spends on discretionary spend groups.
 
+    Months without any discretionary spend are missing for all groups.
+    """
+    spends = {}
+    for group in sorted(fl.DSPEND_GROUPS):
+        is_group = fl.mask(flags, f"dspend_{group}", "debit")
+        spends["_".join(["dspend", group])] = g.sum(df.amount.where(is_group, np.nan))
+    return pd.DataFrame(spends).where(g.max(is_dspend))
 
-@aggregator
-@hh.timer(on=TIMER_ON)
-def dspend_direct_debit(df):
+
+@aggregator(inputs=["amount"], requires=["flags", "is_dspend"])
+def dspend_direct_debit(df, g, flags, is_dspend):
     """Discretionary spend paid by debit direct."""
-    group_cols = [df.user_id, df.ym]
-    dd_pattern = "direct debit|dd$|d/d$|ddr$"
-    dspend_tags = [tag for group, tags in DSPEND_GROUPS.items() for tag in tags]
-    is_dd_dspend = (
-        df.desc.str.contains(dd_pattern) & df.tag_auto.isin(dspend_tags) & df.is_debit
-    )
+    is_dd_dspend = fl.mask(flags, "direct_debit") & is_dspend
     dd_dspend = df.amount.where(is_dd_dspend, np.nan)
-    return dd_dspend.groupby(group_cols).sum().rename("dspend_dd")
-
-
+    return g.sum(dd_dspend, "dspend_dd")
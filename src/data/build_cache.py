@@ -0,0 +1,58 @@
+"""
+Content-addressed cache for results of per-piece build stages.
+
+Results are stored under a key that hashes everything that produced them:
+the input piece or previous stage and the source of the modules that
+implement the stage. A result is reused only if none of these changed.
+
+"""
+
+import hashlib
+import inspect
+import json
+import os
+
+import pandas as pd
+
+from src import config
+
+
+def make_key(*parts):
+    """Returns hash of key parts."""
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(str(part).encode())
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def source_hash(*modules):
+    """Returns hash of the source code of modules."""
+    return make_key(*(inspect.getsource(module) for module in modules))
+
+
+def _path(stage, key, ext):
+    return os.path.join(config.BUILD_CACHE_DIR, stage, f"{key}.{ext}")
+
+
+def load(stage, key):
+    """Returns cached data and metadata of stage, or None if not cached."""
+    fp = _path(stage, key, "parquet")
+    if not os.path.exists(fp):
+        return None
+    with open(_path(stage, key, "json")) as f:
+        meta = json.load(f)
+    return pd.read_parquet(fp), meta
+
+
+def save(stage, key, df, meta=None):
+    """Stores data and metadata of stage in cache."""
+    os.makedirs(os.path.join(config.BUILD_CACHE_DIR, stage), exist_ok=True)
+    fp = _path(stage, key, "parquet")
+    tmp = f"{fp}.{os.getpid()}.tmp"
+    df.to_parquet(tmp, index=False)
+    with open(_path(stage, key, "json"), "w") as f:
+        json.dump(meta or {}, f, default=lambda x: x.item())
+    # Data file is moved into place last, so a complete file marks a
+    # complete entry
+    os.replace(tmp, fp)
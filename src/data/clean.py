@@ -6,96 +6,154 @@ research projects.
 """
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
 import functools
+import itertools
 import os
-import re
 import sys
-
-import time
+import warnings
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 
 import src.config as config
-import src.txn_classifications as tc
-import src.io as io
+import src.data.build_cache as bc
+import src.data.txn_classifications as tc
+import src.helpers.fingerprints as fingerprints
+import src.helpers.io as io
+import src.helpers.metrics as metrics
+import src.helpers.strings as strings
 
 
 cleaner_funcs = []
 
+# Copies of the data clean_data may make, which is the copy that applies
+# selected and sorted rows
+MAX_COPIES = 1
+
+# Columns clean pieces are sorted by, which is recorded in their metadata
+SORT_ORDER = ["user_id", "date"]
+
+# Number of duplicate txns dropped per user
+duplicate_counts = collections.Counter()
+
+
+def cleaner(func=None, reads=(), writes=(), rows=False):
+    """Adds function to list of cleaner functions.
+
+    Cleaners change the data in place and return it, without copying
+    columns they don't write. Cleaners that select or sort rows instead
+    return the positions of the rows to keep, in order (see `clean_data`).
 
-def cleaner(func):
-    """Adds function to list of cleaner functions."""
-    cleaner_funcs.append(func)
-    return func
+    Args:
+      reads: columns func reads.
+      writes: columns func adds, replaces or removes.
+      rows: whether func selects or sorts rows. Such cleaners take the data
+        and the positions of the rows selected by earlier cleaners, or None
+        for all rows, and return new positions, or None for all rows.
+    """
+
+    def decorate(func):
+        func = metrics.instrument("clean", verbose=True)(func)
+        func.reads = list(reads)
+        func.writes = list(writes)
+        func.rows = rows
+        cleaner_funcs.append(func)
+        return func
 
+    return decorate(func) if func else decorate
 
-def timer(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        diff = end - start
-        unit = "seconds"
-        if diff > 60:
-            diff = diff / 60
-            unit = "minutes"
-        print(f"Time for {func.__name__:30}: {diff:.2f} {unit}")
-        return result
 
-    return wrapper
+def _select(rows, keep):
+    """Returns positions of rows for which keep is True.
+
+    Args:
+      rows: positions of selected rows, or None for all rows.
+      keep: boolean array with an element for each row of the data.
+    """
+    if rows is None:
+        return None if keep.all() else np.flatnonzero(keep)
+    return rows[keep[rows]]
+
+
+def split_columns(df):
+    """Returns df with each column in a block of its own, without copying.
+
+    Pandas stores columns of the same type in a single array and copies
+    the other columns of that array when one of them is replaced, which
+    this avoids.
+    """
+    return pd.DataFrame({col: df[col] for col in df.columns}, copy=False)
+
+
+def _addresses(df, exclude=()):
+    """Returns memory addresses of the data of columns not in exclude."""
+    addresses = set()
+    for col in df.columns.difference(exclude):
+        values = df[col].array
+        if isinstance(values, pd.Categorical):
+            values = values.codes
+        elif hasattr(values, "asi8"):
+            # Dates, periods and durations
+            values = values.asi8
+        elif isinstance(df[col].dtype, np.dtype):
+            # Numpy backed columns return their array without copying it
+            values = df[col].to_numpy()
+        if isinstance(values, np.ndarray) and values.size:
+            addresses.add(values.__array_interface__["data"][0])
+    return addresses
 
 
 @cleaner
-@timer
 def remove_header_dots(df):
     """Restores original variable names."""
-    return df.rename(columns=lambda x: x.replace(".", " "))
+    df.columns = [col.replace(".", " ") for col in df.columns]
+    return df
 
 
-@cleaner
-@timer
+RAW_DTYPES = {
+    "Transaction Reference": "int32",
+    "User Reference": "int32",
+    "Year of Birth": "float32",
+    "Salary Range": "category",
+    "Postcode": "category",
+    "LSOA": "category",
+    "MSOA": "category",
+    "Derived Gender": "category",
+    "Account Reference": "int32",
+    "Provider Group Name": "category",
+    "Account Type": "category",
+    "Latest Recorded Balance": "float32",
+    "Transaction Description": "category",
+    "Credit Debit": "category",
+    "Amount": "float32",
+    "User Precedence Tag Name": "category",
+    "Manual Tag Name": "category",
+    "Auto Purpose Tag Name": "category",
+    "Merchant Name": "category",
+    "Merchant Business Line": "category",
+    "Transaction Updated Flag": "category",
+    "User Registration Date": "datetime64",
+    "Transaction Date": "datetime64",
+    "Account Created Date": "datetime64",
+    "Account Last Refreshed": "datetime64",
+    "Data Warehouse Date Last Updated": "datetime64",
+    "Data Warehouse Date Created": "datetime64",
+}
+
+
+@cleaner(reads=RAW_DTYPES, writes=RAW_DTYPES)
 def cast_dtypes(df):
     """Converts columns to storage-efficient types."""
-
-    dtypes = {
-        "Transaction Reference": "int32",
-        "User Reference": "int32",
-        "Year of Birth": "float32",
-        "Salary Range": "category",
-        "Postcode": "category",
-        "LSOA": "category",
-        "MSOA": "category",
-        "Derived Gender": "category",
-        "Account Reference": "int32",
-        "Provider Group Name": "category",
-        "Account Type": "category",
-        "Latest Recorded Balance": "float32",
-        "Transaction Description": "category",
-        "Credit Debit": "category",
-        "Amount": "float32",
-        "User Precedence Tag Name": "category",
-        "Manual Tag Name": "category",
-        "Auto Purpose Tag Name": "category",
-        "Merchant Name": "category",
-        "Merchant Business Line": "category",
-        "Transaction Updated Flag": "category",
-        "User Registration Date": "datetime64",
-        "Transaction Date": "datetime64",
-        "Account Created Date": "datetime64",
-        "Account Last Refreshed": "datetime64",
-        "Data Warehouse Date Last Updated": "datetime64",
-        "Data Warehouse Date Created": "datetime64",
-    }
-
-    for var, dtype in dtypes.items():
+    for var, dtype in RAW_DTYPES.items():
         df[var] = df[var].astype(dtype)
     return df
 
 
 @cleaner
-@timer
 def rename_cols(df):
     """Renames excessively long columns for more convenient typing."""
     new_names = {
@@ -117,11 +175,11 @@ def rename_cols(df):
         "User Precedence Tag Name": "tag_up",
         "Latest Recorded Balance": "latest_balance",
     }
-    return df.rename(columns=new_names)
+    df.rename(columns=new_names, inplace=True)
+    return df
 
 
 @cleaner
-@timer
 def clean_headers(df):
     """Converts column headers to snake case."""
     df.columns = (
@@ -130,27 +188,44 @@ def clean_headers(df):
     return df
 
 
-@cleaner
-@timer
+# Categorical columns after cast_dtypes and renaming
+CATEGORIES = [
+    "salary_range",
+    "postcode",
+    "lsoa",
+    "msoa",
+    "gender",
+    "account_provider",
+    "account_type",
+    "desc",
+    "credit_debit",
+    "tag_up",
+    "tag_manual",
+    "tag_auto",
+    "merchant",
+    "merchant_business_line",
+    "updated_flag",
+]
+
+
+@cleaner(reads=CATEGORIES, writes=CATEGORIES)
 def lowercase_categories(df):
     """Converts all category values to lowercase to simplify regex searches.
 
-    Recasts categories because casting to lowercase can lead to duplicate
+    Merges categories because casting to lowercase can lead to duplicate
     categories.
     """
-    cat_vars = df.select_dtypes("category").columns
-    df[cat_vars] = df[cat_vars].apply(lambda x: x.str.lower()).astype("category")
+    for col in df.select_dtypes("category").columns:
+        df[col] = strings.lower(df[col])
     return df
 
 
-@cleaner
-@timer
-def drop_missing_txn_desc(df):
-    return df[df.desc.notna()]
+@cleaner(reads=["desc"], rows=True)
+def drop_missing_txn_desc(df, rows):
+    return _select(rows, df.desc.notna().to_numpy())
 
 
-@cleaner
-@timer
+@cleaner(reads=["gender"], writes=["gender", "is_female"])
 def gender_to_female(df):
     """Replaces gender variable with female dummy.
 
@@ -158,39 +233,48 @@ def gender_to_female(df):
     """
     mapping = {"f": 1, "m": 0, "u": np.nan}
     df["is_female"] = df.gender.map(mapping).astype("float32")
-    return df.drop(columns="gender")
+    del df["gender"]
+    return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["credit_debit"], writes=["credit_debit", "is_debit"])
 def credit_debit_to_debit(df):
     """Replaces credit_debit variable with credit dummy."""
     df["is_debit"] = df.credit_debit.eq("debit")
-    return df.drop(columns="credit_debit")
+    del df["credit_debit"]
+    return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["amount", "is_debit"], writes=["amount"])
 def sign_amount(df):
     """Makes credits negative."""
     df["amount"] = df.amount.where(df.is_debit, df.amount.mul(-1))
     return df
 
 
-@cleaner
-@timer
+@cleaner(
+    reads=["merchant", "merchant_business_line", "tag_auto"],
+    writes=["merchant", "merchant_business_line", "tag_auto"],
+)
 def missing_tags_to_nan(df):
-    """Converts missing category values to NaN."""
-    df["merchant"] = df["merchant"].cat.remove_categories(["no merchant"])
-    df["merchant_business_line"] = df["merchant_business_line"].cat.remove_categories(
-        ["no merchant business line", "unknown merchant"]
+    """Converts missing category values to NaN.
+
+    Only removes categories that occur, so that batches without missing
+    values can be cleaned.
+    """
+
+    def remove(series, categories):
+        return series.cat.remove_categories(series.cat.categories.intersection(categories))
+
+    df["merchant"] = remove(df["merchant"], ["no merchant"])
+    df["merchant_business_line"] = remove(
+        df["merchant_business_line"], ["no merchant business line", "unknown merchant"]
     )
-    df["tag_auto"] = df["tag_auto"].cat.remove_categories(["no tag"])
+    df["tag_auto"] = remove(df["tag_auto"], ["no tag"])
     return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["latest_balance"], writes=["latest_balance"])
 def zero_balances_to_missing(df):
     """Replaces zero latest balances with missings.
 
@@ -202,39 +286,82 @@ def zero_balances_to_missing(df):
     return df
 
 
-def _apply_grouping(df, col_name, grouping):
-    """Applies grouping to col_name in dataframe in-place.
+TagLookup = collections.namedtuple("TagLookup", ["groups", "mapping", "conflicts"])
+
+
+def _compile_grouping(*groupings, accepted=()):
+    """Compiles groupings into a tag lookup.
 
     Args:
-      grouping: a dict with name-tags pairs, where name
-        is the group name that will be applied to each txn
-        for which tag_auto equals one of the tags.
-      col_name: a column from df into which the group
-        names will be stored.
+      groupings: dicts with name-tags pairs, where name is the group name
+        that will be applied to each txn for which tag_auto equals one of
+        the tags. Where a tag appears in more than one group, the last
+        group wins, and the tag is recorded in the lookup's conflicts
+        together with all groups it appears in.
+      accepted: tags known to appear in more than one group. Conflicts of
+        other tags raise a warning, so that new conflicts don't silently
+        change how txns are classified.
     """
-    for group, tags in grouping.items():
-        escaped_tags = [re.escape(tag) for tag in tags]
-        pattern = "|".join(escaped_tags)
-        mask = df.tag_auto.str.fullmatch(pattern, na=False)
-        df.loc[mask, col_name] = group
+    mapping = {}
+    appearances = collections.defaultdict(list)
+    for grouping in groupings:
+        for group, tags in grouping.items():
+            for tag in tags:
+                mapping[tag] = group
+                appearances[tag].append(group)
+    groups = sorted(set(mapping.values()))
+    conflicts = {tag: gs for tag, gs in appearances.items() if len(gs) > 1}
+    unexpected = [
+        f"{tag} ({', '.join(gs)})" for tag, gs in conflicts.items() if tag not in accepted
+    ]
+    if unexpected:
+        warnings.warn(
+            "Tags in more than one group, which are assigned to the last: "
+            + "; ".join(unexpected),
+            stacklevel=2,
+        )
+    return TagLookup(groups, mapping, conflicts)
+
+
+TAG_LOOKUP = _compile_grouping(
+    tc.spend_subgroups,
+    tc.income_subgroups,
+    tc.transfers_subgroups,
+    # Income rather than finance spend
+    accepted=["payday loan funds", "rewards/cashback"],
+)
+TAG_GROUP_LOOKUP = _compile_grouping(tc.tag_groups)
+TAG_SPEND_LOOKUP = _compile_grouping(tc.tag_spend)
+
 
+def _apply_grouping(df, col_name, lookup):
+    """Adds group of each txn's tag_auto as categorical col_name in-place.
+
+    Looks up the group of each tag_auto category once and broadcasts groups
+    to txns through the category codes. Txns with a missing or ungrouped
+    tag_auto are missing.
+    """
+    group_codes = {group: code for code, group in enumerate(lookup.groups)}
+    categories = df.tag_auto.cat.categories
+    cat_to_group = np.array(
+        [group_codes.get(lookup.mapping.get(tag), -1) for tag in categories] + [-1]
+    )
+    codes = cat_to_group[df.tag_auto.cat.codes.to_numpy()]
+    df[col_name] = pd.Categorical.from_codes(codes, categories=lookup.groups)
     return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["tag_auto"], writes=["tag"])
 def add_tag(df):
-    """Creates custom transaction tags for spends, income, and transfers."""
-    df["tag"] = np.nan
-    _apply_grouping(df, "tag", tc.spend_subgroups)
-    _apply_grouping(df, "tag", tc.income_subgroups)
-    _apply_grouping(df, "tag", tc.transfers_subgroups)
-    df["tag"] = df.tag.astype("category")
-    return df
+    """Creates custom transaction tags for spends, income, and transfers.
 
+    Income and transfer subgroups take precedence over spend subgroups for
+    tags listed in both (see `TAG_LOOKUP.conflicts`).
+    """
+    return _apply_grouping(df, "tag", TAG_LOOKUP)
 
-@cleaner
-@timer
+
+@cleaner(reads=["desc", "tag", "tag_auto", "is_debit"], writes=["tag"])
 def tag_corrections(df):
     """Fix issues with automatic tagging.
 
@@ -250,15 +377,15 @@ def tag_corrections(df):
     exclude_strings = ["fee", "interest", "rewards"]
     exclude_pattern = "|".join(exclude_strings)
     mask = (
-        df.desc.str.contains(tfr_pattern)
-        & df.desc.str.contains(exclude_pattern).eq(False)
+        strings.contains(df.desc, tfr_pattern)
+        & ~strings.contains(df.desc, exclude_pattern, na=True)
         & df.tag.isna()
     )
     df.loc[mask, "tag"] = "other_transfers"
 
     # tag untagged txns as other_spend if desc contains "bbp",
     # which is short for bill payment
-    mask = df.desc.str.contains("bbp") & df.tag.isna()
+    mask = strings.contains(df.desc, "bbp") & df.tag.isna()
     df.loc[mask, "tag"] = "other_spend"
 
     # reclassify 'interest income' as finance spend if txn is a debit
@@ -269,33 +396,28 @@ def tag_corrections(df):
     return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["tag_auto"], writes=["tag_group"])
 def add_tag_group(df):
     """Groups transactions into income, spend, and transfers."""
-    df["tag_group"] = np.nan
-    _apply_grouping(df, "tag_group", tc.tag_groups)
-    df["tag_group"] = df.tag_group.astype("category")
-    return df
+    return _apply_grouping(df, "tag_group", TAG_GROUP_LOOKUP)
 
 
-@cleaner
-@timer
+@cleaner(reads=["tag_auto"], writes=["tag_spend"])
 def add_tag_spend(df):
     """Create separate variable for corrected auto tag spend categories.
 
     Auto tag variable has duplicated categories such as 'bank charges' and
     'banking charges'.
     """
-    df["tag_spend"] = np.nan
-    _apply_grouping(df, "tag_spend", tc.tag_spend)
-    df["tag_spend"] = df.tag_spend.astype("category")
-    return df
+    return _apply_grouping(df, "tag_spend", TAG_SPEND_LOOKUP)
 
 
-@cleaner
-@timer
-def drop_duplicates(df):
+# Columns that are identical for duplicate txns
+DUPLICATE_KEYS = ["user_id", "account_id", "date", "amount", "desc"]
+
+
+@cleaner(reads=DUPLICATE_KEYS, rows=True)
+def drop_duplicates(df, rows):
     """Drops duplicate transactions.
 
     Retains only the first of all txns for which user_id, account_id,
@@ -303,44 +425,83 @@ def drop_duplicates(df):
 
     While this might drop some genuine duplicates (e.g. buying the same
     coffee at the same place on the same day), data inspection suggests
-    that most dropped txns are unlikely to be genuine.
+    that most dropped txns are unlikely to be genuine. The number of txns
+    dropped for each user is added to `duplicate_counts`.
     """
-    df = df.copy()
-    cols = ["user_id", "account_id", "date", "amount", "desc"]
-    return df.drop_duplicates(subset=cols)
-
-
-@cleaner
-@timer
+    is_duplicate = fingerprints.duplicated(df, DUPLICATE_KEYS, rows)
+    if not is_duplicate.any():
+        return rows
+    users = df.user_id.to_numpy()
+    if rows is not None:
+        users = users[rows]
+    dropped = pd.Series(users[is_duplicate]).value_counts(sort=False)
+    duplicate_counts.update(dict(zip(dropped.index.tolist(), dropped.tolist())))
+    if rows is None:
+        return np.flatnonzero(~is_duplicate)
+    return rows[~is_duplicate]
+
+
+@functools.lru_cache(maxsize=None)
+def _read_regions():
+    """Returns NSPL lookup table indexed by postcode sector.
+
+    The table is read once per process, from a parquet copy in the build
+    cache that is created the first time a version of the lookup is used.
+    """
+    key = bc.make_key(io.fingerprint(config.NSPL_LOOKUP))
+    cached = bc.load("regions", key)
+    if cached is not None:
+        regions = cached[0]
+    else:
+        columns = ["pcsector", "region_name", "is_urban"]
+        regions = io.read_csv(config.NSPL_LOOKUP, usecols=columns)
+        regions = regions.rename(columns={"pcsector": "postcode"})
+        bc.save("regions", key, regions)
+    regions = regions.set_index("postcode")
+    if not regions.index.is_unique:
+        raise ValueError("NSPL lookup table has duplicate postcode sectors.")
+    # Parquet reads missing strings as None
+    return regions.fillna(np.nan)
+
+
+@cleaner(reads=["postcode"], writes=["region_name", "is_urban"])
 def add_region(df):
-    """Adds region name."""
-    columns = ["pcsector", "region_name", "is_urban"]
-    fp = "s3://3di-data-ons/nspl/NSPL_AUG_2020_UK/clean/lookup.csv"
+    """Adds region name and urban dummy of postcode sector.
+
+    Each postcode is looked up once and the result gathered through the
+    postcode codes, which adds the columns without copying the data.
+    """
     try:
-        regions = io.read_csv(fp, usecols=columns).rename(
-            columns={"pcsector": "postcode"}
-        )
+        regions = _read_regions()
     except FileNotFoundError:
         print("NSPL lookup table not found.")
-
-    return df.merge(regions, how="left", on="postcode", validate="m:1")
+        raise
+    if isinstance(df.postcode.dtype, pd.CategoricalDtype):
+        codes, postcodes = df.postcode.cat.codes.to_numpy(), df.postcode.cat.categories
+    else:
+        codes, postcodes = pd.factorize(df.postcode)
+    # Row of each postcode in regions, with a last element for missing
+    # postcodes, and -1 for postcodes not in regions
+    rows = np.append(regions.index.get_indexer(postcodes), -1)[codes]
+    is_found = rows >= 0
+    for column in regions.columns:
+        df[column] = regions[column].take(rows).where(is_found).to_numpy()
+    return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["account_type", "amount", "tag_auto", "desc"], writes=["is_sa_flow"])
 def is_sa_flow(df):
     """Dummy for whether txn is in- or outflow of savings account."""
     df["is_sa_flow"] = (
         df.account_type.eq("savings")
         & df.amount.abs().ge(5)
-        & ~df.tag_auto.str.contains("interest", na=False)
-        & ~df.desc.str.contains(r"save\s?the\s?change", na=False)
+        & ~strings.contains(df.tag_auto, "interest")
+        & ~strings.contains(df.desc, r"save\s?the\s?change")
     )
     return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["tag", "is_debit"], writes=["is_salary_pmt"])
 def is_salary_pmt(df):
     """Dummy for whether txn is salary payment.
 
@@ -351,37 +512,105 @@ def is_salary_pmt(df):
     return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["tag_group", "is_debit"], writes=["is_income_pmt"])
 def is_income_pmt(df):
     """Dummy for whether txn is income payment."""
     df["is_income_pmt"] = df.tag_group.eq('income') & ~df.is_debit
     return df
 
 
-@cleaner
-@timer
+@cleaner(reads=["date"], writes=["ym"])
 def year_month_indicator(df):
     df["ym"] = df.date.dt.to_period("m")
     return df
 
 
+def _sort_ranks(series):
+    """Returns integers in the order of the values of series, with missing
+    values last, and the number of distinct integers."""
+    values = series.to_numpy()
+    if values.dtype.kind in "iu" and len(values):
+        ranks = values.astype("int64") - values.min()
+        return ranks, int(ranks.max()) + 1
+    ranks, uniques = pd.factorize(values, sort=True)
+    ranks = ranks.astype("int64")
+    ranks[ranks == -1] = len(uniques)
+    return ranks, len(uniques) + 1
+
+
+def sorted_positions(df, by, rows=None):
+    """Returns positions that stably sort rows of df by columns in by, or
+    None if rows are already sorted.
+
+    If rows, positions of a selection of rows of df, is given, only these
+    rows are sorted, and returned positions are positions in rows.
+
+    Columns are packed into a single integer key, so that checking the
+    order is a single pass and sorting is a stable sort of integers, which
+    is fast on partly sorted data. Only the part of df between the first
+    and last row that is out of order, extended to the rows that need to
+    move past it, is sorted.
+    """
+    ranks = [_sort_ranks(df[col]) for col in by]
+    if rows is not None:
+        ranks = [(col_ranks[rows], n) for col_ranks, n in ranks]
+    if np.prod([float(n) for _, n in ranks]) >= 2**63:
+        return np.lexsort([col_ranks for col_ranks, _ in reversed(ranks)])
+    key = np.zeros(len(ranks[0][0]), dtype="int64")
+    for col_ranks, n in ranks:
+        key = key * n + col_ranks
+    descents = np.flatnonzero(key[1:] < key[:-1])
+    if not len(descents):
+        return None
+    start, end = descents[0], descents[-1] + 2
+    # Rows before start with keys up to the smallest key of the unsorted
+    # part, and rows after end with keys from its largest key, stay in place
+    unsorted = key[start:end]
+    start = np.searchsorted(key[:start], unsorted.min(), side="right")
+    end += np.searchsorted(key[end:], unsorted.max(), side="left")
+    positions = np.arange(len(key))
+    positions[start:end] = start + np.argsort(key[start:end], kind="stable")
+    return positions
+
+
 @cleaner
-@timer
-def order_and_sort(df):
-    """Orders columns and sort values."""
+def order_columns(df):
+    """Orders columns, without copying the data."""
     cols = df.columns
     first = ["date", "user_id", "amount", "desc", "merchant", "tag_group", "tag_spend"]
     user = cols[cols.str.startswith("user") & ~cols.isin(first)]
     account = cols[cols.str.startswith("account") & ~cols.isin(first)]
     txn = cols[~cols.isin(user.append(account)) & ~cols.isin(first)]
     order = first + sorted(user) + sorted(account) + sorted(txn)
-    return df[order].sort_values(["user_id", "date"])
+    return pd.DataFrame({col: df[col] for col in order}, copy=False)
+
+
+@cleaner(reads=SORT_ORDER, rows=True)
+def sort_txns(df, rows):
+    """Sorts txns by SORT_ORDER."""
+    positions = sorted_positions(df, SORT_ORDER, rows)
+    if positions is None:
+        return rows
+    return positions if rows is None else rows[positions]
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
-    parser.add_argument("filepath")
+    parser.add_argument("filepaths", nargs="+", metavar="filepath")
+    parser.add_argument(
+        "-b",
+        "--batch-rows",
+        type=int,
+        help="Clean piece in batches of about this many rows",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to clean pieces in parallel",
+    )
+    metrics.add_arguments(parser, example="clean.add_region")
     return parser.parse_args(args)
 
 
@@ -394,15 +623,149 @@ def clean_path(path):
     return path.replace('/raw/', '/clean/')
 
 
-@timer
+def clean_data(df, funcs=None):
+    """Runs cleaners on raw data and returns clean data.
+
+    Cleaners that select or sort rows only return positions, which are
+    combined and applied in a single copy of the data once all cleaners
+    have run, so other cleaners also clean rows that are dropped later.
+    Cleaners that copy columns they don't write are counted as copies too,
+    in the `copies` of the clean_data record.
+
+    Raises:
+      KeyError: if a cleaner reads columns that are missing.
+      RuntimeError: if the data is copied more than `MAX_COPIES` times.
+    """
+    with metrics.stage("clean", "clean_data", df) as record:
+        df = split_columns(df)
+        rows = None
+        copied_by = []
+        for func in funcs or cleaner_funcs:
+            missing = set(func.reads) - set(df.columns)
+            if missing:
+                raise KeyError(f"{func.__name__} requires missing columns {missing}.")
+            if func.rows:
+                rows = func(df, rows)
+                continue
+            kept = _addresses(df, exclude=func.writes)
+            df = func(df)
+            if not kept <= _addresses(df):
+                copied_by.append(func.__name__)
+        if rows is not None:
+            df = df.take(rows)
+            copied_by.append("take")
+        df.index = pd.RangeIndex(len(df))
+        record["copies"] = len(copied_by)
+        record["copied_by"] = copied_by
+        record["rows_out"] = len(df)
+        if len(copied_by) > MAX_COPIES:
+            raise RuntimeError(
+                f"Data was copied {len(copied_by)} times, by {', '.join(copied_by)}, "
+                f"but at most {MAX_COPIES} copy is allowed."
+            )
+    return df
+
+
+def iter_user_batches(batches, user_col="User.Reference"):
+    """Regroups record batches into frames that end on user boundaries.
+
+    Rows of the last user in a batch are carried over to the next frame,
+    so each user's txns are cleaned together. Requires the raw piece to be
+    grouped by user.
+    """
+    seen = set()
+    carry = None
+    for batch in batches:
+        if not batch.num_rows:
+            continue
+        df = batch.to_pandas()
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+        is_last_user = df[user_col].eq(df[user_col].iloc[-1])
+        carry = df[is_last_user]
+        done = df[~is_last_user]
+        users = set(done[user_col].unique())
+        if not seen.isdisjoint(users):
+            raise ValueError("Raw piece is not grouped by user, can't stream.")
+        seen.update(users)
+        if len(done):
+            yield done
+    if carry is not None:
+        if carry[user_col].iloc[0] in seen:
+            raise ValueError("Raw piece is not grouped by user, can't stream.")
+        yield carry
+
+
+def clean_streaming(filepath, fp_clean, batch_rows):
+    """Cleans raw piece batch by batch and appends each batch to clean piece.
+
+    Peak memory depends on batch size rather than piece size. Users in the
+    clean piece are sorted within but not across batches.
+    """
+    frames = iter_user_batches(io.iter_parquet_batches(filepath, batch_rows))
+    first = next(frames, None)
+    if first is None:
+        # Empty pieces are written as a clean piece without rows
+        first = io.read_schema(filepath).empty_table().to_pandas()
+    with contextlib.ExitStack() as stack:
+        writer = None
+        for df_raw in itertools.chain([first], frames):
+            table = pa.Table.from_pandas(clean_data(df_raw), preserve_index=False)
+            if writer is None:
+                # Batches are sorted, but not the piece
+                sorting = {"sort_order": SORT_ORDER, "sorted_within": "row_group"}
+                schema = io.add_metadata(io.append_schema(table), sorting)
+                writer = stack.enter_context(io.parquet_writer(fp_clean, schema))
+            writer.write_table(table.cast(schema))
+    print(f"{fp_clean} written.")
+
+
+def clean_piece(filepath, batch_rows=None):
+    """Cleans raw piece and writes it to its clean path.
+
+    Returns the number of duplicate txns dropped per user, which are
+    counted per piece because `duplicate_counts` is not shared between
+    worker processes.
+    """
+    fp_clean = clean_path(filepath)
+    duplicate_counts.clear()
+    with metrics.tagged(piece=os.path.basename(filepath)):
+        if batch_rows:
+            clean_streaming(filepath, fp_clean, batch_rows)
+        else:
+            df_raw = io.read_parquet(filepath)
+            sorting = {"sort_order": SORT_ORDER, "sorted_within": "piece"}
+            io.write_parquet(clean_data(df_raw), fp_clean, metadata=sorting)
+    return duplicate_counts.copy()
+
+
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
     args = parse_args(argv)
-    df_raw = io.read_parquet(args.filepath)
-    df_clean = functools.reduce(lambda df, f: f(df), cleaner_funcs, df_raw)
-    fp_clean = clean_path(args.filepath)
-    io.write_parquet(df_clean, fp_clean)
+    func = functools.partial(clean_piece, batch_rows=args.batch_rows)
+    duplicates = collections.Counter()
+    # Filled in as pieces finish, so failed runs report them too
+    info = {"duplicates_dropped": {}}
+
+    def add_counts(counts):
+        duplicates.update(counts)
+        info["duplicates_dropped"] = dict(sorted(duplicates.items()))
+
+    def clean_pieces():
+        if args.workers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+            with pool as executor:
+                # Records of worker processes are returned with their results
+                collect = functools.partial(metrics.collect, func)
+                for counts, records in executor.map(collect, args.filepaths):
+                    add_counts(counts)
+                    metrics.records.extend(records)
+        else:
+            for filepath in args.filepaths:
+                add_counts(func(filepath))
+
+    metrics.run_instrumented("clean", args, clean_pieces, info)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+Bit flags that classify transactions for aggregators.
+
+Each flag is registered once, with the piece column it is derived from and
+the values of that column it marks. `compute()` packs all flags of a piece
+into a single integer per txn, evaluating each flag on the distinct values
+of its column rather than on every txn, and aggregators test bits with
+`mask()` instead of comparing strings.
+
+"""
+
+import collections
+
+import numpy as np
+import pandas as pd
+
+
+registry = {}
+
+Flag = collections.namedtuple("Flag", ["bit", "column", "test"])
+
+MAX_FLAGS = 32
+
+
+def flag(name, column, values=None, test=None):
+    """Registers flag of txns whose column value is in values.
+
+    Args:
+      name: name of flag.
+      column: piece column the flag is derived from.
+      values: values of column that set the flag.
+      test: function that takes an index of distinct values of column and
+        returns a boolean mask of values that set the flag, used instead of
+        values.
+    """
+    if name in registry:
+        raise ValueError(f"Flag {name} is already registered.")
+    if len(registry) == MAX_FLAGS:
+        raise ValueError(f"Can't register more than {MAX_FLAGS} flags.")
+    if test is None:
+        values = list(values)
+        test = lambda uniques: uniques.isin(values)
+    registry[name] = Flag(len(registry), column, test)
+
+
+def input_columns():
+    """Returns piece columns flags are derived from."""
+    return sorted({f.column for f in registry.values()})
+
+
+def bits(names):
+    """Returns integer with bits of named flags set."""
+    return sum(1 << registry[name].bit for name in names)
+
+
+def compute(df):
+    """Returns flags of each txn in df as array of uint32.
+
+    Missing values set no flags.
+    """
+    flags = np.zeros(len(df), dtype="uint32")
+    by_column = collections.defaultdict(list)
+    for f in registry.values():
+        by_column[f.column].append(f)
+    for column, column_flags in by_column.items():
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            codes, uniques = pd.factorize(values)
+            uniques = pd.Index(uniques)
+        if len(uniques) == 0:
+            continue
+        # Flags of each distinct value, with a last element of zero that
+        # missing values, with code -1, pick up
+        value_flags = np.zeros(len(uniques) + 1, dtype="uint32")
+        for f in column_flags:
+            is_set = np.asarray(f.test(uniques), dtype=bool)
+            value_flags[:-1] |= is_set.astype("uint32") << f.bit
+        flags |= value_flags[codes]
+    return flags
+
+
+def mask(flags, *names, unset=()):
+    """Returns mask of txns with all named flags set and all flags in unset
+    not set."""
+    on = bits(names)
+    return (flags & (on | bits(unset))) == on
+
+
+flag("debit", "is_debit", [True])
+flag("sa_flow", "is_sa_flow", [True])
+
+flag("spend", "tag_group", ["spend"])
+flag("income", "tag_group", ["income"])
+flag("transfers", "tag_group", ["transfers"])
+
+flag("current_account", "account_type", ["current"])
+flag("savings_account", "account_type", ["savings"])
+flag("credit_card_account", "account_type", ["credit card"])
+
+flag("investment", "tag_auto", ["pension or investments"])
+flag("credit_card_payment", "tag_auto", ["credit card"])
+flag(
+    "loan_funds",
+    "tag_auto",
+    [
+        "personal loan",
+        "unsecured loan funds",
+        "payday loan",
+        "payday loan funds",
+        "student loan funds",
+    ],
+)
+flag(
+    "loan_repayment",
+    "tag_auto",
+    [
+        "secured loan repayment",
+        "unsecured loan repayment",
+        "student loan repayment",
+        "payday loan",
+        "personal loan",
+    ],
+)
+
+DSPEND_GROUPS = {
+    "other": [
+        "beauty products",
+        "beauty treatments",
+        "appearance",
+        "accessories",
+        "jewellery",
+        "personal electronics",
+        "hotel/b&b",
+        "gambling",
+        "games and gaming",
+        "enjoyment",
+    ],
+    "clothes": [
+        "clothes",
+        "clothes - designer or other",
+        "clothes - everyday or work",
+        "clothes - other",
+        "designer clothes",
+        "shoes",
+    ],
+    "groceries": [
+        "food, groceries, household",
+        "groceries",
+        "supermarket",
+    ],
+    "entertainment": [
+        "cinema",
+        "concert & theatre",
+        "entertainment, tv, media",
+        "sports event",
+    ],
+    "food": [
+        "dining and drinking",
+        "dining or going out",
+        "lunch or snacks",
+        "take-away",
+    ],
+}
+
+flag("dspend", "tag_auto", [tag for tags in DSPEND_GROUPS.values() for tag in tags])
+for group, tags in DSPEND_GROUPS.items():
+    flag(f"dspend_{group}", "tag_auto", tags)
+
+flag("saving_tag", "tag_up", test=lambda uniques: uniques.str.contains("saving", na=False))
+flag(
+    "direct_debit",
+    "desc",
+    test=lambda uniques: uniques.str.contains("direct debit|dd$|d/d$|ddr$", na=False),
+)
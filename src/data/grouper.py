@@ -0,0 +1,168 @@
+"""
+Shared user-month grouping for aggregators.
+
+Factorizes the (user_id, ym) keys of a piece once and implements the
+reductions used by the aggregators as vectorised operations on the shared
+group codes, so no aggregator has to re-hash the keys.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class Grouper:
+    """Group codes and reductions for one piece of transaction data.
+
+    Groups are sorted by keys in the same order a pandas groupby would
+    produce, and every reduction returns a series indexed by `index`, so
+    results can be combined without realignment. Like a pandas groupby,
+    rows with missing keys, such as txns with a missing date, belong to no
+    group and are ignored.
+    """
+
+    def __init__(self, df, keys=("user_id", "ym")):
+        self.keys = list(keys)
+        combined = np.zeros(len(df), dtype="int64")
+        missing = np.zeros(len(df), dtype=bool)
+        levels = []
+        for key in self.keys:
+            codes, uniques = pd.factorize(df[key], sort=True)
+            missing |= codes < 0
+            combined = combined * len(uniques) + codes
+            levels.append(uniques)
+        # Mask of rows in groups, or None if all rows are
+        self.keep = ~missing if missing.any() else None
+        if self.keep is not None:
+            combined = combined[self.keep]
+
+        self.codes, group_keys = pd.factorize(combined, sort=True)
+        self.ngroups = len(group_keys)
+
+        level_codes = []
+        for uniques in reversed(levels):
+            level_codes.insert(0, group_keys % len(uniques))
+            group_keys = group_keys // len(uniques)
+        self.level_codes = dict(zip(self.keys, level_codes))
+        self.index = pd.MultiIndex(
+            levels=levels, codes=level_codes, names=self.keys, verify_integrity=False
+        )
+
+        self.sizes = np.bincount(self.codes, minlength=self.ngroups)
+        self.starts = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+        if (np.diff(self.codes) >= 0).all():
+            # Clean pieces are sorted by user and date, so rows are
+            # usually already in group order and no reordering is needed.
+            self.order = None
+        else:
+            self.order = np.argsort(self.codes, kind="stable")
+
+    def series(self, values, name=None):
+        """Returns group-level values as series indexed by groups."""
+        return pd.Series(values, index=self.index, name=name)
+
+    def _kept(self, values):
+        return values if self.keep is None else values[self.keep]
+
+    def _sorted(self, values):
+        return values if self.order is None else values[self.order]
+
+    def _reduceat(self, func, arr):
+        # reduceat needs at least one start, which empty pieces don't have
+        if not self.ngroups:
+            return np.empty(0, arr.dtype)
+        return func.reduceat(arr, self.starts)
+
+    def level(self, key):
+        """Returns values of grouping key for each group."""
+        return self.index.get_level_values(key)
+
+    def size(self, name=None):
+        """Number of rows in each group."""
+        return self.series(self.sizes, name)
+
+    def count(self, values, name=None):
+        """Number of non-missing values in each group."""
+        notna = self._kept(np.asarray(pd.notna(values)))
+        counts = np.bincount(self.codes[notna], minlength=self.ngroups)
+        return self.series(counts, name)
+
+    def sum(self, values, name=None):
+        """Sum of values in each group, skipping missing values.
+
+        Float values keep their dtype, all others are summed as integers.
+        """
+        arr = self._kept(np.asarray(values))
+        dtype = arr.dtype if arr.dtype.kind == "f" else "int64"
+        weights = np.nan_to_num(arr.astype("float64"), nan=0.0)
+        sums = np.bincount(self.codes, weights=weights, minlength=self.ngroups)
+        return self.series(sums.astype(dtype), name)
+
+    def mean(self, values, name=None):
+        """Mean of values in each group, skipping missing values."""
+        arr = np.asarray(values)
+        dtype = arr.dtype if arr.dtype.kind == "f" else "float64"
+        sums = self.sum(arr.astype("float64")).to_numpy()
+        counts = self.count(pd.Series(arr)).to_numpy()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, sums / counts, np.nan)
+        return self.series(means.astype(dtype), name)
+
+    def max(self, values, name=None):
+        """Maximum of values in each group, skipping missing values."""
+        arr = self._sorted(self._kept(np.asarray(values)))
+        func = np.fmax if arr.dtype.kind == "f" else np.maximum
+        return self.series(self._reduceat(func, arr), name)
+
+    def first(self, values, name=None):
+        """First non-missing value in each group.
+
+        Returns missing value for groups without non-missing values and
+        preserves the dtype of values.
+        """
+        values = self._kept(pd.Series(values))
+        notna = self._sorted(values.notna().to_numpy())
+        pos = np.where(notna, np.arange(len(notna)), len(notna))
+        first = self._reduceat(np.minimum, pos)
+        found = first < len(notna)
+        rows = np.where(found, first, 0)
+        if self.order is not None:
+            rows = self.order[rows]
+        result = values.take(rows).where(found).set_axis(self.index)
+        return result.rename(name if name else values.name)
+
+    def nunique(self, values, level=None, name=None):
+        """Number of distinct non-missing values in each group.
+
+        If level is given, counts distinct values across all groups sharing
+        the same value of that grouping key and broadcasts counts to groups.
+        """
+        value_codes, uniques = pd.factorize(values)
+        value_codes = self._kept(value_codes)
+        valid = value_codes >= 0
+        if level is None:
+            keys, nkeys = self.codes, self.ngroups
+        else:
+            keys = self.level_codes[level][self.codes]
+            nkeys = len(self.index.levels[self.keys.index(level)])
+        pairs = np.unique(keys[valid] * len(uniques) + value_codes[valid])
+        counts = np.bincount(pairs // max(len(uniques), 1), minlength=nkeys)
+        if level is not None:
+            counts = counts[self.level_codes[level]]
+        return self.series(counts, name)
+
+    def collect(self, results):
+        """Combines aggregator results into a single frame.
+
+        All results share the group index, so columns are written into the
+        output frame directly instead of being aligned by `pd.concat`.
+        """
+        columns = {}
+        for result in results:
+            if not result.index.equals(self.index):
+                raise ValueError("Aggregator result is not indexed by groups.")
+            if isinstance(result, pd.Series):
+                columns[result.name] = result.array
+            else:
+                columns.update({col: result[col].array for col in result})
+        return pd.DataFrame(columns, index=self.index)
@@ -5,94 +5,299 @@ Produces analysis dataset.
 
 import argparse
 import collections
-import concurrent
+import concurrent.futures
+import contextlib
 import functools
 import os
 import sys
+import tempfile
 
 import pandas as pd
+import pyarrow as pa
 
 import src.config as config
 import src.data.aggregators as agg
+import src.data.build_cache as bc
+import src.data.flags as fl
+import src.data.grouper as gr
 import src.data.selectors as sl
 import src.data.transformers as tf
 import src.data.validators as vl
 import src.helpers.data as hd
-import src.helpers.helpers as hh
 import src.helpers.io as io
+import src.helpers.metrics as metrics
+import src.helpers.sketch as sk
 
 
 TIMER_ON = True
 
 
-@hh.timer(on=TIMER_ON)
+def check_inputs(df, funcs):
+    """Raises KeyError if df lacks columns that funcs declare as inputs."""
+    for func in funcs:
+        missing = set(func.inputs) - set(df.columns)
+        if missing:
+            raise KeyError(f"{func.__name__} requires missing columns {missing}.")
+    return df
+
+
+@metrics.instrument("make_data", verbose=TIMER_ON)
 def read_piece(filepath, **kwargs):
+    """Reads columns of piece that aggregators need."""
     print("Reading", filepath)
-    return io.read_parquet(filepath, **kwargs)
+    return io.read_parquet(filepath, columns=agg.input_columns(), **kwargs)
 
 
-@hh.timer(on=TIMER_ON)
-def aggregate_data(df):
-    return pd.concat((f(df) for f in agg.aggregators), axis=1).reset_index()
+@metrics.instrument("make_data", verbose=TIMER_ON)
+def aggregate_data(df, threads=1):
+    cache = agg.ResultCache(df)
+    try:
+        names = [f.__name__ for f in agg.aggregators]
+        results = cache.get_all(names, threads=threads)
+        return cache.grouper.collect(results).reset_index()
+    finally:
+        cache.clear()
 
 
-@hh.timer(on=TIMER_ON)
+@metrics.instrument("make_data", verbose=TIMER_ON)
 def select_sample(df):
-    return functools.reduce(lambda df, f: f(df), sl.selectors, df)
+    check_inputs(df, sl.selectors)
+    return sl.select(df)
+
+
+def aggregate_piece(filepath, cache=True, threads=1):
+    """Returns aggregated piece, reusing cached result if inputs are unchanged."""
+    key = bc.make_key(io.fingerprint(filepath), bc.source_hash(agg, fl, gr))
+    cached = bc.load("aggregate", key) if cache else None
+    if cached is not None:
+        print("Reusing cached aggregated data for", filepath)
+        return cached[0], key
+    print("Computing aggregated data for", filepath)
+    df = aggregate_data(read_piece(filepath), threads=threads)
+    if cache:
+        bc.save("aggregate", key, df)
+    return df, key
+
+
+def select_piece(df, aggregate_key, filepath, cache=True):
+    """Returns selected sample of aggregated piece, reusing cached result if
+    inputs are unchanged.
+
+    Selection counts of the piece are added to `sl.sample_counts` either way.
+    """
+    key = bc.make_key(aggregate_key, bc.source_hash(sl, config))
+    cached = bc.load("select", key) if cache else None
+    if cached is not None:
+        print("Reusing cached selected data for", filepath)
+        df, counts = cached
+    else:
+        print("Computing selected data for", filepath)
+        previous_counts = sl.sample_counts.copy()
+        sl.sample_counts.clear()
+        df = select_sample(df)
+        counts = sl.sample_counts.copy()
+        sl.sample_counts.clear()
+        sl.sample_counts.update(previous_counts)
+        if cache:
+            bc.save("select", key, df, counts)
+    sl.sample_counts.update(counts)
+    return df
+
+
+@metrics.instrument("make_data", verbose=TIMER_ON)
+def clean_piece(filepath, cache=True, threads=1):
+    with metrics.tagged(piece=os.path.basename(filepath)):
+        df, aggregate_key = aggregate_piece(filepath, cache=cache, threads=threads)
+        return select_piece(df, aggregate_key, filepath, cache=cache)
+
 
+def clean_piece_with_counts(filepath, directory, cache=True, threads=1):
+    """Cleans piece, writes it to directory, and returns its path together
+    with its selection counts and the quantile sketches of its winsorised
+    columns.
 
-@hh.timer(on=TIMER_ON)
-def clean_piece(filepath):
-    return read_piece(filepath).pipe(aggregate_data).pipe(select_sample)
+    Pieces are written rather than returned, so that no process holds more
+    than one piece in memory. Counts and sketches are collected per piece
+    because `sl.sample_counts` and `tf.sketches` are not shared between
+    worker processes.
+    """
+    sl.sample_counts.clear()
+    tf.sketches.clear()
+    data = clean_piece(filepath, cache=cache, threads=threads)
+    tf.update_sketches(data)
+    fp = os.path.join(directory, os.path.basename(filepath))
+    io.write_parquet(data, fp, verbose=False)
+    sketches = dict(tf.sketches)
+    tf.sketches.clear()
+    return fp, sl.sample_counts.copy(), sketches
 
 
-@hh.timer(on=TIMER_ON)
+def clean_pieces(filepaths, directory, workers=1, cache=True, threads=1):
+    """Cleans pieces, using a process pool if workers > 1, and a thread pool
+    for the aggregators of each piece if threads > 1, and returns paths of
+    clean pieces written to directory.
+
+    Selection counts, sketches and metrics records of all pieces are merged
+    into `sl.sample_counts`, `tf.sketches` and `metrics.records` in piece
+    order, so the selection table doesn't depend on which worker finishes
+    first.
+    """
+    func = functools.partial(
+        clean_piece_with_counts, directory=directory, cache=cache, threads=threads
+    )
+    collect = functools.partial(metrics.collect, func)
+    if workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(collect, filepaths))
+    else:
+        results = [collect(fp) for fp in filepaths]
+
+    sl.sample_counts.clear()
+    tf.sketches.clear()
+    for (_, counts, sketches), records in results:
+        sl.sample_counts.update(counts)
+        for col, sketch in sketches.items():
+            tf.sketches.setdefault(col, sk.QuantileSketch()).merge(sketch)
+        metrics.records.extend(records)
+    return [fp for (fp, _, _), _ in results]
+
+
+@metrics.instrument("make_data", verbose=TIMER_ON)
 def transform_variables(df):
+    check_inputs(df, tf.transformers)
     return functools.reduce(lambda df, f: f(df), tf.transformers, df)
 
 
-@hh.timer(on=TIMER_ON)
+@metrics.instrument("make_data", verbose=TIMER_ON)
+def transform_pieces(filepaths, output, check_thresholds=False, names=None):
+    """Transforms and validates clean pieces one at a time and appends them
+    to the analysis data at output.
+
+    Pieces are winsorised at thresholds estimated from the quantile sketches
+    in `tf.sketches`, merged across all pieces, so no piece needs the others
+    in memory.
+
+    Returns report of winsorisation thresholds, which includes exact
+    thresholds and relative errors if check_thresholds is True, for which
+    the winsorised columns of all pieces are kept in memory. Metrics records
+    of each piece are tagged with its name in names. The analysis data
+    replaces any file at output only once all pieces have been written.
+    """
+    if not filepaths:
+        raise ValueError("No clean pieces to transform.")
+    names = names or range(len(filepaths))
+    cols = [col for cols, _, _ in tf.WINSORISE.values() for col in cols]
+    exact_data = []
+    with contextlib.ExitStack() as stack:
+        writer = None
+        for name, fp in zip(names, filepaths):
+            with metrics.tagged(piece=name):
+                piece = io.read_parquet(fp)
+                if check_thresholds:
+                    exact_data.append(piece[cols])
+                piece = transform_variables(piece)
+                # Validators check every row, which empty pieces pass trivially
+                if len(piece):
+                    piece = validate_data(piece)
+            table = pa.Table.from_pandas(piece, preserve_index=False)
+            if writer is None:
+                schema = io.append_schema(table)
+                writer = stack.enter_context(io.parquet_writer(output, schema))
+            writer.write_table(table.cast(schema))
+    print(f"{output} written.")
+    if check_thresholds:
+        return tf.threshold_errors(pd.concat(exact_data))
+    return pd.concat(tf.thresholds, names=["transformer"])
+
+
+@metrics.instrument("make_data", verbose=TIMER_ON)
 def validate_data(df):
     return functools.reduce(lambda df, f: f(df), vl.validators, df)
 
 
-def get_filepath(piece):
-    return os.path.join(config.AWS_PIECES, f"mdb_XX{piece}.parquet")
+def get_filepath(piece, source=config.AWS_PIECES):
+    return os.path.join(source, f"mdb_XX{piece}.parquet")
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--piece", help="Piece in [0,9] to process")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes used to clean pieces in parallel",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of threads used to run the aggregators of each piece",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="Recompute all pieces instead of reusing cached results",
+    )
+    parser.add_argument(
+        "--check-thresholds",
+        action="store_true",
+        help="Report errors of sketched winsorisation thresholds against exact ones",
+    )
+    parser.add_argument(
+        "--source",
+        default=config.AWS_PIECES,
+        help="Directory or bucket with clean pieces",
+    )
+    parser.add_argument(
+        "--output",
+        default=config.AWS_PROJECT,
+        help="Directory or bucket to write analysis data to",
+    )
+    parser.add_argument(
+        "--tables",
+        default=config.TABDIR,
+        help="Directory to write sample selection and threshold tables to",
+    )
+    metrics.add_arguments(parser, example="aggregate.dspend")
     return parser.parse_args(args)
 
 
-@hh.timer(on=TIMER_ON)
-def main(argv=None):
-    if argv is None:
-        argv = sys.argv[1:]
-    args = parse_args(argv)
-
+def run(args):
     # Use supplied test piece or all pieces
-    pieces = args.piece if args.piece else range(10)
-    filepaths = [get_filepath(piece) for piece in pieces]
-
-    data = (
-        pd.concat(clean_piece(fp) for fp in filepaths)
-        .reset_index(drop=True)
-        .pipe(transform_variables)
-        .pipe(validate_data)
-    )
+    pieces = [args.piece] if args.piece else range(10)
+    filepaths = [get_filepath(piece, args.source) for piece in pieces]
+
+    names = [os.path.basename(fp) for fp in filepaths]
     fn = f"eval_XX{args.piece}.parquet" if args.piece else "eval.parquet"
-    fp = os.path.join(config.AWS_PROJECT, fn)
-    io.write_parquet(data, fp)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        clean = clean_pieces(
+            filepaths, tmpdir, workers=args.workers, cache=args.cache, threads=args.threads
+        )
+        thresholds = transform_pieces(
+            clean, os.path.join(args.output, fn), args.check_thresholds, names
+        )
+        tf.sketches.clear()
 
     selection_table = hd.make_selection_table(sl.sample_counts)
-    fp = os.path.join(config.TABDIR, "sample_selection.tex")
+    fp = os.path.join(args.tables, "sample_selection.tex")
     hd.write_selection_table(selection_table, fp)
 
+    thresholds.to_csv(os.path.join(args.tables, "winsorisation_thresholds.csv"))
+
     with pd.option_context("max_colwidth", 25):
         print(selection_table)
 
 
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    args = parse_args(argv)
+    metrics.run_instrumented("make_data", args, functools.partial(run, args))
+
+
 if __name__ == "__main__":
     main()
@@ -1,6 +1,12 @@
 """
 Functions to select users for analysis data.
 
+Selectors don't filter the data themselves. Each selector declares the
+user-level summary columns it needs and returns a boolean mask of users to
+keep. `select()` builds the user summary once, combines the masks of all
+selectors, counts the sample after each step from the cumulative mask, and
+materializes the selected data only once, at the end.
+
 """
 
 import collections
@@ -8,57 +14,105 @@ import functools
 import itertools
 
 import numpy as np
+import pandas as pd
 
 import src.config as cf
 import src.helpers.helpers as hh
+import src.helpers.metrics as metrics
 
 
 selectors = []
 sample_counts = collections.Counter()
 
-
-def selector(func):
-    selectors.append(func)
-    return func
+# Summary columns used to count sample in selection table
+COUNT_SUMMARY = {
+    "user_months": ("user_id", "size"),
+    "txns": ("txns_count", "sum"),
+    "txns_volume": ("txns_volume", "sum"),
+}
 
 
-def counter(func):
-    """Count sample after applying function and update selection table.
+def selector(func=None, summary=None, inputs=()):
+    """Adds function to list of selector functions.
 
-    First line of func docstring is used for description in selection table.
+    Args:
+      summary: dict of name-(column, aggfunc) pairs defining the user-level
+        summary columns that func reads, in the format of pandas named
+        aggregation. column can also be a function that derives a column
+        from the data.
+      inputs: columns of the data read by functions in summary.
     """
 
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        df = func(*args, **kwargs)
-        description = func.__doc__.splitlines()[0]
-        sample_counts.update(
-            {
-                description + "@users": df.user_id.nunique(),
-                description + "@user_months": len(df),
-                description + "@txns": df.txns_count.sum(),
-                description + "@txns_volume": df.txns_volume.sum() / 1e6,
-            }
-        )
-        return df
-
-    return wrapper
+    def decorate(func):
+        func = metrics.instrument("select")(func)
+        func.summary = dict(summary or {})
+        columns = [col for col, _ in {**func.summary, **COUNT_SUMMARY}.values()]
+        func.inputs = [col for col in columns if not callable(col)] + list(inputs)
+        selectors.append(func)
+        return func
+
+    return decorate(func) if func else decorate
+
+
+def user_summary(df, funcs):
+    """Returns user-level summary table with columns required by funcs."""
+    aggs = dict(COUNT_SUMMARY)
+    for func in funcs:
+        for name, agg in func.summary.items():
+            if aggs.setdefault(name, agg) != agg:
+                raise ValueError(f"Conflicting definitions of summary column {name}.")
+
+    columns = {"user_id": df.user_id}
+    named_aggs = {}
+    for name, (col, aggfunc) in aggs.items():
+        if callable(col):
+            columns[name] = col(df)
+            col = name
+        else:
+            columns[col] = df[col]
+        named_aggs[name] = (col, aggfunc)
+    return pd.DataFrame(columns).groupby("user_id").agg(**named_aggs)
+
+
+def update_counts(users, keep, description):
+    """Adds sample after selection step to selection table."""
+    sample_counts.update(
+        {
+            description + "@users": keep.sum(),
+            description + "@user_months": users.user_months[keep].sum(),
+            description + "@txns": users.txns[keep].sum(),
+            description + "@txns_volume": users.txns_volume[keep].sum() / 1e6,
+        }
+    )
+
+
+def select(df, funcs=None):
+    """Returns data of users retained by all selectors.
+
+    First line of each selector's docstring is used for description in
+    selection table.
+    """
+    funcs = selectors if funcs is None else funcs
+    users = user_summary(df, funcs)
+    keep = pd.Series(True, index=users.index)
+    for func in funcs:
+        keep &= func(users)
+        update_counts(users, keep, func.__doc__.splitlines()[0])
+    return df[keep.reindex(df.user_id).to_numpy()]
 
 
 @selector
-@counter
-def add_raw_count(df):
+def add_raw_count(users):
     """Raw sample
     Add count of raw dataset to selection table."""
-    return df
+    return pd.Series(True, index=users.index)
 
 
-# @selector
-# @counter
 def drop_first_and_last_month(df):
     """Drop first and last month
 
-    These will likely have incomplete data.
+    These will likely have incomplete data. Drops user-months rather than
+    users, so can't be used as a selector.
     """
     g = df.groupby("user_id")
     ym_max = g.ym.transform("max")
@@ -67,130 +121,118 @@ def drop_first_and_last_month(df):
     return df[cond]
 
 
-@selector
-@counter
-def drop_testers(df):
+@selector(summary={"reg_ym": ("user_reg_ym", "first")})
+def drop_testers(users):
     """Drop test users
 
-    App was launched sometime in 2011, so to ensure we only have users that 
+    App was launched sometime in 2011, so to ensure we only have users that
     were not testers, we drop all users registering before 2012.
     """
-    cond = df.groupby("user_id").user_reg_ym.first().ge("2012-01")
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.reg_ym.ge("2012-01")
 
 
-@selector
-@counter
-def signup_after_march_2017(df):
+@selector(summary={"reg_ym": ("user_reg_ym", "first")})
+def signup_after_march_2017(users):
     """App signup after March 2017
 
     To ensure that we have at least 12 months of account history
     available, which became available for all major banks from
     April 2017 onwards.
     """
-    cond = df.user_reg_ym.ge('2017-04')
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.reg_ym.ge("2017-04")
 
 
-# @selector
-# @counter
-def pre_and_post_signup_data(df, lower=cf.MIN_PRE_MONTHS, upper=cf.MIN_POST_MONTHS):
-    """At least 6 months of pre and post signup data
+def _in_signup_run(df, post=True):
+    """Dummy for whether user-month is part of unbroken run of observed months
+    that starts in signup month (post) or ends in the month before (pre).
 
-    Also ensures that we obser users during all months during that period.
+    Months are offsets from the run's start, so a user-month with offset k
+    is in the run if and only if it is the user's (k+1)-th month on that
+    side of signup. Assumes one row per user-month.
     """
-    required_periods = set(range(-lower, upper))
+    offset = df.tt if post else -df.tt - 1
+    rank = offset.where(offset.ge(0)).groupby(df.user_id).rank(method="first")
+    return rank.sub(1).eq(offset)
 
-    def cond_checker(g):
-        observed_periods = set(g.tt.unique())
-        return required_periods.issubset(observed_periods)
 
-    cond = df.groupby("user_id").apply(cond_checker)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+SIGNUP_RUNS = {
+    "pre_signup_months": (functools.partial(_in_signup_run, post=False), "sum"),
+    "post_signup_months": (functools.partial(_in_signup_run, post=True), "sum"),
+}
 
 
-@selector
-@counter
-def has_savings_account(df):
+# @selector(summary=SIGNUP_RUNS, inputs=["tt"])
+def pre_and_post_signup_data(users, lower=cf.MIN_PRE_MONTHS, upper=cf.MIN_POST_MONTHS):
+    """At least 6 months of pre and post signup data
+
+    Also ensures that we observe users during all months during that period,
+    i.e. in months tt = -lower, ..., upper - 1. Works for any window because
+    the summary holds the length of each user's unbroken pre and post signup
+    runs.
+    """
+    return users.pre_signup_months.ge(lower) & users.post_signup_months.ge(upper)
+
+
+@selector(summary={"has_savings_account": ("has_savings_account", "max")})
+def has_savings_account(users):
     """At least one savings account"""
-    cond = df.has_savings_account.groupby(df.user_id).max().eq(1)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.has_savings_account.eq(1)
 
 
-@selector
-@counter
-def has_current_account(df):
+@selector(summary={"has_current_account": ("has_current_account", "max")})
+def has_current_account(users):
     """At least one current account"""
-    cond = df.has_current_account.groupby(df.user_id).max().eq(1)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.has_current_account.eq(1)
 
 
-@selector
-@counter
-def year_income(df, min_income=cf.MIN_YEAR_INCOME):
+@selector(summary={"min_month_income_mean": ("month_income_mean", "min")})
+def year_income(users, min_income=cf.MIN_YEAR_INCOME):
     """At least \pounds5,000 of annual income"""
-    cond = df.groupby("user_id").month_income_mean.min().ge(min_income / 12)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_month_income_mean.ge(min_income / 12)
 
 
-@selector
-@counter
-def month_min_txns(df, min_txns=cf.MIN_MONTH_TXNS):
+@selector(summary={"min_txns_count": ("txns_count", "min")})
+def month_min_txns(users, min_txns=cf.MIN_MONTH_TXNS):
     """At least 10 txns each month"""
-    cond = df.groupby("user_id").txns_count.min().ge(min_txns)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_txns_count.ge(min_txns)
 
 
-@selector
-@counter
-def month_min_spend(df, min_spend=cf.MIN_MONTH_SPEND):
+@selector(summary={"min_month_spend": ("month_spend", "min")})
+def month_min_spend(users, min_spend=cf.MIN_MONTH_SPEND):
     """At least \pounds200 of monthly spend"""
-    cond = df.groupby("user_id").month_spend.min().ge(min_spend)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.min_month_spend.ge(min_spend)
 
 
-@selector
-@counter
-def max_active_accounts(df, max_accounts=cf.MAX_ACTIVE_ACCOUNTS):
+@selector(summary={"max_accounts_active": ("accounts_active", "max")})
+def max_active_accounts(users, max_accounts=cf.MAX_ACTIVE_ACCOUNTS):
     """No more than 10 active accounts"""
-    cond = df.groupby("user_id").accounts_active.max().le(max_accounts)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.max_accounts_active.le(max_accounts)
 
 
-@selector
-@counter
-def complete_demographic_info(df):
+@selector(
+    summary={
+        "age_count": ("age", "count"),
+        "is_female_count": ("is_female", "count"),
+        "is_urban_count": ("is_urban", "count"),
+    }
+)
+def complete_demographic_info(users):
     """Complete demographic information
 
     Retains only users for which we have full demographic information.
     """
-    cols = ["age", "is_female", "is_urban"]
-    cond = df[cols].isna().groupby(df.user_id).sum().sum(1).eq(0)
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    cols = ["age_count", "is_female_count", "is_urban_count"]
+    return users[cols].eq(users.user_months, axis=0).all(axis=1)
 
 
-@selector
-@counter
-def working_age(df):
+@selector(summary={"age": ("age", "first")})
+def working_age(users):
     """Working age"""
-    cond = df.groupby("user_id").age.first().between(18, 65, inclusive="both")
-    users = cond[cond].index
-    return df[df.user_id.isin(users)]
+    return users.age.between(18, 65, inclusive="both")
 
 
 @selector
-@counter
-def add_final_count(df):
+def add_final_count(users):
     """Final sample
     Add count of final dataset to selection table."""
-    return df
+    return pd.Series(True, index=users.index)
@@ -3,56 +3,114 @@ Functions to transform variables.
 
 """
 
+import pandas as pd
+
 import src.config as config
 import src.helpers.data as hd
+import src.helpers.metrics as metrics
+import src.helpers.sketch as sk
 
 
 transformers = []
+thresholds = {}
+sketches = {}
 
 
-def transformer(func):
-    """Add func to list of transformer functions."""
-    transformers.append(func)
-    return func
+def transformer(func=None, inputs=()):
+    """Add func to list of transformer functions.
 
+    Args:
+      inputs: columns of the analysis data read by func.
+    """
 
-@transformer
-def winsorise_upper(df):
-    cols = [
-        "inflows",
-        "outflows",
-        "pos_netflows",
-        "inflows_norm",
-        "outflows_norm",
-        "txns_count",
-        "txns_volume",
-        "month_spend",
-        "month_income",
-        "dspend",
-        "dspend_mean",
-        "dspend_count",
-        "dspend_clothes",
-        "dspend_entertainment",
-        "dspend_food",
-        "dspend_groceries",
-        "dspend_other",
-        "dspend_dd",
-        "investments",
-        "up_savings",
-        "ca_transfers",
-        "cc_payments",
-        "loan_funds",
-        "loan_rpmts",
-    ]
-    df[cols] = df[cols].apply(hd.winsorise, pct=config.WIN_PCT, how="upper")
+    def decorate(func):
+        func = metrics.instrument("transform")(func)
+        func.inputs = list(inputs)
+        transformers.append(func)
+        return func
+
+    return decorate(func) if func else decorate
+
+
+WINSORISE_UPPER_COLS = [
+    "inflows",
+    "outflows",
+    "pos_netflows",
+    "inflows_norm",
+    "outflows_norm",
+    "txns_count",
+    "txns_volume",
+    "month_spend",
+    "month_income",
+    "dspend",
+    "dspend_mean",
+    "dspend_count",
+    "dspend_clothes",
+    "dspend_entertainment",
+    "dspend_food",
+    "dspend_groceries",
+    "dspend_other",
+    "dspend_dd",
+    "investments",
+    "up_savings",
+    "ca_transfers",
+    "cc_payments",
+    "loan_funds",
+    "loan_rpmts",
+]
+
+WINSORISE_BOTH_COLS = [
+    "netflows",
+    "netflows_norm",
+]
+
+
+# Columns, percentile and tails winsorised by each winsorising transformer
+WINSORISE = {
+    "winsorise_upper": (WINSORISE_UPPER_COLS, config.WIN_PCT, "upper"),
+    "winsorise_both": (WINSORISE_BOTH_COLS, config.WIN_PCT / 2, "both"),
+}
+
+
+def update_sketches(df):
+    """Adds values of winsorised columns of df to their quantile sketches.
+
+    Once `sketches` holds the sketches of all pieces, winsorising
+    transformers use thresholds estimated from them instead of thresholds
+    of the data they transform.
+    """
+    for cols, _, _ in WINSORISE.values():
+        for col in cols:
+            sketches.setdefault(col, sk.QuantileSketch()).update(df[col])
+
+
+def threshold_errors(df):
+    """Returns thresholds estimated from sketches together with exact
+    thresholds of df and their relative errors."""
+    reports = {}
+    for name, (cols, pct, how) in WINSORISE.items():
+        report = thresholds[name][["lower", "upper"]]
+        exact = hd.winsorise_thresholds(df, cols, pct=pct, how=how)[["lower", "upper"]]
+        error = report.sub(exact).abs().div(exact.abs())
+        reports[name] = pd.concat(
+            [report, exact.add_suffix("_exact"), error.add_suffix("_error")], axis=1
+        )
+    return pd.concat(reports, names=["transformer"])
+
+
+def _winsorise(df, name):
+    cols, pct, how = WINSORISE[name]
+    thresholds[name] = hd.winsorise_block(
+        df, cols, pct=pct, how=how, sketches=sketches or None
+    )
     return df
 
 
-@transformer
+@transformer(inputs=WINSORISE_UPPER_COLS)
+def winsorise_upper(df):
+    return _winsorise(df, "winsorise_upper")
+
+
+@transformer(inputs=WINSORISE_BOTH_COLS)
 def winsorise_both(df):
-    cols = [
-        "netflows",
-        "netflows_norm",
-    ]
-    df[cols] = df[cols].apply(hd.winsorise, pct=config.WIN_PCT / 2, how="both")
-    return df
+    return _winsorise(df, "winsorise_both")
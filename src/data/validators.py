@@ -6,6 +6,7 @@ Functions to validate integrity of analysis data.
 import numpy as np
 
 import src.config as config
+import src.helpers.metrics as metrics
 
 
 validators = []
@@ -13,6 +14,7 @@ validators = []
 
 def validator(func):
     """Add func to list of validator functions."""
+    func = metrics.instrument("validate")(func)
     validators.append(func)
     return func
 
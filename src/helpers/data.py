@@ -101,6 +101,111 @@ def winsorise(series, pct=1, how="both"):
     return series.clip(**kwargs)
 
 
+def _block_percentiles(block, pcts):
+    """Returns percentiles of each column of 2-D block, ignoring missing values.
+
+    Matches `np.nanpercentile` with linear interpolation, but finds the
+    order statistics of all columns with a single partition instead of one
+    per column and percentile call. Missing values are sorted to the end of each
+    column, so the valid values of a column with n of them occupy the first
+    n positions.
+
+    Returns array with one row per percentile and one column per column of
+    block.
+    """
+    # Work on a copy with one contiguous row per column of block.
+    work = np.array(block.T, order="C")
+    if work.dtype.kind == "f":
+        isnan = np.isnan(work)
+        n = work.shape[1] - isnan.sum(axis=1)
+        work[isnan] = np.inf
+    else:
+        n = np.full(work.shape[0], work.shape[1])
+    idx = np.outer(np.asarray(pcts, dtype="float64") / 100, n - 1)
+    lower = np.clip(np.floor(idx).astype("int64"), 0, None)
+    upper = np.minimum(lower + 1, np.clip(n - 1, 0, None))
+    if work.shape[1]:
+        work.partition(np.unique(np.concatenate([lower, upper], axis=None)), axis=1)
+        a = np.take_along_axis(work, lower.T, axis=1).T
+        b = np.take_along_axis(work, upper.T, axis=1).T
+    else:
+        a = b = np.full(idx.shape, np.nan)
+    t = idx - lower
+    # Columns without valid values have only inf sentinels, whose difference
+    # is NaN, and are set to missing below.
+    with np.errstate(invalid="ignore"):
+        diff = b - a
+        result = np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+    return np.where(n > 0, result, np.nan)
+
+
+def winsorise_thresholds(df, cols, pct=1, how="both", sketches=None):
+    """Returns thresholds at which to winsorise cols of df.
+
+    Percentiles of all columns of the same dtype are computed in one pass.
+
+    Arguments:
+        pct : Percentile of data to be winsorised at specified ends.
+            Default is 1.
+        how: end(s) of distribution from which to winsorise values. One of
+            {'both', 'lower', 'upper'}. Defaults to 'both'.
+        sketches: Optional dict of column-`QuantileSketch` pairs. If given,
+            thresholds are estimated from the sketches instead of computed
+            from df, so that pieces of a dataset can be winsorised at the
+            thresholds of the entire dataset.
+
+    Returns:
+        Dataframe with lower and upper threshold and number of non-missing
+        values for each column. Unused thresholds are missing.
+    """
+    pcts = {"both": [pct, 100 - pct], "lower": [pct], "upper": [100 - pct]}[how]
+    sides = ["lower", "upper"] if how == "both" else [how]
+    if sketches is not None:
+        report = pd.DataFrame(
+            [sketches[col].quantile(pcts) for col in cols], index=cols, columns=sides
+        )
+        report["n"] = [sketches[col].count for col in cols]
+    else:
+        reports = []
+        dtypes = df.dtypes[cols]
+        for dtype, dtype_cols in dtypes.groupby(dtypes).groups.items():
+            block = df[list(dtype_cols)].to_numpy(dtype=dtype)
+            report = pd.DataFrame(
+                dict(zip(sides, _block_percentiles(block, pcts))), index=dtype_cols
+            )
+            report["n"] = np.count_nonzero(~pd.isna(block), axis=0)
+            reports.append(report)
+        report = pd.concat(reports)
+    report = report.reindex(index=cols, columns=["lower", "upper", "n"])
+    return report.rename_axis("column").astype("float64")
+
+
+def winsorise_block(df, cols, pct=1, how="both", sketches=None):
+    """Winsorises cols of df in-place and returns thresholds used.
+
+    Equivalent to applying `winsorise()` to each column, but computes
+    thresholds with `winsorise_thresholds()`, which takes the same arguments.
+    Float columns keep their dtype, so float32 columns are clipped at
+    thresholds rounded to float32 rather than upcast to float64.
+    """
+    report = winsorise_thresholds(df, cols, pct=pct, how=how, sketches=sketches)
+    bounds = report[["lower", "upper"]].fillna({"lower": -np.inf, "upper": np.inf})
+    for col, (lo, hi) in zip(cols, bounds.to_numpy()):
+        if np.isinf([lo, hi]).all():
+            continue
+        values = df[col].to_numpy()
+        if values.dtype.kind == "f" or (lo == np.round(lo) and hi == np.round(hi)):
+            # Setting values of same dtype through loc writes into the
+            # existing block instead of splitting it to insert a new one.
+            lo, hi = [None if np.isinf(b) else values.dtype.type(b) for b in [lo, hi]]
+            df.loc[:, col] = np.clip(values, lo, hi)
+        else:
+            # Like `Series.clip()`, upcast integers clipped at fractional
+            # thresholds.
+            df[col] = np.clip(values, lo, hi)
+    return report
+
+
 def breakdown(df, group_var, group_var_value, component_var, metric="value", net=False):
     """Calculates sorted breakdown of group_var_value by component_var.
 
@@ -0,0 +1,79 @@
+"""
+Row fingerprints for finding duplicate rows.
+
+Each key column is mapped to 64-bit integers that are equal whenever
+pandas considers two values equal (category codes, the bits of dates and
+numbers), and these are mixed into a single 64-bit fingerprint per row.
+Duplicates are then found by hashing one integer per row rather than the
+values of each column, and confirmed by comparing the key columns, so that
+results are exact even if two rows share a fingerprint by chance.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Multiplier of the 64-bit MurmurHash3 finaliser
+_MIX = np.uint64(0xFF51AFD7ED558CCD)
+
+
+def keys(series):
+    """Returns integers that are equal for values pandas considers equal.
+
+    Missing values map to a single integer.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy().astype("int64")
+    values = series.to_numpy()
+    if values.dtype.kind in "mM":
+        return values.view("int64")
+    if values.dtype.kind == "f":
+        # Adding zero turns -0.0 into 0.0, and all NaNs get the same bits
+        values = np.where(np.isnan(values), np.nan, values.astype("float64") + 0.0)
+        return values.view("int64")
+    if values.dtype.kind in "iub":
+        return values.astype("int64")
+    return pd.factorize(values)[0].astype("int64")
+
+
+def fingerprint(columns):
+    """Returns 64-bit fingerprint of each row of key columns."""
+    result = np.zeros(len(columns[0]), dtype="uint64")
+    with np.errstate(over="ignore"):
+        for column in columns:
+            result ^= column.view("uint64")
+            result *= _MIX
+            result ^= result >> np.uint64(33)
+    return result
+
+
+def duplicated(df, subset, rows=None):
+    """Returns mask of rows whose subset columns equal those of an earlier row.
+
+    Matches `df.duplicated(subset)` with keep="first".
+
+    Args:
+      df: data.
+      subset: key columns.
+      rows: positions of the rows to compare, in order, or None for all
+        rows. The mask then has an element for each of these rows.
+    """
+    columns = [keys(df[col]) for col in subset]
+    if rows is not None:
+        columns = [col[rows] for col in columns]
+    codes, _ = pd.factorize(fingerprint(columns))
+    # Codes are numbered in order of first appearance, so the first row with
+    # each fingerprint is the one whose code exceeds all codes before it
+    positions = np.arange(len(codes))
+    is_first = codes > np.maximum.accumulate(np.append(-1, codes[:-1]))
+    first = positions[is_first]
+    is_duplicate = ~is_first
+    dups = positions[is_duplicate]
+    originals = first[codes[dups]]
+    if all(np.array_equal(col[dups], col[originals]) for col in columns):
+        return is_duplicate
+    # Distinct rows with the same fingerprint
+    if rows is not None:
+        df = df[subset].take(rows)
+    return df.duplicated(subset).to_numpy()
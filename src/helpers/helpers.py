@@ -1,23 +1,7 @@
-import time
-import functools
+import src.helpers.metrics as metrics
 
 
 def timer(func=None, on=True):
-    def decorate(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            start = time.time()
-            result = func(*args, **kwargs)
-            end = time.time()
-            if on:
-                diff = end - start
-                unit = "seconds"
-                if diff > 60:
-                    diff /= 60
-                    unit = "minutes"
-                    print(f"Time for {func.__name__:30}: {diff:.2f} {unit}")
-            return result
-
-        return wrapper
-
+    """Records metrics of calls of func and prints their duration if on."""
+    decorate = metrics.instrument("call", verbose=on)
     return decorate(func) if func else decorate
@@ -1,21 +1,121 @@
 import argparse
+import contextlib
+import functools
+import glob
+import hashlib
+import json
 import os
 import platform
+import time
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import s3fs
 
 from src import config
+import src.helpers.metrics as metrics
 
 
-def read_csv(path, aws_profile=config.AWS_PROFILE, **kwargs):
-    """Reads csv files from local directory or AWS bucket."""
+def _hash(string):
+    return hashlib.sha1(string.encode()).hexdigest()
+
+
+def _evict(max_bytes=None):
+    """Removes least recently used cache files until cache fits size budget.
+
+    Cache files are touched on every read, so modification times order
+    files by last use. Files used within `config.CACHE_GRACE_SECONDS` are
+    kept, so that eviction by one process doesn't remove files that other
+    processes have resolved but not yet read.
+    """
+    if max_bytes is None:
+        max_bytes = config.CACHE_MAX_BYTES
+    grace_start = time.time() - config.CACHE_GRACE_SECONDS
+    files = []
+    for fp in glob.glob(os.path.join(config.CACHE_DIR, "*", "*")):
+        with contextlib.suppress(FileNotFoundError):
+            if not fp.endswith(".tmp"):
+                stat = os.stat(fp)
+                files.append((stat.st_mtime, stat.st_size, fp))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    # Most recently used file is kept even if it exceeds the budget
+    for mtime, size, fp in files[:-1]:
+        if total <= max_bytes or mtime >= grace_start:
+            break
+        total -= size
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(fp)
+
+
+@metrics.instrument("io")
+def cached_path(path, aws_profile=config.AWS_PROFILE):
+    """Returns path of local copy of S3 object, downloading object if needed.
+
+    Copies are keyed by S3 path and the object's ETag and size, so that a
+    changed object is downloaded again. In offline mode, returns the most
+    recently used copy of the object without contacting S3. Returns path
+    unchanged for objects that aren't single files, such as partitioned
+    parquet datasets.
+    """
+    path_dir = os.path.join(config.CACHE_DIR, _hash(path))
+    ext = os.path.splitext(path)[1]
+    if config.OFFLINE:
+        copies = glob.glob(os.path.join(path_dir, f"*{ext}"))
+        if not copies:
+            raise FileNotFoundError(f"{path} is not cached and S3 is offline.")
+        fp = max(copies, key=os.path.getmtime)
+    else:
+        fs = s3fs.S3FileSystem(profile=aws_profile)
+        info = fs.info(path)
+        if info["type"] != "file":
+            return path
+        version = _hash(f"{info.get('ETag')}-{info['size']}")
+        fp = os.path.join(path_dir, version + ext)
+        if not os.path.exists(fp):
+            os.makedirs(path_dir, exist_ok=True)
+            tmp = f"{fp}.{os.getpid()}.tmp"
+            fs.get(path, tmp)
+            os.replace(tmp, fp)
+    os.utime(fp)
+    _evict()
+    return fp
+
+
+def fingerprint(path, aws_profile=config.AWS_PROFILE):
+    """Returns hash that changes whenever the content of file changes.
+
+    Uses the ETag and size of S3 objects (or, in offline mode, of their
+    cached copy) and the content of local files.
+    """
+    if path.startswith("s3://"):
+        if config.OFFLINE:
+            return os.path.splitext(os.path.basename(cached_path(path)))[0]
+        info = s3fs.S3FileSystem(profile=aws_profile).info(path)
+        return _hash(f"{info.get('ETag')}-{info['size']}")
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+@metrics.instrument("io")
+def read_csv(path, aws_profile=config.AWS_PROFILE, cache=True, **kwargs):
+    """Reads csv files from local directory or AWS bucket.
+
+    Files from AWS are read through the local cache unless cache is False.
+    """
+    if path.startswith("s3://") and cache:
+        path = cached_path(path, aws_profile)
     if path.startswith("s3://"):
         options = dict(storage_options=dict(profile=aws_profile))
         return pd.read_csv(path, **options, **kwargs)
     return pd.read_csv(path, **kwargs)
 
 
+@metrics.instrument("io")
 def write_csv(df, path, aws_profile=config.AWS_PROFILE, verbose=True, **kwargs):
     """Writes csv to local directory or to AWS bucket."""
     if path.startswith("s3://"):
@@ -27,20 +127,120 @@ def write_csv(df, path, aws_profile=config.AWS_PROFILE, verbose=True, **kwargs):
         print(f"{path} (of shape {df.shape}) written.")
 
 
-def read_parquet(path, aws_profile=config.AWS_PROFILE, **kwargs):
-    """Reads parquet file from local directory or AWS bucket."""
+@metrics.instrument("io")
+def read_parquet(path, aws_profile=config.AWS_PROFILE, cache=True, **kwargs):
+    """Reads parquet file from local directory or AWS bucket.
+
+    Files from AWS are read through the local cache unless cache is False.
+    """
+    if path.startswith("s3://") and cache:
+        path = cached_path(path, aws_profile)
     if path.startswith("s3://"):
         options = dict(storage_options=dict(profile=aws_profile))
         return pd.read_parquet(path, **options, **kwargs)
     return pd.read_parquet(path, **kwargs)
 
 
-def write_parquet(df, path, aws_profile=config.AWS_PROFILE, index=False, verbose=True, **kwargs):
-    """Writes parquet to local directory or to AWS bucket."""
-    if path.startswith("s3://"):
+@metrics.instrument("io")
+def write_parquet(
+    df, path, aws_profile=config.AWS_PROFILE, index=False, verbose=True, metadata=None, **kwargs
+):
+    """Writes parquet to local directory or to AWS bucket.
+
+    Metadata is stored in the schema of the file (see `add_metadata`).
+    """
+    if metadata:
+        table = pa.Table.from_pandas(df, preserve_index=index)
+        schema = add_metadata(table.schema, metadata)
+        with parquet_writer(path, schema, aws_profile, **kwargs) as writer:
+            writer.write_table(table.replace_schema_metadata(schema.metadata))
+    elif path.startswith("s3://"):
         options = dict(storage_options=dict(profile=aws_profile))
         df.to_parquet(path, index=index, **options, **kwargs)
     else:
         df.to_parquet(path, index=index, **kwargs)
     if verbose:
         print(f"{path} (of shape {df.shape}) written.")
+
+
+def append_schema(table):
+    """Returns schema that tables appended to a parquet file are cast to.
+
+    Categories differ across tables, so dictionary columns are written
+    with string values and int32 indices, and columns that are entirely
+    missing in the first table as strings.
+    """
+    fields = []
+    for field in table.schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(
+                pa.dictionary(pa.int32(), pa.string(), field.type.ordered)
+            )
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())
+        fields.append(field)
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def add_metadata(schema, metadata):
+    """Returns parquet schema with metadata, a dict of json serialisable
+    values, added to the metadata of the file."""
+    merged = dict(schema.metadata or {})
+    merged[b"mdb"] = json.dumps(metadata).encode()
+    return schema.with_metadata(merged)
+
+
+def read_schema(path, aws_profile=config.AWS_PROFILE, cache=True):
+    """Returns schema of parquet file from local directory or AWS bucket."""
+    if path.startswith("s3://") and cache:
+        path = cached_path(path, aws_profile)
+    if path.startswith("s3://"):
+        fs = s3fs.S3FileSystem(profile=aws_profile)
+        with fs.open(path, "rb") as f:
+            return pq.read_schema(f)
+    return pq.read_schema(path)
+
+
+def read_metadata(path, aws_profile=config.AWS_PROFILE, cache=True):
+    """Returns metadata added to parquet file with `add_metadata`."""
+    schema = read_schema(path, aws_profile, cache)
+    return json.loads((schema.metadata or {}).get(b"mdb", b"{}"))
+
+
+def iter_parquet_batches(
+    path, batch_size, aws_profile=config.AWS_PROFILE, cache=True, **kwargs
+):
+    """Yields record batches of parquet file from local directory or AWS bucket."""
+    if path.startswith("s3://") and cache:
+        path = cached_path(path, aws_profile)
+    if path.startswith("s3://"):
+        fs = s3fs.S3FileSystem(profile=aws_profile)
+        with fs.open(path, "rb") as f:
+            yield from pq.ParquetFile(f).iter_batches(batch_size=batch_size, **kwargs)
+    else:
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size, **kwargs)
+
+
+@contextlib.contextmanager
+def parquet_writer(path, schema, aws_profile=config.AWS_PROFILE, **kwargs):
+    """Opens writer that appends row groups to parquet file in local directory
+    or AWS bucket.
+
+    Row groups are written to a temporary file, which replaces the file at
+    path only if the block exits without error, so that failed writes don't
+    leave a partial file in its place.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if path.startswith("s3://"):
+        fs = s3fs.S3FileSystem(profile=aws_profile)
+        open_tmp, remove, move = functools.partial(fs.open, tmp, "wb"), fs.rm, fs.mv
+    else:
+        open_tmp, remove, move = functools.partial(open, tmp, "wb"), os.remove, os.replace
+    try:
+        with open_tmp() as f, pq.ParquetWriter(f, schema, **kwargs) as writer:
+            yield writer
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            remove(tmp)
+        raise
+    move(tmp, path)
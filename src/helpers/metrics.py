@@ -0,0 +1,535 @@
+"""
+Metrics of pipeline stages.
+
+Cleaners, aggregators, selectors, transformers, validators and I/O functions
+are wrapped with `instrument()` when they are registered, which adds a
+record with wall time, CPU time, rows and columns in and out, and change in
+resident memory of each call to `records`. CPU time (`cpu`) is that of the
+thread running the stage, so that stages run in parallel threads don't count
+each other's time, and `process_cpu` that of all threads of the process,
+which includes threads the stage starts, such as those of aggregators. `write_report()` writes the
+records of a run to a json file, and `write_trace()` writes them as a
+timeline in Chrome's trace event format.
+
+Memory instrumentation is optional. With `config.TRACK_MEMORY` set, records
+also hold peak resident memory and peak memory allocated through Python
+(traced with tracemalloc, which includes numpy arrays) of each stage. Stages
+with a budget in `config.MEMORY_BUDGETS` raise `MemoryBudgetError` as soon
+as resident memory exceeds it, rather than running until the process is
+killed. Where peak resident memory can't be reset and current resident
+memory isn't available (e.g. on macOS), the peak of a stage is that of the
+process up to the end of the stage, and budgets are checked against new
+peaks of the process reached while the stage runs.
+
+Stages selected with `config.PROFILE_STAGES` are profiled, see
+`src/helpers/profiling.py`.
+
+"""
+
+import contextlib
+import datetime
+import functools
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import _thread
+
+import pandas as pd
+
+from src import config
+from src.helpers import profiling
+
+
+records = []
+tags = {}
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+# Seconds between checks of resident memory against budgets
+WATCH_INTERVAL = 0.05
+
+# Memory frames of active stages by thread, and budget breaches found by
+# the watchdog thread that are yet to be raised
+_frames = {}
+_breaches = []
+_lock = threading.Lock()
+_watchdog = None
+
+
+class MemoryBudgetError(MemoryError):
+    """Raised when a stage exceeds its memory budget."""
+
+
+def rss_mb():
+    """Returns resident memory of process in MB, or None if unavailable."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / 2**20
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    """Returns peak resident memory of process in MB since it was last reset."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Process lifetime peak, in bytes on macOS and KB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+
+def _reset_peak_rss():
+    """Resets peak resident memory of process and returns whether this is
+    supported (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def configure_memory(track=False, budgets=None):
+    """Enables memory tracking and sets memory budgets of stages, here and,
+    through the environment, in worker processes started afterwards.
+
+    Args:
+      track: record peak resident and allocated memory of stages.
+      budgets: budgets in MB by stage, given as "kind.name", "kind" or "*".
+    """
+    config.TRACK_MEMORY = track or config.TRACK_MEMORY
+    config.MEMORY_BUDGETS = {**config.MEMORY_BUDGETS, **(budgets or {})}
+    os.environ["MDB_TRACK_MEMORY"] = "1" if config.TRACK_MEMORY else "0"
+    os.environ["MDB_MEMORY_BUDGETS"] = ",".join(
+        f"{key}={mb}" for key, mb in config.MEMORY_BUDGETS.items()
+    )
+
+
+def _keys(kind, name):
+    """Returns keys that select a stage in settings, most specific first."""
+    return f"{kind}.{name}", kind, "*"
+
+
+def budget(kind, name):
+    """Returns memory budget of stage in MB, or None if it has none."""
+    budgets = config.MEMORY_BUDGETS
+    for key in _keys(kind, name):
+        if key in budgets:
+            return budgets[key]
+    return None
+
+
+def profiled(kind, name):
+    """Returns whether stage is selected for profiling."""
+    return any(key in config.PROFILE_STAGES for key in _keys(kind, name))
+
+
+class _MemoryFrame(object):
+    """Memory measurements of an active stage."""
+
+    def __init__(self, record, budget, parent):
+        self.record = record
+        self.budget = budget
+        self.parent = parent
+        self.traced = config.TRACK_MEMORY
+        self.peak_reset = False
+        self.peak_start = 0
+        self.peak_rss = 0
+        self.alloc_start = 0
+        self.alloc_peak = 0
+
+
+def _enter_memory(record):
+    """Starts measuring memory of stage and returns its frame.
+
+    Peaks are reset at the start of each stage, so the peak of the
+    enclosing stage is saved in its frame first, and the peak of each
+    stage is passed on to the enclosing stage when it ends.
+    """
+    with _lock:
+        stack = _frames.setdefault(threading.get_ident(), [])
+        parent = stack[-1] if stack else None
+        frame = _MemoryFrame(record, budget(record["kind"], record["name"]), parent)
+        stack.append(frame)
+    if frame.traced:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        current, peak = tracemalloc.get_traced_memory()
+        if parent is not None:
+            parent.alloc_peak = max(parent.alloc_peak, peak)
+        tracemalloc.reset_peak()
+        frame.alloc_start = frame.alloc_peak = current
+    peak = peak_rss_mb()
+    if parent is not None:
+        parent.peak_rss = max(parent.peak_rss, peak)
+    frame.peak_reset = _reset_peak_rss()
+    # Without a reset, only peaks above that of the process so far are the
+    # stage's own
+    frame.peak_start = 0 if frame.peak_reset else peak
+    if frame.budget is not None:
+        _start_watchdog()
+    return frame
+
+
+def _exit_memory(frame):
+    """Stops measuring memory of stage and adds peaks to its record."""
+    with _lock:
+        _frames[threading.get_ident()].remove(frame)
+    frame.peak_rss = max(frame.peak_rss, peak_rss_mb())
+    # Without a reset, the peak is that of the process so far
+    frame.record["peak_rss_mb"] = frame.peak_rss
+    if frame.parent is not None:
+        frame.parent.peak_rss = max(frame.parent.peak_rss, frame.peak_rss)
+    if frame.traced and tracemalloc.is_tracing():
+        frame.alloc_peak = max(frame.alloc_peak, tracemalloc.get_traced_memory()[1])
+        frame.record["alloc_peak_mb"] = (frame.alloc_peak - frame.alloc_start) / 2**20
+        if frame.parent is not None:
+            frame.parent.alloc_peak = max(frame.parent.alloc_peak, frame.alloc_peak)
+
+
+def _budget_report(frame, rss):
+    """Returns message describing breach of memory budget of frame's stage."""
+    record = frame.record
+    piece = f" on {record['piece']}" if "piece" in record else ""
+    lines = [
+        f"Stage {record['kind']}.{record['name']}{piece} exceeded its memory "
+        f"budget of {frame.budget:,.0f} MB: resident memory reached {rss:,.0f} MB."
+    ]
+    with _lock:
+        stacks = [list(stack) for stack in _frames.values() if stack]
+    for stack in stacks:
+        names = [f"{f.record['kind']}.{f.record['name']}" for f in stack]
+        lines.append("Active stages: " + " > ".join(names))
+    finished = [r for r in records if "peak_rss_mb" in r]
+    if finished:
+        largest = max(finished, key=lambda r: r["peak_rss_mb"])
+        lines.append(
+            f"Largest finished stage: {largest['kind']}.{largest['name']} "
+            f"({largest['peak_rss_mb']:,.0f} MB)"
+        )
+    if tracemalloc.is_tracing():
+        lines.append("Largest allocations:")
+        stats = tracemalloc.take_snapshot().statistics("lineno")[:5]
+        lines.extend(f"  {stat}" for stat in stats)
+    return "\n".join(lines)
+
+
+def _watch():
+    """Interrupts main thread when resident memory exceeds a stage budget."""
+    while True:
+        time.sleep(WATCH_INTERVAL)
+        if _breaches:
+            continue
+        rss = rss_mb()
+        current = rss is not None
+        if not current:
+            # Only the peak of the process is known, e.g. on macOS
+            rss = peak_rss_mb()
+        # Stages can't end while the lock is held, so the breach is raised
+        # by a stage that is still active
+        with _lock:
+            frames = [frame for stack in _frames.values() for frame in stack]
+            for frame in frames:
+                exceeded = frame.budget is not None and rss > frame.budget
+                if exceeded and (current or rss > frame.peak_start):
+                    _breaches.append((frame, rss))
+                    _thread.interrupt_main()
+                    break
+
+
+def _start_watchdog():
+    global _watchdog
+    if _watchdog is None or not _watchdog.is_alive():
+        _watchdog = threading.Thread(target=_watch, name="memory-watchdog", daemon=True)
+        _watchdog.start()
+
+
+def _after_fork():
+    """Forgets stages of parent process in forked worker processes."""
+    global _watchdog
+    _frames.clear()
+    del _breaches[:]
+    _watchdog = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _shape(obj, suffix):
+    if isinstance(obj, pd.DataFrame):
+        return {f"rows_{suffix}": len(obj), f"cols_{suffix}": len(obj.columns)}
+    if isinstance(obj, pd.Series):
+        return {f"rows_{suffix}": len(obj), f"cols_{suffix}": 1}
+    return {}
+
+
+def format_duration(seconds):
+    if seconds > 60:
+        return f"{seconds / 60:.2f} minutes"
+    return f"{seconds:.2f} seconds"
+
+
+@contextlib.contextmanager
+def tagged(**kwargs):
+    """Adds tags, such as the piece being processed, to records of stages
+    run inside the block."""
+    previous = dict(tags)
+    tags.update(kwargs)
+    try:
+        yield
+    finally:
+        tags.clear()
+        tags.update(previous)
+
+
+@contextlib.contextmanager
+def stage(kind, name, data=None, verbose=False):
+    """Records metrics of code run inside the block.
+
+    Yields the record, so that callers can add the output shape or other
+    details before it is stored.
+
+    Args:
+      kind: type of stage, such as "clean" or "aggregate".
+      name: name of stage, usually the name of the function.
+      data: input data, whose number of rows and columns is recorded.
+      verbose: print duration of stage once it has finished.
+
+    Raises:
+      MemoryBudgetError: if resident memory exceeds the budget of the stage,
+        or of an enclosing stage, while it runs.
+    """
+    record = {"kind": kind, "name": name, **tags, "pid": os.getpid()}
+    record["tid"] = threading.get_native_id()
+    record.update(_shape(data, "in"))
+    rss_start = rss_mb()
+    memory = None
+    if config.TRACK_MEMORY or config.MEMORY_BUDGETS:
+        memory = _enter_memory(record)
+    profiler = None
+    if config.PROFILE_STAGES and profiled(kind, name):
+        profiler = profiling.start()
+    record["start"] = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    process_cpu_start = time.process_time()
+    try:
+        yield record
+    except KeyboardInterrupt as e:
+        record["error"] = type(e).__name__
+        if not _breaches:
+            raise
+        frame, rss = _breaches.pop()
+        record["error"] = MemoryBudgetError.__name__
+        raise MemoryBudgetError(_budget_report(frame, rss)) from None
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["wall"] = time.perf_counter() - wall_start
+        record["cpu"] = time.thread_time() - cpu_start
+        record["process_cpu"] = time.process_time() - process_cpu_start
+        if profiler is not None:
+            record["profile"] = profiling.finish(profiler, record)
+        rss_end = rss_mb()
+        if rss_start is not None and rss_end is not None:
+            record["mem_delta_mb"] = rss_end - rss_start
+        if memory is not None:
+            _exit_memory(memory)
+        records.append(record)
+        if verbose:
+            print(f"Time for {name:30}: {format_duration(record['wall'])}")
+    # Peaks between two checks of the watchdog are caught here
+    if memory is not None and memory.budget is not None:
+        if memory.peak_rss > max(memory.budget, memory.peak_start):
+            record["error"] = MemoryBudgetError.__name__
+            raise MemoryBudgetError(_budget_report(memory, memory.peak_rss))
+
+
+def instrument(kind, verbose=False):
+    """Returns decorator that records metrics of each call of func.
+
+    The first argument of func is taken to be its input data, or, if it is
+    a string, the path it reads or writes.
+    """
+
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            data = args[0] if args else None
+            with stage(kind, func.__name__, data, verbose=verbose) as record:
+                if isinstance(data, str):
+                    record["path"] = data
+                result = func(*args, **kwargs)
+                record.update(_shape(result, "out"))
+            return result
+
+        # Gives wrappers of different funcs distinct names in profiles and
+        # tracebacks
+        wrapper.__code__ = wrapper.__code__.replace(co_name=f"{kind}.{func.__name__}")
+        return wrapper
+
+    return decorate
+
+
+def collect(func, *args, **kwargs):
+    """Calls func and returns its result and the records it added.
+
+    The records are removed from `records`. Used to return records from
+    worker processes, which don't share `records` with the parent.
+    """
+    start = len(records)
+    result = func(*args, **kwargs)
+    new = records[start:]
+    del records[start:]
+    return result, new
+
+
+def write_report(filepath, command, **info):
+    """Writes records of run to json file and clears them."""
+    report = {
+        "command": command,
+        "argv": sys.argv,
+        "host": platform.node(),
+        "written": datetime.datetime.now().isoformat(timespec="seconds"),
+        **info,
+        "stages": records,
+    }
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    with open(filepath, "w") as f:
+        json.dump(report, f, indent=1, default=str)
+    print(f"{filepath} written.")
+    write_trace(os.path.splitext(filepath)[0] + ".trace.json", records)
+    records.clear()
+
+
+# Fields of records that place spans rather than being shown as arguments
+_SPAN_KEYS = {"name", "kind", "start", "wall", "pid", "tid"}
+
+
+def trace_events(stages, main_pid=None):
+    """Returns stages as Chrome trace events.
+
+    Each process gets a row in the timeline, labelled main or worker in
+    order of their first stage, and each stage a span with its tags and
+    other metrics as arguments.
+
+    Args:
+      stages: metrics records.
+      main_pid: process id of the main process, current process by default.
+    """
+    if not stages:
+        return []
+    main_pid = main_pid or os.getpid()
+    origin = min(s["start"] for s in stages)
+    first_start = {}
+    for s in sorted(stages, key=lambda s: s["start"]):
+        first_start.setdefault(s["pid"], s["start"])
+    workers = [pid for pid in first_start if pid != main_pid]
+    names = {main_pid: "main", **{pid: f"worker {i}" for i, pid in enumerate(workers, 1)}}
+    events = []
+    for i, pid in enumerate([main_pid, *workers]):
+        events.append(
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": names[pid]}}
+        )
+        events.append(
+            {"name": "process_sort_index", "ph": "M", "pid": pid, "args": {"sort_index": i}}
+        )
+    for s in stages:
+        args = {k: v for k, v in s.items() if k not in _SPAN_KEYS}
+        events.append(
+            {
+                "name": s["name"],
+                "cat": s["kind"],
+                "ph": "X",
+                "ts": (s["start"] - origin) * 1e6,
+                "dur": s["wall"] * 1e6,
+                "pid": s["pid"],
+                "tid": s.get("tid", 0),
+                "args": args,
+            }
+        )
+    return events
+
+
+def write_trace(filepath, stages):
+    """Writes stages as Chrome trace event json file, which can be viewed
+    with https://ui.perfetto.dev or chrome://tracing."""
+    trace = {"traceEvents": trace_events(stages), "displayTimeUnit": "ms"}
+    with open(filepath, "w") as f:
+        json.dump(trace, f, default=str)
+    print(f"{filepath} written.")
+
+
+def report_path(command):
+    """Returns path of metrics report of run of command started now."""
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    return os.path.join(config.METRICS_DIR, f"{command}_{stamp}.json")
+
+
+def add_arguments(parser, example):
+    """Adds options to track memory, set memory budgets and profile stages
+    to parser of command.
+
+    Args:
+      parser: argument parser of command.
+      example: stage given as "kind.name" that help messages refer to.
+    """
+    kind = example.split(".")[0]
+    parser.add_argument(
+        "--track-memory",
+        action="store_true",
+        help="Record peak resident and allocated memory of each stage",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=config.parse_budget,
+        action="append",
+        default=[],
+        metavar="[STAGE=]MB",
+        help=f"Fail stage (e.g. {kind} or {example}) once resident memory "
+        "exceeds MB, can be repeated",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="main",
+        metavar="STAGES",
+        help=f"Profile whole run, or comma-separated stages such as {kind} or "
+        f"{example}, and write flame graphs next to the metrics report",
+    )
+
+
+def run_instrumented(command, args, func, info=None):
+    """Runs func as main stage of command and writes metrics report of run.
+
+    The report is written for failed runs too, to show where they failed.
+
+    Args:
+      command: name of command, such as "clean".
+      args: parsed arguments, including those added by `add_arguments`.
+      func: function of the run, called without arguments.
+      info: dict of details added to the report, which func can fill in as
+        it runs.
+    """
+    report = report_path(command)
+    configure_memory(args.track_memory, dict(args.memory_budget))
+    if args.profile:
+        profiles = os.path.splitext(report)[0] + "_profiles"
+        profiling.configure(args.profile.split(","), profiles)
+    try:
+        with stage("main", command, verbose=True):
+            return func()
+    finally:
+        write_report(report, command, **(info or {}))
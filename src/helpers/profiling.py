@@ -0,0 +1,189 @@
+"""
+Profiles of pipeline stages.
+
+Stages selected with `config.PROFILE_STAGES` are profiled with cProfile.
+Each profile is written to `config.PROFILE_DIR` as a pstats file, as folded
+stacks (read by flamegraph.pl and speedscope), as a speedscope json file,
+and as a summary of the functions with the most own time.
+
+cProfile records time per caller and callee rather than per stack, so
+stacks are reconstructed by splitting the time of each function across its
+callees in proportion to the time spent in each. This is exact for
+functions with a single caller and an approximation otherwise.
+
+"""
+
+import cProfile
+import collections
+import functools
+import io
+import itertools
+import json
+import os
+import pstats
+
+from src import config
+
+
+# Calls with less than this share of the time of a profile are counted as
+# time of their caller in flame graphs, which keeps them small
+MIN_STACK_SHARE = 1e-4
+MAX_STACK_DEPTH = 100
+
+_count = itertools.count()
+_active = []
+
+
+def configure(stages, directory):
+    """Selects stages to profile and sets directory profiles are written to.
+
+    Both are exported as MDB_PROFILE_STAGES and MDB_PROFILE_DIR, which
+    worker processes read in `config`.
+
+    Args:
+      stages: stages given as "kind.name", "kind" or "*".
+      directory: directory to write profiles to.
+    """
+    config.PROFILE_STAGES = list(stages)
+    config.PROFILE_DIR = directory
+    os.environ["MDB_PROFILE_STAGES"] = ",".join(stages)
+    os.environ["MDB_PROFILE_DIR"] = directory
+
+
+def start():
+    """Starts profiling and returns the profiler.
+
+    Returns None if a stage is already being profiled, as only one profiler
+    can be active at a time and profiles of enclosing stages include those
+    of nested ones. Only the thread that started the profiler is profiled.
+    """
+    if _active:
+        return None
+    profiler = cProfile.Profile()
+    _active.append(profiler)
+    profiler.enable()
+    return profiler
+
+
+def finish(profiler, record):
+    """Stops profiler and writes profile of stage, returns path of summary."""
+    profiler.disable()
+    _active.remove(profiler)
+    stats = pstats.Stats(profiler)
+    title = f"{record['kind']}.{record['name']}"
+    # Pieces are cleaned in one process each, other stages can run anywhere
+    if "piece" in record:
+        piece = os.path.splitext(record["piece"])[0]
+        filename = f"{title}_{piece}_{next(_count)}"
+        title += f" ({record['piece']})"
+    else:
+        filename = f"{title}_{os.getpid()}_{next(_count)}"
+    base = os.path.join(config.PROFILE_DIR, filename)
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    stats.dump_stats(base + ".prof")
+    stacks = fold(stats)
+    write_folded(stacks, base + ".folded")
+    write_speedscope(stacks, base + ".speedscope.json", title)
+    with open(base + ".txt", "w") as f:
+        f.write(summary(stats, title))
+    return base + ".txt"
+
+
+def fold(stats):
+    """Returns own time of each stack reconstructed from pstats stats."""
+    callees = collections.defaultdict(dict)
+    roots = []
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        if func[2].startswith("<method 'disable'"):
+            continue
+        if not callers:
+            roots.append(func)
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    stacks = collections.Counter()
+    min_seconds = MIN_STACK_SHARE * sum(stats.stats[root][3] for root in roots)
+
+    def visit(stack, seconds):
+        func = stack[-1]
+        # Time of recursive calls is left with the outermost call
+        edges = {
+            callee: edge_seconds
+            for callee, edge_seconds in callees[func].items()
+            if callee not in stack
+        }
+        # Time in callees of recursive functions can exceed their own
+        # cumulative time, as pstats counts it at each level of recursion
+        total = max(stats.stats[func][3], sum(edges.values()))
+        share = seconds / total if total else 0
+        in_callees = 0
+        for callee, edge_seconds in edges.items():
+            callee_seconds = edge_seconds * share
+            if callee_seconds < min_seconds or len(stack) >= MAX_STACK_DEPTH:
+                continue
+            in_callees += callee_seconds
+            visit(stack + (callee,), callee_seconds)
+        stacks[stack] += seconds - in_callees
+
+    for root in roots:
+        visit((root,), stats.stats[root][3])
+    return stacks
+
+
+@functools.lru_cache(maxsize=None)
+def _label(func):
+    """Returns name of function with its file, relative to the repo or the
+    installed packages."""
+    filename, line, name = func
+    if filename == "~":
+        return name
+    for prefix in (str(config.ROOTDIR) + os.sep, "site-packages" + os.sep):
+        if prefix in filename:
+            filename = filename.split(prefix, 1)[1]
+    return f"{name} ({filename}:{line})"
+
+
+def write_folded(stacks, filepath):
+    """Writes stacks as folded stacks with weights in microseconds."""
+    with open(filepath, "w") as f:
+        for stack, seconds in stacks.items():
+            labels = ";".join(_label(func) for func in stack)
+            f.write(f"{labels} {round(seconds * 1e6)}\n")
+
+
+def write_speedscope(stacks, filepath, name):
+    """Writes stacks as sampled profile in speedscope's file format."""
+    frames = {}
+    for stack in stacks:
+        for func in stack:
+            frames.setdefault(func, len(frames))
+    profile = {
+        "type": "sampled",
+        "name": name,
+        "unit": "seconds",
+        "startValue": 0,
+        "endValue": sum(stacks.values()),
+        "samples": [[frames[func] for func in stack] for stack in stacks],
+        "weights": list(stacks.values()),
+    }
+    shared = [
+        {"name": _label(func), "file": func[0], "line": func[1]} for func in frames
+    ]
+    document = {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": shared},
+        "profiles": [profile],
+        "name": name,
+        "exporter": "mdb_eval",
+    }
+    with open(filepath, "w") as f:
+        json.dump(document, f)
+
+
+def summary(stats, title, top=None):
+    """Returns table of functions with most own time, i.e. time not spent in
+    functions they called."""
+    out = io.StringIO()
+    print(f"Profile of {title}", file=out)
+    stats.stream = out
+    stats.sort_stats("tottime").print_stats(top or config.PROFILE_TOP)
+    return out.getvalue()
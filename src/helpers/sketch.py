@@ -0,0 +1,95 @@
+"""
+Mergeable quantile sketches.
+
+A sketch summarises the distribution of a column in logarithmically sized
+buckets (as in DDSketch), so that sketches of different pieces can be merged
+by adding bucket counts and quantiles of the merged sketch are within a
+relative error of alpha of the exact quantiles of all pieces combined.
+
+"""
+
+import collections
+
+import numpy as np
+
+from src import config
+
+
+class QuantileSketch:
+    """Quantile sketch with relative error guarantee.
+
+    Args:
+      alpha: relative accuracy. Quantiles returned by the sketch differ
+        from the exact order statistics by at most alpha times their
+        absolute value.
+      min_value: absolute values below min_value are counted as zeros.
+    """
+
+    def __init__(self, alpha=config.SKETCH_ALPHA, min_value=1e-9):
+        self.alpha = alpha
+        self.min_value = min_value
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.positive = collections.Counter()
+        self.negative = collections.Counter()
+        self.zeros = 0
+
+    @property
+    def count(self):
+        """Number of values added to sketch."""
+        return sum(self.positive.values()) + sum(self.negative.values()) + self.zeros
+
+    def _keys(self, values):
+        return np.ceil(np.log(values) / np.log(self.gamma)).astype("int64")
+
+    def _value(self, keys):
+        return 2 * self.gamma ** keys.astype("float64") / (self.gamma + 1)
+
+    def update(self, values):
+        """Adds non-missing values to sketch and returns sketch."""
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        large = np.abs(values) >= self.min_value
+        self.zeros += int(np.count_nonzero(~large))
+        for counter, side in [(self.positive, values > 0), (self.negative, values < 0)]:
+            keys, counts = np.unique(self._keys(np.abs(values[side & large])), return_counts=True)
+            counter.update(dict(zip(keys.tolist(), counts.tolist())))
+        return self
+
+    def merge(self, other):
+        """Adds bucket counts of other sketch to sketch and returns sketch."""
+        if (other.alpha, other.min_value) != (self.alpha, self.min_value):
+            raise ValueError("Can only merge sketches with the same parameters.")
+        self.positive.update(other.positive)
+        self.negative.update(other.negative)
+        self.zeros += other.zeros
+        return self
+
+    def quantile(self, pcts):
+        """Returns estimates of percentiles pcts of values added to sketch.
+
+        Like `np.nanpercentile`, percentiles are in [0, 100] and interpolate
+        linearly between adjacent order statistics. Returns missing values
+        for an empty sketch.
+        """
+        pcts = np.asarray(pcts, dtype="float64")
+        count = self.count
+        if not count:
+            return np.full(pcts.shape, np.nan)
+
+        neg_keys = np.array(sorted(self.negative, reverse=True), dtype="int64")
+        pos_keys = np.array(sorted(self.positive), dtype="int64")
+        values = np.concatenate([-self._value(neg_keys), [0.0], self._value(pos_keys)])
+        counts = np.concatenate(
+            [
+                [self.negative[k] for k in neg_keys],
+                [self.zeros],
+                [self.positive[k] for k in pos_keys],
+            ]
+        )
+        bounds = np.cumsum(counts)
+
+        rank = pcts / 100 * (count - 1)
+        lower = np.floor(rank)
+        a = values[np.searchsorted(bounds, lower, side="right")]
+        b = values[np.searchsorted(bounds, np.minimum(lower + 1, count - 1), side="right")]
+        return a + (b - a) * (rank - lower)
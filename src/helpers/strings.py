@@ -0,0 +1,57 @@
+"""
+String operations on categorical columns.
+
+Categorical columns have far fewer categories than rows, so each operation
+is applied once to each category and the result broadcast to rows through
+the category codes. Non-categorical columns fall back to the `.str`
+accessor.
+
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _is_categorical(series):
+    return isinstance(series.dtype, pd.CategoricalDtype)
+
+
+def broadcast(series, values, na):
+    """Returns values of the categories of series for each row.
+
+    Args:
+      series: categorical series.
+      values: array with one value for each category.
+      na: value for rows with missing values.
+    """
+    values = np.append(np.asarray(values), na)
+    return pd.Series(values[series.cat.codes.to_numpy()], index=series.index, name=series.name)
+
+
+def contains(series, pattern, na=False):
+    """Returns boolean series of whether regex pattern matches each value."""
+    if not _is_categorical(series):
+        return series.str.contains(pattern, na=na).astype(bool)
+    matches = series.cat.categories.str.contains(pattern, na=na)
+    return broadcast(series, np.asarray(matches, dtype=bool), na)
+
+
+def lower(series):
+    """Returns categorical series with lowercase values.
+
+    Categories that are equal once lowercased are merged, and categories
+    are sorted and limited to those that occur, as if the lowercase values
+    were cast to category.
+    """
+    if not _is_categorical(series):
+        return series.str.lower().astype("category")
+    codes = series.cat.codes.to_numpy()
+    ncats = len(series.cat.categories)
+    is_used = np.bincount(codes.astype("intp") + 1, minlength=ncats + 1)[1:] > 0
+    used = series.cat.categories[is_used]
+    used_codes, categories = pd.factorize(used.str.lower(), sort=True)
+    # New code of each old category, with a last element for missing values
+    new_codes = np.full(ncats + 1, -1, dtype=used_codes.dtype)
+    new_codes[:-1][is_used] = used_codes
+    values = pd.Categorical.from_codes(new_codes[codes], categories=categories)
+    return pd.Series(values, index=series.index, name=series.name)
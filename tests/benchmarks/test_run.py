@@ -0,0 +1,32 @@
+import benchmarks.run as br
+import src.config as config
+import src.data.aggregators as agg
+import src.data.clean as cl
+
+
+class TestRun(object):
+    def test_times_every_stage_offline(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(config, "BUILD_CACHE_DIR", str(tmp_path))
+        nspl_lookup = config.NSPL_LOOKUP
+        params = dict(users=40, txns_per_user=60, descriptions=50, merchants=20)
+        timings = br.run(params, repeat=1)
+        for func in cl.cleaner_funcs:
+            assert f"clean.{func.__name__}" in timings
+        for func in agg.aggregators:
+            assert f"aggregate.{func.__name__}" in timings
+        assert "transform.winsorise_upper" in timings
+        assert config.NSPL_LOOKUP == nspl_lookup
+        assert config.BUILD_CACHE_DIR == str(tmp_path)
+        assert not list(tmp_path.iterdir())
+
+    def test_compare_flags_regressions(self):
+        baseline = {"timings": {"a": 1.0, "b": 0.001}}
+        table = br.compare(baseline, {"a": 1.5, "b": 0.002}, tolerance=0.25)
+        assert table.regressed.tolist() == [True, False]
+        assert not table.unmatched.any()
+
+    def test_compare_flags_unmatched_stages(self):
+        baseline = {"timings": {"a": 1.0, "old": 1.0}}
+        table = br.compare(baseline, {"a": 1.0, "new": 1.0}, tolerance=0.25)
+        assert table.unmatched.to_dict() == {"a": False, "new": True, "old": True}
+        assert not table.regressed.any()
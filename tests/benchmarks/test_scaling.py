@@ -0,0 +1,51 @@
+import subprocess
+
+import pandas as pd
+
+import benchmarks.scaling as bs
+
+
+class TestScalingTable(object):
+    def test_speedup_relative_to_fewest_workers(self):
+        records = [
+            dict(stage="clean", scale=1, workers=w, rows=100, wall=wall, cpu=1.0)
+            for w, wall in [(4, 1.0), (1, 2.0), (2, 1.0)]
+        ]
+        table = bs.scaling_table(records).loc["clean"]
+        assert table.speedup.tolist() == [1.0, 2.0, 2.0]
+        assert table.efficiency.tolist() == [1.0, 1.0, 0.5]
+        assert table.rows_per_sec.tolist() == [50.0, 100.0, 100.0]
+
+
+class TestRunScale(object):
+    def test_keeps_outputs_in_root(self, tmp_path, monkeypatch):
+        envs = []
+
+        def measure(cmd, env, log):
+            envs.append(env)
+            return dict(wall=1.0, cpu=1.0, peak_rss_mb=1.0)
+
+        monkeypatch.setattr(bs, "make_dataset", lambda *args: ([], 0))
+        monkeypatch.setattr(bs, "measure", measure)
+        args = bs.parse_args([])
+        bs.run_scale(str(tmp_path), 1, [1], args, None)
+        for env in envs:
+            for var in ["MDB_CACHE_DIR", "MDB_BUILD_CACHE_DIR", "MDB_METRICS_DIR"]:
+                assert env[var].startswith(str(tmp_path))
+
+
+class TestMain(object):
+    def test_reports_failed_scales(self, tmp_path, monkeypatch, capsys):
+        def run_scale(root, scale, workers, args, log):
+            if scale < 1:
+                raise subprocess.CalledProcessError(1, ["make_data"])
+            return [
+                dict(stage="clean", scale=scale, workers=1, rows=100, wall=1.0, cpu=1.0)
+            ]
+
+        monkeypatch.setattr(bs, "run_scale", run_scale)
+        monkeypatch.setattr(bs, "plot_speedup", lambda table, filepath: None)
+        bs.main(["--scales", "0.1", "1", "-o", str(tmp_path)])
+        assert "Scale 0.1 failed" in capsys.readouterr().out
+        table = pd.read_csv(tmp_path / "scaling.csv")
+        assert table.scale.tolist() == [1]
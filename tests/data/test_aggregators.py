@@ -1,7 +1,87 @@
+import time
+
+import pandas as pd
 import pytest
 
+import src.data.aggregators as agg
+
 
 class TestTimeToTreatment(object):
 
     def basic_test_succeeds(self):
         pass
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Registers aggregators and intermediates of a test in copies of the
+    module registries, which are restored after the test."""
+    monkeypatch.setattr(agg, "registry", dict(agg.registry))
+    monkeypatch.setattr(agg, "aggregators", list(agg.aggregators))
+    return agg.registry
+
+
+class TestResultCache(object):
+    def test_required_results_are_computed_once(self, registry):
+        calls = []
+
+        @agg.intermediate
+        def shared(df, g):
+            calls.append("shared")
+            return df.amount
+
+        @agg.intermediate(requires=["shared"])
+        def first(df, g, shared):
+            return shared + 1
+
+        @agg.intermediate(requires=["shared"])
+        def second(df, g, shared):
+            return shared + 2
+
+        df = pd.DataFrame(
+            {"user_id": [1], "ym": pd.PeriodIndex(["2020-01"], freq="M"), "amount": [1]}
+        )
+        cache = agg.ResultCache(df)
+        assert cache.get("first").tolist() == [2]
+        assert cache.get("second").tolist() == [3]
+        assert calls == ["shared"]
+        cache.clear()
+        assert cache.results == {}
+
+    def test_threads_share_results_and_keep_order(self, registry):
+        calls = []
+
+        @agg.intermediate
+        def slow(df, g):
+            calls.append("slow")
+            time.sleep(0.05)
+            return df.amount
+
+        @agg.intermediate(requires=["slow"])
+        def plus_one(df, g, slow):
+            return slow + 1
+
+        @agg.intermediate(requires=["slow"])
+        def plus_two(df, g, slow):
+            return slow + 2
+
+        df = pd.DataFrame(
+            {"user_id": [1], "ym": pd.PeriodIndex(["2020-01"], freq="M"), "amount": [1]}
+        )
+        cache = agg.ResultCache(df)
+        results = cache.get_all(["plus_two", "plus_one", "slow"], threads=3)
+        assert [r.tolist() for r in results] == [[3], [2], [1]]
+        assert calls == ["slow"]
+
+    def test_circular_dependency_raises(self, registry):
+        @agg.intermediate(requires=["egg"])
+        def chicken(df, g, egg):
+            return egg
+
+        @agg.intermediate(requires=["chicken"])
+        def egg(df, g, chicken):
+            return chicken
+
+        df = pd.DataFrame({"user_id": [1], "ym": pd.PeriodIndex(["2020-01"], freq="M")})
+        with pytest.raises(ValueError, match="Circular"):
+            agg.ResultCache(df).get("chicken")
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from src import config
+import src.data.build_cache as bc
+import src.data.selectors as sl
+
+
+class TestBuildCache(object):
+    def test_roundtrip(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(config, "BUILD_CACHE_DIR", str(tmp_path))
+        df = pd.DataFrame({"a": [1, 2]})
+        key = bc.make_key("piece", bc.source_hash(sl))
+        assert bc.load("select", key) is None
+        bc.save("select", key, df, {"n@users": 2})
+        cached, meta = bc.load("select", key)
+        assert cached.equals(df) and meta == {"n@users": 2}
+
+    def test_key_depends_on_all_parts(self):
+        assert bc.make_key("a", "bc") != bc.make_key("ab", "c")
@@ -0,0 +1,221 @@
+import collections
+import os
+import warnings
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+import src.data.clean as cl
+import src.helpers.metrics as metrics
+
+
+class TestTagLookups(object):
+    def test_known_conflicts(self):
+        assert cl.TAG_LOOKUP.conflicts == {
+            "payday loan funds": ["finance", "other_income"],
+            "rewards/cashback": ["finance", "other_income"],
+        }
+        assert cl.TAG_GROUP_LOOKUP.conflicts == {}
+        assert cl.TAG_SPEND_LOOKUP.conflicts == {}
+
+    def test_warns_about_unaccepted_conflicts(self):
+        groupings = [{"spend": ["isa", "coffee"]}, {"savings": ["isa"]}]
+        with pytest.warns(UserWarning, match=r"isa \(spend, savings\)"):
+            lookup = cl._compile_grouping(*groupings)
+        assert lookup.mapping["isa"] == "savings"
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            cl._compile_grouping(*groupings, accepted=["isa"])
+
+    def test_apply_grouping_uses_last_group(self):
+        df = pd.DataFrame(
+            {"tag_auto": pd.Categorical(["rewards/cashback", None, "salary", "isa"])}
+        )
+        cl._apply_grouping(df, "tag", cl.TAG_LOOKUP)
+        assert df.tag.tolist()[0] == "other_income"
+        assert pd.isna(df.tag[1]) and pd.isna(df.tag[2])
+        assert df.tag[3] == "savings"
+
+
+class TestAddRegion(object):
+    @pytest.fixture
+    def lookup(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(cl.config, "BUILD_CACHE_DIR", str(tmp_path / "build"))
+        monkeypatch.setattr(cl.config, "NSPL_LOOKUP", str(tmp_path / "lookup.csv"))
+        pd.DataFrame(
+            {
+                "pcsector": ["ab1 1", "ab1 2", "ab1 3"],
+                "region_name": ["wales", None, "london"],
+                "is_urban": [0.0, 1.0, 1.0],
+                "pop": [1, 2, 3],
+            }
+        ).to_csv(cl.config.NSPL_LOOKUP, index=False)
+        cl._read_regions.cache_clear()
+        yield
+        cl._read_regions.cache_clear()
+
+    def test_matches_merge(self, lookup):
+        postcodes = ["ab1 3", None, "zz9 9", "ab1 2", "ab1 3", "ab1 1"]
+        df = pd.DataFrame({"postcode": pd.Categorical(postcodes)}, index=[5, 4, 3, 2, 1, 0])
+        regions = pd.read_csv(cl.config.NSPL_LOOKUP, usecols=[0, 1, 2])
+        expected = df.merge(regions.rename(columns={"pcsector": "postcode"}), how="left")
+        result = cl.add_region(df).reset_index(drop=True)
+        pd.testing.assert_frame_equal(
+            result.astype({"postcode": object}), expected.astype({"postcode": object})
+        )
+
+    def test_reads_cached_index(self, lookup):
+        regions = cl._read_regions()
+        cl._read_regions.cache_clear()
+        with mock.patch.object(cl.io, "read_csv") as read_csv:
+            pd.testing.assert_frame_equal(cl._read_regions(), regions)
+        read_csv.assert_not_called()
+
+
+class TestDropDuplicates(object):
+    def test_counts_dropped_txns_per_user(self, monkeypatch):
+        monkeypatch.setattr(cl, "duplicate_counts", collections.Counter())
+        df = pd.DataFrame(
+            {
+                "user_id": [1, 2, 1, 1, 2],
+                "account_id": [1, 2, 1, 1, 2],
+                "date": pd.to_datetime(["2020-01-01"] * 5),
+                "amount": [1.0, 2.0, 1.0, 1.0, 3.0],
+                "desc": pd.Categorical(["a", "b", "a", "a", "b"]),
+            }
+        )
+        assert cl.drop_duplicates(df, None).tolist() == [0, 1, 4]
+        assert cl.duplicate_counts == {1: 2}
+        # Only selected rows are compared
+        assert cl.drop_duplicates(df, np.array([3, 4, 0])).tolist() == [3, 4]
+        assert cl.duplicate_counts == {1: 3}
+
+
+class TestSortTxns(object):
+    def make_frame(self, n=1000, seed=0):
+        rng = np.random.default_rng(seed)
+        dates = pd.to_datetime("2020-01-01") + pd.to_timedelta(rng.integers(0, 30, n), "D")
+        return pd.DataFrame(
+            {
+                "user_id": np.sort(rng.integers(0, 20, n)).astype("int32"),
+                "date": dates.where(rng.random(n) > 0.05),
+                "amount": np.arange(n, dtype="float32"),
+            }
+        )
+
+    @pytest.mark.parametrize("seed", range(3))
+    def test_matches_sort_values(self, seed):
+        df = self.make_frame(seed=seed)
+        rng = np.random.default_rng(seed)
+        # Grouped by user, sorted but for one block, and shuffled
+        partly = df.sort_values(["user_id", "date"])
+        partly.iloc[100:200] = partly.iloc[100:200].sample(frac=1, random_state=seed).to_numpy()
+        for unsorted in [df, partly, df.iloc[rng.permutation(len(df))]]:
+            expected = unsorted.sort_values(["user_id", "date"])
+            positions = cl.sorted_positions(unsorted, cl.SORT_ORDER)
+            pd.testing.assert_frame_equal(unsorted.take(positions), expected)
+        rows = rng.permutation(len(df))[:500]
+        expected = df.take(rows).sort_values(["user_id", "date"])
+        pd.testing.assert_frame_equal(df.take(cl.sort_txns(df, rows)), expected)
+
+    def test_sorted_frame_is_not_copied(self):
+        df = self.make_frame().sort_values(["user_id", "date"])
+        for col in ["user_female", "tag_spend", "tag_group", "merchant", "desc"]:
+            df[col] = "a"
+        assert cl.sorted_positions(df, cl.SORT_ORDER) is None
+        assert cl.sort_txns(df, None) is None
+        result = cl.order_columns(df)
+        assert result.columns.tolist() == [
+            "date",
+            "user_id",
+            "amount",
+            "desc",
+            "merchant",
+            "tag_group",
+            "tag_spend",
+            "user_female",
+        ]
+        assert np.shares_memory(result.amount.to_numpy(), df.amount.to_numpy())
+
+
+class TestCleanData(object):
+    def test_applies_rows_once(self, monkeypatch):
+        monkeypatch.setattr(cl, "cleaner_funcs", [])
+
+        @cl.cleaner(reads=["a"], rows=True)
+        def drop_odd(df, rows):
+            return cl._select(rows, df.a.to_numpy() % 2 == 0)
+
+        @cl.cleaner(reads=["a"], writes=["b"])
+        def add_b(df):
+            df["b"] = df.a * 2
+            return df
+
+        @cl.cleaner(rows=True)
+        def reverse(df, rows):
+            return rows[::-1]
+
+        df = pd.DataFrame({"a": np.arange(6), "c": np.arange(6.0)})
+        result = cl.clean_data(df)
+        assert result.a.tolist() == [4, 2, 0]
+        assert result.b.tolist() == [8, 4, 0]
+        assert result.index.tolist() == [0, 1, 2]
+        assert metrics.records[-1]["copied_by"] == ["take"]
+        assert metrics.records[-1]["copies"] == 1
+
+    def test_raises_on_copies(self, monkeypatch):
+        monkeypatch.setattr(cl, "cleaner_funcs", [])
+
+        @cl.cleaner
+        def copy(df):
+            return df.copy()
+
+        @cl.cleaner
+        def copy_again(df):
+            return df.copy()
+
+        with pytest.raises(RuntimeError, match="by copy, copy_again"):
+            cl.clean_data(pd.DataFrame({"a": np.arange(6)}))
+        assert metrics.records[-1]["copies"] == 2
+
+    def test_raises_on_missing_reads(self, monkeypatch):
+        monkeypatch.setattr(cl, "cleaner_funcs", [])
+        cl.cleaner(reads=["b"])(lambda df: df)
+        with pytest.raises(KeyError):
+            cl.clean_data(pd.DataFrame({"a": [1]}))
+
+
+class TestCleanStreaming(object):
+    @pytest.fixture(autouse=True)
+    def no_cleaning(self, monkeypatch):
+        monkeypatch.setattr(cl, "clean_data", lambda df: df)
+
+    def write_raw(self, path, users):
+        df = pd.DataFrame({"User.Reference": users, "amount": np.arange(len(users))})
+        df.to_parquet(path, index=False)
+        return str(path)
+
+    def test_skips_empty_batches(self):
+        df = pd.DataFrame({"User.Reference": [1, 1, 2]})
+        batches = [pa.RecordBatch.from_pandas(part) for part in (df, df.iloc[:0])]
+        frames = list(cl.iter_user_batches(batches))
+        assert [frame["User.Reference"].tolist() for frame in frames] == [[1, 1], [2]]
+
+    def test_failed_piece_keeps_previous_clean_piece(self, tmp_path):
+        fp_clean = str(tmp_path / "clean.parquet")
+        self.write_raw(fp_clean, [9])
+        raw = self.write_raw(tmp_path / "raw.parquet", [1, 1, 2, 2, 1, 1])
+        with pytest.raises(ValueError, match="not grouped by user"):
+            cl.clean_streaming(raw, fp_clean, batch_rows=2)
+        assert pd.read_parquet(fp_clean)["User.Reference"].tolist() == [9]
+        assert sorted(os.listdir(tmp_path)) == ["clean.parquet", "raw.parquet"]
+
+    def test_empty_piece_is_written(self, tmp_path):
+        fp_clean = str(tmp_path / "clean.parquet")
+        raw = self.write_raw(tmp_path / "raw.parquet", [])
+        cl.clean_streaming(raw, fp_clean, batch_rows=2)
+        result = pd.read_parquet(fp_clean)
+        assert result.empty and result.columns.tolist() == ["User.Reference", "amount"]
@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+
+import src.data.flags as fl
+
+
+class TestFlags(object):
+    def test_flags_match_string_comparisons(self):
+        df = pd.DataFrame(
+            {
+                "is_debit": [True, False, True, True],
+                "tag_auto": pd.Categorical(["groceries", "payday loan", np.nan, "cinema"]),
+                "tag_up": ["savings", "no tag", np.nan, "saving (general)"],
+            }
+        )
+        flags = fl.compute(df.reindex(columns=fl.input_columns()))
+        assert flags.dtype == "uint32"
+        is_dspend = fl.mask(flags, "dspend", "debit")
+        assert is_dspend.tolist() == [True, False, False, True]
+        is_loan_fund = fl.mask(flags, "loan_funds", unset=["debit"])
+        assert is_loan_fund.tolist() == [False, True, False, False]
+        assert fl.mask(flags, "saving_tag").tolist() == [True, False, False, True]
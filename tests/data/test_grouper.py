@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.grouper import Grouper
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame(
+        {
+            "user_id": [2, 1, 1, 2, 1, 2],
+            "ym": pd.PeriodIndex(
+                ["2020-02", "2020-01", "2020-01", "2020-02", "2020-03", "2020-01"],
+                freq="M",
+            ),
+            "amount": [1.0, np.nan, 3.0, 4.0, 5.0, 6.0],
+            "account_id": [10, 11, 12, 10, 11, 13],
+        }
+    )
+
+
+class TestGrouper(object):
+    def test_reductions_match_pandas_groupby(self, df):
+        g = Grouper(df)
+        expected = df.groupby(["user_id", "ym"]).amount
+        pd.testing.assert_index_equal(g.index, expected.sum().index)
+        assert g.sum(df.amount).tolist() == expected.sum().tolist()
+        assert g.count(df.amount).tolist() == expected.count().tolist()
+        assert g.first(df.amount).tolist() == expected.first().tolist()
+        assert g.max(df.amount).tolist() == expected.max().tolist()
+
+    def test_nunique_by_level_is_broadcast_to_groups(self, df):
+        g = Grouper(df)
+        assert g.nunique(df.account_id).tolist() == [2, 1, 1, 1]
+        assert g.nunique(df.account_id, level="user_id").tolist() == [2, 2, 2, 2]
+
+    def test_reductions_of_empty_piece(self, df):
+        empty = df.iloc[:0]
+        g = Grouper(empty)
+        assert g.ngroups == 0
+        for result in [
+            g.sum(empty.amount),
+            g.mean(empty.amount),
+            g.max(empty.amount),
+            g.first(empty.amount),
+            g.nunique(empty.account_id),
+        ]:
+            assert result.empty
+            assert result.index.equals(g.index)
+        assert g.max(empty.amount).dtype == "float64"
+
+    def test_rows_with_missing_keys_are_dropped(self, df):
+        df.loc[[1, 3], "ym"] = pd.NaT
+        g = Grouper(df)
+        expected = df.groupby(["user_id", "ym"]).amount
+        pd.testing.assert_index_equal(g.index, expected.sum().index)
+        assert g.size().tolist() == expected.size().tolist()
+        assert g.sum(df.amount).tolist() == expected.sum().tolist()
+        assert g.mean(df.amount).tolist() == expected.mean().tolist()
+        assert g.first(df.amount).tolist() == expected.first().tolist()
+        assert g.max(df.amount).tolist() == expected.max().tolist()
+        assert g.nunique(df.account_id).tolist() == [1, 1, 1, 1]
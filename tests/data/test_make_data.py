@@ -0,0 +1,36 @@
+import os
+
+import pandas as pd
+import pytest
+
+import src.data.make_data as md
+
+
+class TestTransformPieces(object):
+    @pytest.fixture
+    def pieces(self, tmp_path):
+        paths = []
+        for i in range(2):
+            paths.append(str(tmp_path / f"piece_{i}.parquet"))
+            pd.DataFrame({"user_id": [i], "amount": [1.0]}).to_parquet(paths[-1])
+        return paths
+
+    def test_failed_piece_keeps_previous_output(self, pieces, tmp_path, monkeypatch):
+        output = str(tmp_path / "analysis.parquet")
+        pd.DataFrame({"user_id": [9]}).to_parquet(output)
+
+        def transform_variables(df):
+            if df.user_id.iloc[0] == 1:
+                raise ValueError("Invalid piece.")
+            return df
+
+        monkeypatch.setattr(md, "transform_variables", transform_variables)
+        monkeypatch.setattr(md, "validate_data", lambda df: df)
+        with pytest.raises(ValueError, match="Invalid piece"):
+            md.transform_pieces(pieces, output)
+        assert pd.read_parquet(output).user_id.tolist() == [9]
+        assert not [fp for fp in os.listdir(tmp_path) if fp.endswith(".tmp")]
+
+    def test_raises_without_pieces(self, tmp_path):
+        with pytest.raises(ValueError, match="No clean pieces"):
+            md.transform_pieces([], str(tmp_path / "analysis.parquet"))
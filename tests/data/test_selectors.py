@@ -0,0 +1,43 @@
+import types
+
+import pandas as pd
+
+import src.data.selectors as sl
+
+
+class TestSelect(object):
+    def test_counts_follow_cumulative_masks(self):
+        df = pd.DataFrame(
+            {
+                "user_id": [1, 1, 2, 3],
+                "txns_count": [10, 20, 5, 30],
+                "txns_volume": [1e6, 2e6, 1e6, 1e6],
+                "month_spend": [300, 250, 400, 100],
+            }
+        )
+        funcs = [sl.add_raw_count, sl.month_min_txns, sl.month_min_spend]
+        sl.sample_counts.clear()
+        selected = sl.select(df, funcs)
+        assert selected.user_id.tolist() == [1, 1]
+        assert sl.sample_counts["Raw sample@user_months"] == 4
+        assert sl.sample_counts["At least 10 txns each month@users"] == 2
+        assert sl.sample_counts["At least \\pounds200 of monthly spend@txns"] == 30
+        assert sl.sample_counts["At least \\pounds200 of monthly spend@txns_volume"] == 3
+        sl.sample_counts.clear()
+
+
+class TestPreAndPostSignupData(object):
+    def test_window_requires_unbroken_months(self):
+        df = pd.DataFrame(
+            {
+                "user_id": [1, 1, 1, 1, 2, 2, 2],
+                "tt": [-2, -1, 0, 1, -2, 0, 1],
+                "txns_count": 1,
+                "txns_volume": 1,
+            }
+        )
+        users = sl.user_summary(df, [types.SimpleNamespace(summary=sl.SIGNUP_RUNS)])
+        assert users.pre_signup_months.tolist() == [2, 0]
+        assert users.post_signup_months.tolist() == [2, 2]
+        assert sl.pre_and_post_signup_data(users, 2, 2).tolist() == [True, False]
+        assert sl.pre_and_post_signup_data(users, 0, 2).tolist() == [True, True]
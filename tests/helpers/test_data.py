@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.helpers.data as hd
+
+
+class TestWinsoriseBlock:
+    @pytest.fixture
+    def df(self):
+        rng = np.random.default_rng(0)
+        a = rng.normal(size=200).astype("float32")
+        a[::7] = np.nan
+        return pd.DataFrame(
+            {
+                "a": a,
+                "b": rng.normal(size=200),
+                "c": rng.integers(-50, 50, size=200),
+                "d": np.arange(200),
+                "e": ["x"] * 200,
+            }
+        )
+
+    @pytest.mark.parametrize("how", ["both", "lower", "upper"])
+    def test_matches_winsorise(self, df, how):
+        cols = ["a", "b", "c", "d"]
+        expected = df.copy()
+        expected[cols] = expected[cols].apply(hd.winsorise, pct=3, how=how)
+        expected["a"] = expected.a.astype("float32")
+        report = hd.winsorise_block(df, cols, pct=3, how=how)
+        pd.testing.assert_frame_equal(df, expected)
+        assert report.index.tolist() == cols
+        assert report.n.tolist() == [171, 200, 200, 200]
+
+    def test_thresholds_match_nanpercentile(self, df):
+        expected = np.nanpercentile(df.a, [2, 98])
+        report = hd.winsorise_block(df, ["a"], pct=2)
+        np.testing.assert_allclose(report.loc["a", ["lower", "upper"]], expected)
+
+    @pytest.mark.filterwarnings("error")
+    def test_all_missing_column_is_left_unchanged(self, df):
+        df["a"] = np.nan
+        report = hd.winsorise_block(df, ["a"], pct=2, how="upper")
+        assert df.a.isna().all() and report.n.tolist() == [0]
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+import src.helpers.fingerprints as fp
+
+
+def make_frame():
+    return pd.DataFrame(
+        {
+            "user_id": [1, 1, 2, 1, 1, 1, 1],
+            "date": pd.to_datetime(["2020-01-01"] * 6 + [None]),
+            "amount": [0.0, -0.0, 0.0, np.nan, np.nan, 1.5, 1.5],
+            "desc": pd.Categorical(["a", "a", "a", None, None, "b", "b"]),
+        }
+    )
+
+
+class TestDuplicated(object):
+    def test_matches_pandas(self):
+        df = make_frame()
+        cols = ["user_id", "date", "amount", "desc"]
+        result = fp.duplicated(df, cols)
+        np.testing.assert_array_equal(result, df.duplicated(cols).to_numpy())
+        assert result.tolist() == [False, True, False, False, True, False, False]
+
+    def test_shared_fingerprints_are_checked(self, monkeypatch):
+        monkeypatch.setattr(fp, "fingerprint", lambda columns: np.zeros(len(columns[0]), "uint64"))
+        df = make_frame()
+        cols = ["user_id", "desc"]
+        np.testing.assert_array_equal(fp.duplicated(df, cols), df.duplicated(cols).to_numpy())
+
+    def test_shared_fingerprints_of_selected_rows_are_checked(self, monkeypatch):
+        monkeypatch.setattr(fp, "fingerprint", lambda columns: np.zeros(len(columns[0]), "uint64"))
+        df = make_frame()
+        cols = ["user_id", "desc"]
+        rows = np.array([3, 4, 0, 1])
+        expected = df.take(rows).duplicated(cols).to_numpy()
+        np.testing.assert_array_equal(fp.duplicated(df, cols, rows), expected)
+        assert expected.tolist() == [False, True, False, True]
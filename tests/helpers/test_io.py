@@ -0,0 +1,123 @@
+import concurrent.futures
+import multiprocessing
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from src import config
+import src.helpers.io as io
+
+
+class FakeS3FileSystem(object):
+    """Serves s3://bucket/<name> from a local directory."""
+
+    root = None
+    gets = []
+
+    def __init__(self, profile=None):
+        pass
+
+    def _local(self, path):
+        return os.path.join(self.root, path.replace("s3://bucket/", ""))
+
+    def info(self, path):
+        size = os.path.getsize(self._local(path))
+        return {"type": "file", "size": size, "ETag": str(size)}
+
+    def get(self, path, local_path):
+        self.gets.append(path)
+        shutil.copy(self._local(path), local_path)
+
+
+@pytest.fixture
+def s3(tmp_path, monkeypatch):
+    (tmp_path / "s3").mkdir()
+    FakeS3FileSystem.root = str(tmp_path / "s3")
+    FakeS3FileSystem.gets = []
+    monkeypatch.setattr(io.s3fs, "S3FileSystem", FakeS3FileSystem)
+    monkeypatch.setattr(config, "CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(config, "OFFLINE", False)
+    return tmp_path / "s3"
+
+
+class TestCachedPath(object):
+    def test_downloads_only_changed_objects(self, s3):
+        pd.DataFrame({"a": [1]}).to_csv(s3 / "x.csv", index=False)
+        assert io.read_csv("s3://bucket/x.csv").a.tolist() == [1]
+        assert io.read_csv("s3://bucket/x.csv").a.tolist() == [1]
+        pd.DataFrame({"a": [10]}).to_csv(s3 / "x.csv", index=False)
+        assert io.read_csv("s3://bucket/x.csv").a.tolist() == [10]
+        assert len(FakeS3FileSystem.gets) == 2
+
+    def test_offline_serves_latest_copy(self, s3, monkeypatch):
+        pd.DataFrame({"a": [1]}).to_csv(s3 / "x.csv", index=False)
+        io.read_csv("s3://bucket/x.csv")
+        monkeypatch.setattr(config, "OFFLINE", True)
+        assert io.read_csv("s3://bucket/x.csv").a.tolist() == [1]
+        with pytest.raises(FileNotFoundError):
+            io.read_csv("s3://bucket/y.csv")
+
+    def test_evicts_least_recently_used(self, s3, monkeypatch):
+        for name in ["x", "y"]:
+            pd.DataFrame({"a": range(100)}).to_csv(s3 / f"{name}.csv", index=False)
+        monkeypatch.setattr(config, "CACHE_MAX_BYTES", 500)
+        x = io.cached_path("s3://bucket/x.csv")
+        os.utime(x, (0, 0))
+        y = io.cached_path("s3://bucket/y.csv")
+        assert not os.path.exists(x) and os.path.exists(y)
+
+    def test_keeps_files_other_processes_use(self, s3, monkeypatch):
+        for name in ["x", "y"]:
+            pd.DataFrame({"a": range(100)}).to_csv(s3 / f"{name}.csv", index=False)
+        monkeypatch.setattr(config, "CACHE_MAX_BYTES", 500)
+        x = io.cached_path("s3://bucket/x.csv")
+        # Another process resolves y, which puts the cache over budget,
+        # before this one reads x
+        context = multiprocessing.get_context("fork")
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+            y = executor.submit(io.cached_path, "s3://bucket/y.csv").result()
+        assert os.path.exists(y)
+        assert pd.read_csv(x).a.tolist() == list(range(100))
+
+
+class TestMetadata(object):
+    def test_roundtrip(self, tmp_path):
+        fp = str(tmp_path / "piece.parquet")
+        df = pd.DataFrame({"a": [1, 2], "b": pd.Categorical(["x", "y"])})
+        io.write_parquet(df, fp, metadata={"sort_order": ["a"]}, verbose=False)
+        assert io.read_metadata(fp) == {"sort_order": ["a"]}
+        pd.testing.assert_frame_equal(io.read_parquet(fp), df)
+        io.write_parquet(df, fp, verbose=False)
+        assert io.read_metadata(fp) == {}
+
+
+class TestAppendSchema(object):
+    def test_appends_tables_with_different_categories(self, tmp_path):
+        fp = str(tmp_path / "data.parquet")
+        first = pd.DataFrame({"a": pd.Categorical(["x"], ordered=True), "b": [None]})
+        second = pd.DataFrame({"a": pd.Categorical(["y"], ordered=True), "b": ["z"]})
+        tables = [pa.Table.from_pandas(df, preserve_index=False) for df in (first, second)]
+        schema = io.append_schema(tables[0])
+        with io.parquet_writer(fp, schema) as writer:
+            for table in tables:
+                writer.write_table(table.cast(schema))
+        result = io.read_parquet(fp)
+        assert result.a.tolist() == ["x", "y"] and result.a.cat.ordered
+        assert result.b.tolist() == [None, "z"]
+
+
+class TestParquetWriter(object):
+    def test_failed_write_keeps_previous_file(self, tmp_path):
+        fp = str(tmp_path / "data.parquet")
+        df = pd.DataFrame({"a": [1, 2]})
+        io.write_parquet(df, fp, verbose=False)
+        table = pa.Table.from_pandas(df.iloc[:1], preserve_index=False)
+        with pytest.raises(ValueError):
+            with io.parquet_writer(fp, table.schema) as writer:
+                writer.write_table(table)
+                raise ValueError
+        pd.testing.assert_frame_equal(io.read_parquet(fp), df)
+        assert os.listdir(tmp_path) == ["data.parquet"]
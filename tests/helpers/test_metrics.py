@@ -0,0 +1,181 @@
+import argparse
+import importlib
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import src.helpers.metrics as metrics
+
+
+class TestInstrument(object):
+    def test_records_shapes_and_tags(self):
+        @metrics.instrument("clean")
+        def drop_first(df):
+            return df.iloc[1:, :1]
+
+        df = pd.DataFrame({"a": [1, 2, 3], "b": [4, 5, 6]})
+        with metrics.tagged(piece="mdb_XX0.parquet"):
+            _, records = metrics.collect(drop_first, df)
+        [record] = records
+        assert record["kind"] == "clean" and record["name"] == "drop_first"
+        assert record["piece"] == "mdb_XX0.parquet"
+        assert (record["rows_in"], record["cols_in"]) == (3, 2)
+        assert (record["rows_out"], record["cols_out"]) == (2, 1)
+        assert record["wall"] >= 0 and record["cpu"] >= 0
+        assert metrics.tags == {}
+
+    def test_cpu_excludes_other_threads(self):
+        def spin():
+            deadline = time.perf_counter() + 0.3
+            while time.perf_counter() < deadline:
+                pass
+
+        with metrics.stage("aggregate", "wait") as record:
+            thread = threading.Thread(target=spin)
+            thread.start()
+            thread.join()
+        metrics.records.pop()
+        assert record["cpu"] < 0.1 < record["process_cpu"]
+
+    def test_write_report(self, tmp_path):
+        metrics.records.clear()
+        with metrics.stage("main", "run"):
+            pass
+        fp = tmp_path / "report.json"
+        metrics.write_report(str(fp), "test", workers=2)
+        report = json.loads(fp.read_text())
+        assert report["workers"] == 2
+        assert [s["name"] for s in report["stages"]] == ["run"]
+        assert metrics.records == []
+        trace = json.loads((tmp_path / "report.trace.json").read_text())
+        assert [e["name"] for e in trace["traceEvents"] if e["ph"] == "X"] == ["run"]
+
+    def test_trace_events(self):
+        stages = [
+            {"kind": "main", "name": "run", "pid": 1, "tid": 1, "start": 10.0, "wall": 3.0},
+            {"kind": "clean", "name": "a", "pid": 3, "tid": 3, "start": 11.0, "wall": 1.0},
+            {"kind": "clean", "name": "b", "pid": 2, "tid": 2, "start": 10.5, "wall": 0.5},
+        ]
+        stages[1]["piece"] = "mdb_XX1.parquet"
+        events = metrics.trace_events(stages, main_pid=1)
+        names = {e["pid"]: e["args"]["name"] for e in events if e["name"] == "process_name"}
+        assert names == {1: "main", 2: "worker 1", 3: "worker 2"}
+        spans = {e["name"]: e for e in events if e["ph"] == "X"}
+        assert (spans["a"]["ts"], spans["a"]["dur"]) == (1e6, 1e6)
+        assert spans["a"]["args"] == {"piece": "mdb_XX1.parquet"}
+
+
+class TestMemory(object):
+    def test_records_peaks(self, monkeypatch):
+        monkeypatch.setattr(metrics.config, "TRACK_MEMORY", True)
+
+        @metrics.instrument("aggregate")
+        def allocate():
+            return np.ones(2**20).sum()
+
+        try:
+            _, [record] = metrics.collect(allocate)
+        finally:
+            tracemalloc.stop()
+        assert record["alloc_peak_mb"] >= 8
+        assert record["peak_rss_mb"] > 0
+
+    def test_budget_raises(self, monkeypatch):
+        if not metrics._reset_peak_rss():
+            pytest.skip("Peak resident memory can't be reset on this platform.")
+        monkeypatch.setattr(metrics.config, "MEMORY_BUDGETS", {"aggregate": 1})
+        monkeypatch.setattr(metrics, "_start_watchdog", lambda: None)
+
+        @metrics.instrument("aggregate")
+        def allocate():
+            return np.ones(2**20).sum()
+
+        with pytest.raises(metrics.MemoryBudgetError, match="aggregate.allocate"):
+            metrics.collect(allocate)
+        assert metrics.records.pop()["error"] == "MemoryBudgetError"
+
+    def test_budgets_from_environment(self, monkeypatch):
+        monkeypatch.setenv("MDB_MEMORY_BUDGETS", "4000,aggregate=500")
+        try:
+            importlib.reload(metrics.config)
+            assert metrics.config.MEMORY_BUDGETS == {"*": 4000.0, "aggregate": 500.0}
+        finally:
+            monkeypatch.delenv("MDB_MEMORY_BUDGETS")
+            importlib.reload(metrics.config)
+
+    def test_budget_raises_without_peak_reset(self, monkeypatch):
+        # As on macOS, only the peak of the process is known
+        peaks = iter([50, 200])
+        monkeypatch.setattr(metrics, "_reset_peak_rss", lambda: False)
+        monkeypatch.setattr(metrics, "rss_mb", lambda: None)
+        monkeypatch.setattr(metrics, "peak_rss_mb", lambda: next(peaks))
+        monkeypatch.setattr(metrics, "_start_watchdog", lambda: None)
+        monkeypatch.setattr(metrics.config, "MEMORY_BUDGETS", {"aggregate": 100})
+
+        @metrics.instrument("aggregate")
+        def allocate():
+            pass
+
+        with pytest.raises(metrics.MemoryBudgetError, match="aggregate.allocate"):
+            metrics.collect(allocate)
+        assert metrics.records.pop()["peak_rss_mb"] == 200
+
+    def test_earlier_peaks_are_not_breaches(self, monkeypatch):
+        monkeypatch.setattr(metrics, "_reset_peak_rss", lambda: False)
+        monkeypatch.setattr(metrics, "rss_mb", lambda: None)
+        monkeypatch.setattr(metrics, "peak_rss_mb", lambda: 200)
+        monkeypatch.setattr(metrics, "_start_watchdog", lambda: None)
+        monkeypatch.setattr(metrics.config, "MEMORY_BUDGETS", {"aggregate": 100})
+
+        @metrics.instrument("aggregate")
+        def allocate():
+            pass
+
+        _, [record] = metrics.collect(allocate)
+        assert record["peak_rss_mb"] == 200
+
+    def test_watchdog_raises_without_current_memory(self, monkeypatch):
+        peak = [50]
+        monkeypatch.setattr(metrics, "_reset_peak_rss", lambda: False)
+        monkeypatch.setattr(metrics, "rss_mb", lambda: None)
+        monkeypatch.setattr(metrics, "peak_rss_mb", lambda: peak[0])
+        monkeypatch.setattr(metrics, "WATCH_INTERVAL", 0.01)
+        monkeypatch.setattr(metrics.config, "MEMORY_BUDGETS", {"aggregate": 100})
+
+        @metrics.instrument("aggregate")
+        def allocate():
+            peak[0] = 200
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                time.sleep(0.01)
+
+        with pytest.raises(metrics.MemoryBudgetError, match="reached 200 MB"):
+            metrics.collect(allocate)
+        metrics.records.pop()
+
+
+class TestRunInstrumented(object):
+    def test_writes_report_of_failed_run(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(metrics.config, "METRICS_DIR", str(tmp_path))
+        monkeypatch.setattr(metrics, "configure_memory", lambda *args: None)
+        parser = argparse.ArgumentParser()
+        metrics.add_arguments(parser, example="clean.add_region")
+        args = parser.parse_args(["--memory-budget", "clean=100"])
+        assert args.memory_budget == [("clean", 100.0)] and args.profile is None
+        info = {}
+
+        def fail():
+            info["pieces"] = 1
+            raise ValueError
+
+        with pytest.raises(ValueError):
+            metrics.run_instrumented("clean", args, fail, info)
+        [fp] = tmp_path.glob("clean_*[0-9].json")
+        report = json.loads(fp.read_text())
+        assert report["pieces"] == 1
+        assert report["stages"][-1]["error"] == "ValueError"
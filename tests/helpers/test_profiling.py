@@ -0,0 +1,35 @@
+import json
+
+import pandas as pd
+
+import src.helpers.metrics as metrics
+import src.helpers.profiling as profiling
+
+
+class TestProfile(object):
+    def test_writes_profiles_of_selected_stages(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(profiling.config, "PROFILE_STAGES", ["aggregate"])
+        monkeypatch.setattr(profiling.config, "PROFILE_DIR", str(tmp_path))
+
+        @metrics.instrument("aggregate")
+        def group_sums(df):
+            return df.groupby("user_id").sum()
+
+        @metrics.instrument("select")
+        def drop_first(df):
+            return df.iloc[1:]
+
+        df = pd.DataFrame({"user_id": [1, 1, 2], "amount": [1.0, 2.0, 3.0]})
+        _, records = metrics.collect(lambda df: drop_first(group_sums(df)), df)
+        assert [r["name"] for r in records] == ["group_sums", "drop_first"]
+        assert "profile" not in records[1]
+        assert records[0]["profile"].endswith(".txt")
+        assert "group_sums" in open(records[0]["profile"]).read()
+
+        base = records[0]["profile"][: -len(".txt")]
+        with open(base + ".speedscope.json") as f:
+            [profile] = json.load(f)["profiles"]
+        with open(base + ".folded") as f:
+            stacks = [line.rsplit(" ", 1) for line in f]
+        assert sum(profile["weights"]) > 0
+        assert any(stack.startswith("group_sums (") for stack, _ in stacks)
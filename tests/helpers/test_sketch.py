@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import src.helpers.sketch as sk
+
+
+class TestQuantileSketch:
+    @pytest.fixture
+    def values(self):
+        rng = np.random.default_rng(0)
+        values = np.concatenate(
+            [rng.lognormal(5, 2, 5000), -rng.lognormal(3, 1, 1000), np.zeros(100)]
+        )
+        values[::50] = np.nan
+        return values
+
+    @pytest.mark.parametrize("alpha", [0.01, 0.001])
+    def test_relative_error_within_alpha(self, values, alpha):
+        pcts = [0.5, 1, 25, 50, 99, 99.5]
+        sketch = sk.QuantileSketch(alpha=alpha).update(values)
+        exact = np.nanpercentile(values, pcts)
+        assert sketch.count == np.count_nonzero(~np.isnan(values))
+        assert np.all(np.abs(sketch.quantile(pcts) - exact) <= alpha * np.abs(exact))
+
+    def test_merged_sketches_equal_sketch_of_all_values(self, values):
+        pieces = np.array_split(values, 3)
+        merged = sk.QuantileSketch()
+        for piece in pieces:
+            merged.merge(sk.QuantileSketch().update(piece))
+        whole = sk.QuantileSketch().update(values)
+        np.testing.assert_array_equal(merged.quantile([1, 99]), whole.quantile([1, 99]))
+
+    def test_empty_sketch_returns_missing(self):
+        assert np.isnan(sk.QuantileSketch().quantile([1, 99])).all()
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+
+import src.helpers.strings as strings
+
+
+class TestLower(object):
+    def test_matches_lowercase_cast_to_category(self):
+        values = ["Tesco DD", "tesco dd", np.nan, "Costa", "costa"]
+        s = pd.Series(values, dtype="category").cat.add_categories(["Unused"])
+        expected = s.str.lower().astype("category")
+        pd.testing.assert_series_equal(strings.lower(s), expected)
+
+
+class TestContains(object):
+    def test_broadcasts_category_matches(self):
+        s = pd.Series(["a transfer", "bbp bill", np.nan, "a transfer"], dtype="category")
+        assert strings.contains(s, "transfer|bbp").tolist() == [True, True, False, True]
+        assert strings.contains(s, "bbp", na=True).tolist() == [False, True, True, False]